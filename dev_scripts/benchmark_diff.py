@@ -0,0 +1,91 @@
+"""
+Compare the time and peak memory (allocated by Python in the main process,
+tracemalloc) of the Differ.diff modes, on two maggma.memdb collections with a few differences.
+
+Usage:
+    python benchmark_diff.py [n_records] [num_workers] [n_numeric]
+
+n_numeric is the number of numeric properties of the columnar vs scalar (key by
+key) comparison.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from maggma.lava.diff import Delta, Differ
+from maggma.memdb import MemoryDatabase
+
+
+def make_collections(n_records):
+    db = MemoryDatabase()
+    random.seed(0)
+    for coll in (db["old"], db["new"]):
+        coll.insert_many([{"task_id": "mp-{}".format(i),
+                           "formula": "Fe{}O{}".format(i % 7, i % 5),
+                           "energy": -1.0 * (i % 100) + (random.random() < 0.01),
+                           "_lu": 0}
+                          for i in range(n_records) if random.random() > 0.001])
+        coll.create_index("task_id")
+    return db["old"], db["new"]
+
+
+def make_numeric_collections(n_records, n_numeric):
+    db = MemoryDatabase()
+    random.seed(0)
+    for coll in (db["old"], db["new"]):
+        coll.insert_many([dict({"task_id": "mp-{}".format(i)},
+                               **{"e{}".format(j): -1.0 * ((i + j) % 100) + (random.random() < 0.01)
+                                  for j in range(n_numeric)})
+                          for i in range(n_records)])
+    return db["old"], db["new"]
+
+
+def benchmark(differ, collections, **kwargs):
+    t0 = time.time()
+    result = differ.diff(*collections, **kwargs)
+    elapsed = time.time() - t0
+    # separate run, tracemalloc slows down the diff (and the forked workers)
+    tracemalloc.start()
+    differ.diff(*collections, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, {k: len(v) for k, v in result.items()}
+
+
+if __name__ == "__main__":
+    n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    n_numeric = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    collections = make_collections(n_records)
+    differ = Differ(key="task_id", props=["formula"], deltas={"energy": Delta("+-0.5")})
+    for name, kwargs in (("in memory", {}),
+                         ("stream", {"stream": True}),
+                         ("stream, spill", {"stream": True, "spill": 10000}),
+                         ("parallel", {"num_workers": num_workers}),
+                         ("fingerprint", {"fingerprint": True}),
+                         ("columnar", {"columnar": True})):
+        elapsed, peak, counts = benchmark(differ, collections, **kwargs)
+        print("{:<16s} {:>8.2f} sec {:>10.1f} MB peak  {}".format(
+            name, elapsed, peak / 1e6, counts))
+
+    # incremental re-run after updating 1% of the records
+    with tempfile.TemporaryDirectory() as tmpdir:
+        kwargs = {"state": os.path.join(tmpdir, "state.pickle")}
+        differ.diff(*collections, **kwargs)
+        for doc in collections[1].find({}, {"task_id": 1}).limit(n_records // 100):
+            collections[1].update_one({"task_id": doc["task_id"]}, {"$set": {"energy": 1.0, "_lu": 1}})
+        name = "incremental"
+        elapsed, peak, counts = benchmark(differ, collections, **kwargs)
+        print("{:<16s} {:>8.2f} sec {:>10.1f} MB peak  {}".format(
+            name, elapsed, peak / 1e6, counts))
+
+    # many numeric properties, key by key vs columnar
+    collections = make_numeric_collections(n_records, n_numeric)
+    differ = Differ(key="task_id", deltas={"e{}".format(j): Delta("+-0.5") for j in range(n_numeric)})
+    for name, kwargs in (("scalar", {}), ("columnar", {"columnar": True})):
+        elapsed, peak, counts = benchmark(differ, collections, **kwargs)
+        print("{:<16s} {:>8.2f} sec {:>10.1f} MB peak  {}".format(
+            "{} x{:d}".format(name, n_numeric), elapsed, peak / 1e6, counts))
@@ -0,0 +1,65 @@
+"""
+Compare the dot-notation accessors of maggma.utils (compiled, cached DotPath)
+against the previous implementation of get_mongolike and put_mongolike, which
+split and parsed the key at every call.
+
+Usage:
+    python benchmark_dot_path.py [n_docs]
+"""
+import sys
+import timeit
+
+from maggma.utils import dot_path, extract_paths, get_mongolike, put_mongolike
+
+
+def legacy_get_mongolike(d, key):
+    lead_key = key.split(".", 1)[0]
+    try:
+        lead_key = int(lead_key)
+    except:
+        pass
+
+    if "." in key:
+        remainder = key.split(".", 1)[1]
+        return legacy_get_mongolike(d[lead_key], remainder)
+    return d[lead_key]
+
+
+def legacy_put_mongolike(key, value):
+    lead_key = key.split(".", 1)[0]
+
+    if "." in key:
+        remainder = key.split(".", 1)[1]
+        return {lead_key: legacy_put_mongolike(remainder, value)}
+    return {lead_key: value}
+
+
+KEYS = ["task_id", "output.energy", "output.structure.lattice.a", "calcs_reversed.0.output.gap"]
+
+
+def make_docs(n):
+    return [{"task_id": i,
+             "output": {"energy": -1.5 * i, "structure": {"lattice": {"a": 3.0 + i}}},
+             "calcs_reversed": [{"output": {"gap": 0.1 * i}}]}
+            for i in range(n)]
+
+
+def bench(label, fn, n_values, number=5):
+    elapsed = min(timeit.repeat(fn, number=1, repeat=number))
+    print("{:<36s} {:>12.0f} values/sec".format(label, n_values / elapsed))
+
+
+if __name__ == "__main__":
+    n_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    docs = make_docs(n_docs)
+    n_values = n_docs * len(KEYS)
+    paths = [dot_path(k) for k in KEYS]
+
+    bench("legacy get_mongolike", lambda: [legacy_get_mongolike(d, k) for d in docs for k in KEYS],
+          n_values)
+    bench("get_mongolike", lambda: [get_mongolike(d, k) for d in docs for k in KEYS], n_values)
+    bench("DotPath.get", lambda: [p.get(d) for d in docs for p in paths], n_values)
+    bench("extract_paths", lambda: extract_paths(docs, KEYS), n_values)
+    bench("legacy put_mongolike", lambda: [legacy_put_mongolike(k, 1) for _ in docs for k in KEYS],
+          n_values)
+    bench("put_mongolike", lambda: [put_mongolike(k, 1) for _ in docs for k in KEYS], n_values)
@@ -0,0 +1,75 @@
+"""
+Compare the throughput (items/sec) of MPIProcessor and MPICollectiveProcessor at
+several numbers of MPI ranks.
+
+Usage:
+    python benchmark_mpi.py [n_items] [item_cost] [ranks ...]
+
+item_cost is the processing time of an item in seconds (busy loop). Each rank
+count runs in its own mpiexec, e.g. python benchmark_mpi.py 20000 0.0001 2 4 8
+"""
+import os
+import subprocess
+import sys
+import time
+
+from maggma.builder import Builder
+from maggma.stores import MemoryStore
+
+
+class BusyBuilder(Builder):
+
+    def __init__(self, N, cost, sources, targets, chunk_size=1000):
+        super(BusyBuilder, self).__init__(sources, targets, chunk_size)
+        self.N = N
+        self.cost = cost
+        self.n_updated = 0
+
+    def get_items(self):
+        for i in range(self.N):
+            yield {"task_id": i, "data": list(range(10))}
+
+    def process_item(self, item):
+        t_end = time.perf_counter() + self.cost
+        while time.perf_counter() < t_end:
+            pass
+        item["sum"] = sum(item["data"])
+        return item
+
+    def update_targets(self, items):
+        self.n_updated += len(items)
+
+    def finalize(self, cursor=None):
+        pass
+
+
+def benchmark(n_items, cost):
+    from maggma.runner import MPIProcessor, MPICollectiveProcessor
+
+    for cls, kwargs in ((MPIProcessor, {"batch_size": 0}),
+                        (MPICollectiveProcessor, {"items_per_rank": 100})):
+        builder = BusyBuilder(n_items, cost, [MemoryStore("source")], [MemoryStore("target")])
+        processor = cls([builder], **kwargs)
+        processor.comm.Barrier()
+        t0 = time.time()
+        processor.process(0)
+        processor.comm.Barrier()
+        elapsed = time.time() - t0
+        if processor.rank == 0:
+            assert builder.n_updated == n_items
+            print("{:>5d} ranks  {:<24s} {:>12.0f} items/sec".format(
+                processor.size, cls.__name__, n_items / elapsed))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cost = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0001
+    ranks = [int(r) for r in sys.argv[3:]] or [2, 4]
+    if os.environ.get("MAGGMA_BENCHMARK_RANK"):
+        benchmark(n_items, cost)
+    else:
+        env = dict(os.environ, MAGGMA_BENCHMARK_RANK="1")
+        for n_ranks in ranks:
+            subprocess.check_call(["mpiexec", "-n", str(n_ranks), sys.executable, __file__,
+                                   str(n_items), str(cost)], env=env)
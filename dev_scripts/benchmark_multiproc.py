@@ -0,0 +1,95 @@
+"""
+Compare the throughput (items/sec) of MultiprocProcessor against the previous
+implementation, which collected processed items in a multiprocessing.Manager().list().
+
+Usage:
+    python benchmark_multiproc.py [n_items] [num_workers]
+"""
+import multiprocessing
+import sys
+import time
+
+from maggma.builder import Builder
+from maggma.runner import MultiprocProcessor
+from maggma.stores import MemoryStore
+
+
+class NullBuilder(Builder):
+
+    def __init__(self, N, sources, targets, chunk_size=1000):
+        super(NullBuilder, self).__init__(sources, targets, chunk_size)
+        self.N = N
+        self.n_updated = 0
+
+    def get_items(self):
+        for i in range(self.N):
+            yield {"task_id": i, "data": list(range(10))}
+
+    def process_item(self, item):
+        item["sum"] = sum(item["data"])
+        return item
+
+    def update_targets(self, items):
+        self.n_updated += len(items)
+
+    def finalize(self, cursor=None):
+        pass
+
+
+class ManagerListProcessor(MultiprocProcessor):
+    """
+    The manager-list result path MultiprocProcessor used to implement.
+    """
+
+    def process(self, builder_id, num_workers=None):
+        builder = self.builders[builder_id]
+        chunk_size = builder.chunk_size
+        self._queue = multiprocessing.Queue(chunk_size)
+        manager = multiprocessing.Manager()
+        self.processed_items = manager.list()
+        builder.connect()
+        processes = [multiprocessing.Process(target=self.worker, args=(self._queue, None))
+                     for _ in range(self.num_workers)]
+        for p in processes:
+            p.start()
+        cursor = builder.get_items()
+        for item in cursor:
+            if len(self.processed_items) >= chunk_size:
+                builder.update_targets(self.processed_items[:chunk_size])
+                del self.processed_items[:chunk_size]
+            self._queue.put((builder_id, item))
+        for _ in range(self.num_workers):
+            self._queue.put(None)
+        for p in processes:
+            p.join()
+        while len(self.processed_items):
+            builder.update_targets(self.processed_items[:chunk_size])
+            del self.processed_items[:chunk_size]
+        builder.finalize(cursor)
+        manager.shutdown()
+
+    def worker(self, task_queue, result_queue):
+        while True:
+            packet = task_queue.get()
+            if packet is None:
+                break
+            builder_id, item = packet
+            self.processed_items.append(self.builders[builder_id].process_item(item))
+
+
+def benchmark(processor_cls, n_items, num_workers):
+    builder = NullBuilder(n_items, [MemoryStore("source")], [MemoryStore("target")])
+    processor = processor_cls([builder], num_workers)
+    t0 = time.time()
+    processor.process(0)
+    elapsed = time.time() - t0
+    assert builder.n_updated == n_items
+    return n_items / elapsed
+
+
+if __name__ == "__main__":
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    for cls in (ManagerListProcessor, MultiprocProcessor):
+        rate = benchmark(cls, n_items, num_workers)
+        print("{:<24s} {:>12.0f} items/sec".format(cls.__name__, rate))
@@ -0,0 +1,55 @@
+"""
+Compare the time spent starting workers when each build starts its own pool of
+worker processes with a pool shared by all the builds of a run (the pool is
+started once by Runner.run), for the fork and forkserver start methods.
+
+Usage:
+    python benchmark_worker_startup.py [n_builders] [num_workers]
+"""
+import sys
+import time
+
+from maggma.builder import Builder
+from maggma.runner import MultiprocProcessor
+from maggma.stores import MemoryStore
+
+
+class SmallBuilder(Builder):
+
+    def __init__(self, N, sources, targets, chunk_size=1000):
+        super(SmallBuilder, self).__init__(sources, targets, chunk_size)
+        self.N = N
+
+    def get_items(self):
+        return range(self.N)
+
+    def update_targets(self, items):
+        pass
+
+    def finalize(self, cursor=None):
+        pass
+
+
+def benchmark(n_builders, num_workers, start_method, shared):
+    builders = [SmallBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")])
+                for _ in range(n_builders)]
+    processor = MultiprocProcessor(builders, num_workers, start_method=start_method)
+    t0 = time.time()
+    if shared:
+        processor.start()
+    try:
+        for i in range(n_builders):
+            processor.process(i)
+    finally:
+        processor.close()
+    return (time.time() - t0) / n_builders
+
+
+if __name__ == "__main__":
+    n_builders = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    for start_method in ("fork", "forkserver"):
+        for shared in (False, True):
+            elapsed = benchmark(n_builders, num_workers, start_method, shared)
+            print("{:<10s} {:<14s} {:>8.1f} ms/build".format(
+                start_method, "shared pool" if shared else "pool per build", 1000 * elapsed))
@@ -1,12 +1,24 @@
 from abc import ABCMeta, abstractmethod
+from datetime import datetime
+import heapq
 import logging
 
 from monty.json import MSONable
+from pymongo import ASCENDING
+
+from maggma.memdb import sort_key
+from maggma.utils import dot_path
 
 
 class Builder(MSONable, metaclass=ABCMeta):
 
-    def __init__(self, sources, targets, chunk_size=1000):
+    #: optional bounds on the chunks of processed items passed to
+    #: update_targets, in addition to chunk_size: total size in bytes (see
+    #: maggma.utils.sizeof) and time in seconds spent collecting a chunk
+    chunk_max_bytes = None
+    chunk_max_age = None
+
+    def __init__(self, sources, targets, chunk_size=1000, incremental=False, key="task_id"):
         """
         Initialize the builder the framework.
 
@@ -14,10 +26,16 @@ class Builder(MSONable, metaclass=ABCMeta):
             sources([Store]): list of source stores
             targets([Store]): list of target stores
             chunk_size(int): chunk size for processing
+            incremental (bool): only build the source documents that are new or
+                changed since the last complete build, see get_new_keys
+            key (str): field identifying the source documents
         """
         self.sources = sources
         self.targets = targets
         self.chunk_size = chunk_size
+        self.incremental = incremental
+        self.key = key
+        self.build_start = None
 
         self.logger = logging.getLogger(type(self).__name__)
         self.logger.addHandler(logging.NullHandler())
@@ -29,6 +47,70 @@ class Builder(MSONable, metaclass=ABCMeta):
         stores = self.sources + self.targets
         for s in stores:
             s.connect()
+        self.build_start = datetime.utcnow()
+
+    def connect_sources(self):
+        """
+        Connect the sources that are not connected in this process yet, e.g. in
+        a worker process reading a shard, see get_shard_items.
+        """
+        for source in self.sources:
+            if not source.connected:
+                source.connect()
+
+    def get_watermark(self):
+        """
+        The time of the last complete build, i.e. the oldest watermark recorded
+        in the targets by update_watermarks, or datetime.min if a target has
+        none. Documents stamped by an interrupted build are not taken into
+        account.
+
+        Returns:
+            datetime
+        """
+        watermarks = []
+        for target in self.targets:
+            watermark = target.watermark
+            watermarks.append(datetime.min if watermark is None else target.lu_key[0](watermark))
+        return min(watermarks, default=datetime.min)
+
+    def get_new_keys(self):
+        """
+        Keys of the source documents to build. In incremental mode, these are
+        the documents of any source with a lu_field later than the watermark,
+        otherwise all the documents of the sources.
+
+        The keys are streamed from the sources sorted by key (which needs an
+        index on the key for big collections) and merged, so they are never
+        all held in memory. The key values must be of a single type.
+
+        Yields:
+            the keys, sorted and unique
+        """
+        watermark = self.get_watermark() if self.incremental else datetime.min
+        scans = []
+        for source in self.sources:
+            criteria = {}
+            if watermark != datetime.min:
+                criteria = {source.lu_field: {"$gt": source.lu_key[1](watermark)}}
+            cursor = source.collection.find(criteria, {self.key: True, "_id": False})
+            scans.append(self._sorted_keys(cursor.sort(self.key, ASCENDING)))
+        previous, n_keys = None, 0
+        for sortable, key in heapq.merge(*scans):
+            if n_keys and sortable == previous:
+                continue
+            previous, n_keys = sortable, n_keys + 1
+            yield key
+        self.logger.info("{} keys to build".format(n_keys))
+
+    def _sorted_keys(self, docs):
+        path = dot_path(self.key)
+        for doc in docs:
+            try:
+                key = path._get(doc)
+            except KeyError:
+                continue
+            yield sort_key(key), key
 
     @abstractmethod
     def get_items(self):
@@ -40,10 +122,44 @@ class Builder(MSONable, metaclass=ABCMeta):
         """
         pass
 
+    def get_shards(self, n):
+        """
+        Split the items into about n shards that the workers of the parallel
+        processors read straight from the sources with get_shard_items, instead
+        of receiving the items of get_items from the master process. Default
+        behavior is to return None, i.e. to use get_items. A typical
+        implementation returns self.sources[0].key_ranges(self.key, n).
+
+        Args:
+            n (int): suggested number of shards
+
+        Returns:
+            list: picklable description of each shard, or None
+        """
+        return None
+
+    def get_shard_items(self, shard):
+        """
+        The items of a shard, see get_shards. Called in a worker process, after
+        connect_sources.
+
+        Args:
+            shard: description of the shard, from get_shards
+
+        Returns:
+            generator or list of items to process
+        """
+        raise NotImplementedError("{} does not support sharding".format(type(self).__name__))
+
     def process_item(self, item):
         """
         Process an item. Should not expect DB access as this can be run MPI
         Default behavior is to return the item.
+
+        In the worker processes of MultiprocProcessor, which may have been
+        started before connect was called, only connect_sources has been
+        called: state set up by an overridden connect is not available.
+
         Args:
             item:
 
@@ -52,6 +168,24 @@ class Builder(MSONable, metaclass=ABCMeta):
         """
         return item
 
+    def item_key(self, item):
+        """
+        Key identifying an item of get_items. The key of the last item written
+        to the targets is saved in the run checkpoint, and a resumed run skips
+        the items up to this key, so get_items must yield the items sorted by
+        unique keys to resume. Default behavior is to return item[self.key]
+        for dict items, otherwise None, in which case the run cannot be resumed.
+
+        Args:
+            item: an item from get_items
+
+        Returns:
+            a BSON-encodable key or None
+        """
+        if isinstance(item, dict):
+            return item.get(self.key)
+        return None
+
     @abstractmethod
     def update_targets(self, items):
         """
@@ -66,16 +200,48 @@ class Builder(MSONable, metaclass=ABCMeta):
         """
         pass
 
+    def stamp_items(self, items):
+        """
+        In incremental mode, set the lu_field of every target to the start time
+        of the build on the processed items (dicts) before update_targets. The
+        start time, rather than the write time, ensures that the source
+        documents changed during the build are built again.
+
+        Args:
+            items (list): processed items
+
+        Returns:
+            list: the items
+        """
+        if self.incremental and self.build_start is not None:
+            for target in self.targets:
+                path, lu = dot_path(target.lu_field), target.lu_key[1](self.build_start)
+                for item in items:
+                    if isinstance(item, dict):
+                        path.set(item, lu)
+        return items
+
+    def update_watermarks(self):
+        """
+        Cache the lu_field high-water mark of each target in its meta collection,
+        see Store.update_watermark. Called by the processors once all the
+        processed items have been written. In incremental mode, the start time
+        of the build is recorded in a single write per target, so an
+        interrupted build never advances the watermark.
+        """
+        for target in self.targets:
+            if self.incremental and self.build_start is not None:
+                target.update_watermark(target.lu_key[1](self.build_start))
+            else:
+                target.update_watermark()
+
     def finalize(self, cursor=None):
         """
         Perform any final clean up.
         """
         # Close any Mongo connections.
         for store in (self.sources + self.targets):
-            try:
-                store.collection.database.client.close()
-            except AttributeError:
-                continue
+            store.close()
         # Runner will pass iterable yielded by `self.get_items` as `cursor`. If
         # this is a Mongo cursor with `no_cursor_timeout=True` (not the
         # default), we must be explicitly kill it.
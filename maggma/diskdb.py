@@ -0,0 +1,376 @@
+"""
+A persistent, memory-mapped collection engine for local builds.
+
+Each DiskCollection is stored in a directory as two files:
+
+    <name>.records  append-only log of BSON documents and deletion markers,
+                    read through a memory map
+    <name>.index    pickled _id -> offset map and field indexes, written by
+                    flush/close
+
+Opening a collection loads the index file and replays the records appended
+after it was written (e.g. after a crash), so no document is parsed at start
+up. Replaced and deleted documents stay in the log until compact is called.
+
+A single process writes a directory: the first to open it takes an exclusive
+lock on its LOCK file (fcntl.flock, POSIX only), held until it exits. The
+other processes, including the children forked by the writer, open the files
+read-only: they see the documents as of opening, never cut off a record the
+writer is appending, and fail with PermissionError on writes.
+
+Queries, updates and indexes are those of maggma.memdb.
+"""
+import mmap
+import os
+import pickle
+import threading
+from collections.abc import MutableMapping
+from itertools import count
+
+from bson import BSON
+
+from maggma.memdb import MemoryCollection, MemoryDatabase
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: no lock between processes
+    fcntl = None
+
+
+class RecordFile:
+    """
+    Append-only file of BSON records. Each record is a one byte flag, DOC or
+    DELETED, followed by a BSON document (which starts with its own length).
+    """
+
+    DOC, DELETED = b"\x00", b"\x01"
+
+    #: number of appended documents kept in memory before remapping the file
+    MAX_PENDING = 10000
+
+    def __init__(self, path, read_only=False):
+        """
+        Args:
+            path (str): path of the file
+            read_only (bool): whether another process writes the file
+        """
+        self.path = path
+        self.read_only = read_only
+        self._pid = os.getpid()
+        self._file = None
+        self._mmap = None
+        self._pending = {}  # offset: document, appended since the file was mapped
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    @property
+    def writable(self):
+        """
+        Whether this process writes the file: not read-only, and not a child
+        forked by the writer.
+        """
+        return not self.read_only and self._pid == os.getpid()
+
+    def _check_writable(self):
+        if not self.writable:
+            raise PermissionError("{} is written by another process".format(self.path))
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            self.size = self._file.tell()
+
+    def _remap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.flush()
+        if self.size:
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pending = {}
+
+    def append(self, flag, doc):
+        """
+        Append a record.
+
+        Args:
+            flag (bytes): DOC or DELETED
+            doc (dict): the document, or {"_id": _id} for a deletion
+
+        Returns:
+            int: offset of the record
+        """
+        self._check_writable()
+        self._open()
+        offset = self.size
+        data = BSON.encode(doc)
+        self._file.write(flag + data)
+        self.size += 1 + len(data)
+        if flag == self.DOC:
+            if len(self._pending) >= self.MAX_PENDING:
+                self._remap()
+            self._pending[offset] = doc
+        return offset
+
+    def _read(self, offset):
+        length = int.from_bytes(self._mmap[offset + 1:offset + 5], "little")
+        flag = self._mmap[offset:offset + 1]
+        return flag, BSON(self._mmap[offset + 1:offset + 1 + length]).decode(), 1 + length
+
+    def read(self, offset):
+        """
+        Read the document of the record at an offset.
+        """
+        if offset in self._pending:
+            return dict(self._pending[offset])
+        if self._mmap is None or offset >= len(self._mmap):
+            self._remap()
+        return self._read(offset)[1]
+
+    def scan(self, start=0):
+        """
+        Iterate over the records from an offset. A truncated record at the end
+        of the file (e.g. after a crash during a write) is cut off, unless the
+        file is written by another process, which may be appending it.
+
+        Yields:
+            tuple: (offset, flag, document)
+        """
+        self._remap()
+        offset = start
+        end = len(self._mmap) if self._mmap is not None else 0
+        while offset < end:
+            try:
+                flag, doc, length = self._read(offset)
+            except Exception:
+                length = None
+            if length is None or offset + length > end:
+                if self.writable:
+                    self.truncate(offset)
+                return
+            yield offset, flag, doc
+            offset += length
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def truncate(self, size=0):
+        self._check_writable()
+        self.close()
+        with open(self.path, "ab") as f:
+            f.truncate(size)
+        self.size = size
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._pending = {}
+
+
+class RecordMap(MutableMapping):
+    """
+    _id -> document mapping backed by a RecordFile. Setting a document appends
+    it to the file, deleting one appends a deletion marker.
+    """
+
+    def __init__(self, records, offsets=None):
+        self.records = records
+        self.offsets = offsets if offsets is not None else {}
+
+    def __getitem__(self, _id):
+        return self.records.read(self.offsets[_id])
+
+    def __setitem__(self, _id, doc):
+        self.offsets[_id] = self.records.append(RecordFile.DOC, doc)
+
+    def __delitem__(self, _id):
+        del self.offsets[_id]
+        self.records.append(RecordFile.DELETED, {"_id": _id})
+
+    def __contains__(self, _id):
+        return _id in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def clear(self):
+        self.offsets.clear()
+        self.records.truncate()
+
+
+class DiskCollection(MemoryCollection):
+    """
+    MemoryCollection persisted in a directory, see the module doc.
+    """
+
+    def __init__(self, name, database):
+        """
+        Args:
+            name (str): collection name
+            database (DiskDatabase): database holding the collection
+        """
+        super(DiskCollection, self).__init__(name, database)
+        base = os.path.join(database.path, name)
+        self._index_path = base + ".index"
+        self._docs = RecordMap(RecordFile(base + ".records", database.read_only))
+        self._load()
+
+    def _load(self):
+        """
+        Load the index file and replay the records appended after it.
+        """
+        start = 0
+        records = self._docs.records
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "rb") as f:
+                state = pickle.load(f)
+            if state["size"] <= records.size:
+                start = state["size"]
+                self._docs.offsets = state["offsets"]
+                self._indexes = state["indexes"]
+        if start < records.size:
+            for offset, flag, doc in records.scan(start):
+                _id = doc["_id"]
+                for index in self._indexes.values():
+                    index.remove(_id)
+                if flag == RecordFile.DELETED:
+                    self._docs.offsets.pop(_id, None)
+                else:
+                    self._docs.offsets[_id] = offset
+                    for index in self._indexes.values():
+                        index.add(_id, doc)
+        self._seq = {_id: n for n, _id in enumerate(self._docs.offsets)}
+        self._counter = count(len(self._seq))
+
+    def create_index(self, keys, unique=False, **kwargs):
+        n_indexes = len(self._indexes)
+        name = super(DiskCollection, self).create_index(keys, unique, **kwargs)
+        if len(self._indexes) != n_indexes:
+            self.flush()
+        return name
+
+    def flush(self):
+        """
+        Write the records to disk and save the indexes.
+        """
+        with self._lock:
+            records = self._docs.records
+            if not records.writable:
+                return
+            if not records.size and not os.path.exists(self._index_path):
+                return
+            records.flush()
+            state = {"size": records.size, "offsets": self._docs.offsets,
+                     "indexes": self._indexes}
+            tmp_path = self._index_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._index_path)
+
+    def compact(self):
+        """
+        Rewrite the records file without the replaced and deleted documents.
+        """
+        with self._lock:
+            records = self._docs.records
+            docs = [(_id, self._docs[_id]) for _id in self._docs]
+            records.truncate()
+            self._docs.offsets = {}
+            for _id, doc in docs:
+                self._docs[_id] = doc
+            self.flush()
+
+    def close(self):
+        """
+        Flush and release the file handles.
+        """
+        with self._lock:
+            self.flush()
+            self._docs.records.close()
+
+    def drop(self):
+        super(DiskCollection, self).drop()
+        with self._lock:
+            if os.path.exists(self._index_path):
+                os.remove(self._index_path)
+
+
+class DiskDatabase(MemoryDatabase):
+    """
+    Set of DiskCollections stored in a directory. Use DiskDatabase.open to get
+    the database of a directory, so that a process never writes the same
+    files through two different objects. The database is read-only if another
+    process writes the directory, see the module doc.
+    """
+
+    collection_class = DiskCollection
+
+    _open_databases = {}
+    _open_lock = threading.RLock()
+    _writer_locks = {}  # realpath: (pid, LOCK file) of the directories written by the process
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): directory of the database, created if needed
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.read_only = not self._lock_writer(path)
+        self._pid = os.getpid()
+        super(DiskDatabase, self).__init__(os.path.basename(os.path.abspath(path)))
+
+    @classmethod
+    def _lock_writer(cls, path):
+        """
+        Take the writer lock of a directory, held until the process exits.
+
+        Returns:
+            bool: whether the process writes the directory
+        """
+        if fcntl is None:
+            return True
+        key = os.path.realpath(path)
+        with cls._open_lock:
+            pid, _ = cls._writer_locks.get(key, (None, None))
+            if pid == os.getpid():
+                return True
+            lock_file = open(os.path.join(path, "LOCK"), "ab")
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            cls._writer_locks[key] = (os.getpid(), lock_file)
+            return True
+
+    @classmethod
+    def open(cls, path):
+        """
+        The DiskDatabase of a directory, shared within the process. A child
+        process gets its own, read-only, database instead of the one of its parent.
+        """
+        key = os.path.realpath(path)
+        with cls._open_lock:
+            db = cls._open_databases.get(key)
+            if db is None or db._pid != os.getpid():
+                db = cls._open_databases[key] = cls(path)
+            return db
+
+    def flush(self):
+        for coll in list(self._collections.values()):
+            coll.flush()
+
+    def close(self):
+        for coll in list(self._collections.values()):
+            coll.close()
@@ -1,6 +1,12 @@
 import json
+import os
+import threading
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import OperationFailure
+
+from maggma.memdb import sort_key
+from maggma.utils import get_mongolike
 
 
 def get_database(cred, **mongo_client_kwargs):
@@ -25,12 +31,99 @@ def get_database(cred, **mongo_client_kwargs):
     return db
 
 
+class ClientRegistry:
+    """
+    Process-wide registry of shared MongoClients.
+
+    Clients are keyed by host, port and credentials, and reference counted:
+    a client is closed when the last store using it releases it. Clients are
+    created with connect=False, and the registry forgets the clients of the
+    parent process after a fork (without closing them, they still belong to
+    the parent), so worker processes get their own clients.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._clients = {}  # key: [client, reference count]
+        self._keys = {}  # id(client): key
+
+    def acquire(self, host="localhost", port=27017, username="", password="",
+                database=None, **mongo_client_kwargs):
+        """
+        Get a shared client, incrementing its reference count.
+
+        Args:
+            host (str):
+            port (int):
+            username (str):
+            password (str):
+            database (str): database the credentials are for. Clients
+                authenticated against different databases are not shared.
+            mongo_client_kwargs: extra arguments for new MongoClients
+
+        Returns:
+            pymongo.MongoClient
+        """
+        key = (host, port, username, password, database if username else None)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if key not in self._clients:
+                # respect potential multiprocessing fork
+                mc_kwargs = dict(connect=False)
+                mc_kwargs.update(mongo_client_kwargs)
+                client = MongoClient(host, port, **mc_kwargs)
+                self._clients[key] = [client, 0]
+                self._keys[id(client)] = key
+            entry = self._clients[key]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, client):
+        """
+        Decrement the reference count of a client, closing it when it drops to 0.
+        Clients that are not in the registry (e.g. inherited from a parent
+        process) are left alone.
+
+        Args:
+            client (pymongo.MongoClient): client obtained with acquire
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            key = self._keys.get(id(client))
+            if key is None:
+                return
+            entry = self._clients[key]
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._clients[key]
+                del self._keys[id(client)]
+                client.close()
+
+    def count(self, client):
+        """
+        Reference count of a client, 0 if it is not in the registry.
+        """
+        with self._lock:
+            key = self._keys.get(id(client))
+            return self._clients[key][1] if key is not None else 0
+
+
+client_registry = ClientRegistry()
+
+
 def get_collection(config):
     """
     Returns collection from config file
 
     Args:
-        config(str): path to the collection config file
+        config(str): path to the collection config file, a JSON credential
+            dict (see get_database) with the name of the "collection"
 
     Returns:
         pymongo.collection
@@ -39,7 +132,83 @@ def get_collection(config):
         settings = json.load(f)
     settings["aliases_config"] = {"aliases": {}, "defaults": {}}
     db = get_database(cred=settings)
-    return db[config]
+    return db[settings["collection"]]
+
+
+def supports_aggregation(collection):
+    """
+    Whether a collection has an aggregate method. The collections of
+    maggma.memdb, like pymongo's, return sub-collections for unknown attributes.
+    """
+    return callable(getattr(type(collection), "aggregate", None))
+
+
+def key_range_filters(collection, key, n, criteria=None):
+    """
+    Split the documents of a collection into at most n contiguous ranges of key
+    values with about the same number of documents, e.g. to let workers read
+    their part of the collection themselves. The documents with the same key
+    are in the same range. The key values must be of a single type.
+
+    The bounds of the ranges are computed by the server with $bucketAuto if
+    possible. Otherwise they are picked in a single scan of the keys sorted by
+    the collection (which needs an index on the key for big collections), and
+    only the bounds are kept in memory.
+
+    Args:
+        collection: the collection
+        key (str): field to split on
+        n (int): number of ranges
+        criteria (dict): restrict the documents to those matching it
+
+    Returns:
+        list: a criteria dict selecting the documents of each range
+    """
+    bounds = [None]
+    for bound in _key_bounds(collection, key, n, criteria or {}):
+        if bound is not None and (bounds[-1] is None or sort_key(bound) > sort_key(bounds[-1])):
+            bounds.append(bound)
+    bounds.append(None)
+    ranges = []
+    for lower, upper in zip(bounds[:-1], bounds[1:]):
+        condition = {}
+        if lower is not None:
+            condition["$gte"] = lower
+        if upper is not None:
+            condition["$lt"] = upper
+        key_range = {key: condition} if condition else {}
+        ranges.append({"$and": [criteria, key_range]} if criteria else key_range)
+    return ranges
+
+
+def _key_bounds(collection, key, n, criteria):
+    """
+    Lower bounds of the key ranges after the first one, see key_range_filters.
+    """
+    if n <= 1:
+        return []
+    if supports_aggregation(collection):
+        pipeline = [{"$match": criteria}, {"$bucketAuto": {"groupBy": "$" + key, "buckets": n}}]
+        try:
+            buckets = list(collection.aggregate(pipeline, allowDiskUse=True))
+            return [bucket["_id"]["min"] for bucket in buckets[1:]]
+        except (NotImplementedError, OperationFailure):
+            pass
+    count = collection.count_documents(criteria)
+    positions = sorted(set(count * i // n for i in range(1, n)) - {0})
+    bounds = []
+    if not positions:
+        return bounds
+    cursor = collection.find(criteria, {key: True, "_id": False}).sort(key, ASCENDING)
+    for position, doc in enumerate(cursor):
+        if position == positions[len(bounds)]:
+            try:
+                bounds.append(get_mongolike(doc, key))
+            except KeyError:
+                bounds.append(None)
+            if len(bounds) == len(positions):
+                break
+    return bounds
 
 
 class CredentialManager:
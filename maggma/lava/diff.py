@@ -1,8 +1,24 @@
+import hashlib
+import heapq
 import logging
+import multiprocessing
+import os
+import pickle
 import re
+import tempfile
 import time
+from array import array
+from contextlib import ExitStack
+from itertools import islice
+from operator import itemgetter
 
-from maggma.helpers import get_collection
+from pymongo import ASCENDING, DESCENDING
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+from maggma.helpers import get_collection, key_range_filters, supports_aggregation
+from maggma.memdb import sort_key
+from maggma.utils import get_mongolike
 
 """
 Diff collections, as sets
@@ -29,7 +45,8 @@ class Differ(object):
     selected key.
 
     As noted in :func:`diff`, this will not work with huge datasets, as it stores
-    all the keys in memory in order to do a "set difference" using Python sets.
+    all the keys in memory in order to do a "set difference" using Python sets,
+    unless the streaming mode is used.
     """
 
     #: Keys in result dictionary.
@@ -46,6 +63,12 @@ class Differ(object):
     #: for missing property
     NO_PROPERTY = "__MISSING__"
 
+    #: field of the exact-match properties digest computed by the server
+    FINGERPRINT = "__fingerprint__"
+
+    #: BSON types hashed losslessly by $toHashedIndexKey, which truncates doubles
+    HASHED_TYPES = ["string", "int", "long", "bool", "date", "objectId"]
+
     def __init__(self, key='_id', props=None, info=None, fltr=None, deltas=None):
         """
         Constructor.
@@ -67,13 +90,16 @@ class Differ(object):
         self._all_props = list(set(self._props[:] +
                                    list(self._prop_deltas.keys())))
 
-    def diff(self, c1, c2, only_missing=False, only_values=False, allow_dup=False):
+    def diff(self, c1, c2, only_missing=False, only_values=False, allow_dup=False,
+             stream=False, spill=None, tmpdir=None, num_workers=0, partitions=None,
+             fingerprint=False, columnar=False, state=None, lu_field="_lu"):
         """
         Perform a difference between the 2 collections.
         The first collection is treated as the previous one, and the second
         is treated as the new one.
 
-        Note: this is not 'big data'-ready; we assume all the records can fit in memory.
+        Note: this is not 'big data'-ready; we assume all the records can fit in memory,
+        unless stream is True.
 
         Args:
             c1(str): Collection (1) config file
@@ -81,6 +107,35 @@ class Differ(object):
             only_missing(bool): Only find and return self.MISSING; ignore 'new' keys
             only_values(bool): Only find and return self.CHANGED; ignore new or missing keys
             allow_dup(bool): Allow duplicate keys, otherwise fail with ValueError
+            stream(bool): Read both collections sorted by key and merge-join them in
+                one pass, so that only the differences are kept in memory. The records
+                are sorted by the server, which needs an index on the key for big
+                collections, unless 'spill' is given.
+            spill(int): In stream mode, sort the records on the client instead, in
+                sorted runs of this many records spilled to temporary files.
+            tmpdir(str): Directory of the spilled runs, defaults to the system one.
+            num_workers(int): Split the key space in ranges and diff them in parallel on a
+                pool of num_workers processes, which open the collections themselves if
+                config files are given and otherwise inherit them (fork start method only,
+                not for pymongo collections, which are not fork-safe).
+                The key values must be of a single type.
+            partitions(int): Number of key ranges, defaults to 4 * num_workers
+            fingerprint(bool): Compare a digest of the exact-match properties instead of
+                their values, which are then fetched only for the keys with different
+                digests. If both collections support it, the server computes the
+                digest of the values of the types in HASHED_TYPES with
+                $toHashedIndexKey in an aggregation, and returns the other values
+                (floats, lists, ...). Otherwise (mongomock, memdb, older servers) the
+                client computes the digest of all the values. The path is logged.
+            columnar(bool): Without stream, evaluate the numeric deltas on NumPy arrays
+                of the properties of the common keys, instead of key by key. The
+                results are the same. Requires numpy.
+            state(str): Diff incrementally, saving in this file the key, fingerprint,
+                numeric properties and info of the records with the latest lu_field
+                value of each collection (watermark). Later runs with the same
+                settings read only the records updated after the watermarks, and scan
+                the keys for deleted records. Not allowed with stream or num_workers.
+            lu_field(str): 'last updated' field of the records, for state
 
         Returns:
             dict: dict with keys self.MISSING, self.NEW (unless only_missing is True),
@@ -90,91 +145,125 @@ class Differ(object):
                 'new' is keys found in c2 that are not found in c1, and 'changed' are records
                 with the same key that have different 'props' values.
         """
-        # Connect.
+        options = dict(only_missing=only_missing, only_values=only_values, allow_dup=allow_dup,
+                       stream=stream, spill=spill, tmpdir=tmpdir, fingerprint=fingerprint,
+                       columnar=columnar)
+        if num_workers > 0 and any(isinstance(c, Collection) for c in (c1, c2)):
+            raise ValueError("Give the config files of MongoDB collections with num_workers, "
+                             "pymongo collections are not fork-safe")
+        collections = self._connect(c1, c2)
+        if state:
+            if stream or num_workers > 0:
+                raise ValueError("Incremental diff can't be combined with stream or num_workers")
+            result, counts, missing_props = self._diff_incremental(
+                collections, self._filter, state, lu_field, only_missing, only_values, allow_dup,
+                columnar)
+        elif num_workers > 0:
+            result, counts, missing_props = self._diff_parallel(
+                collections, (c1, c2), num_workers, partitions or 4 * num_workers, options)
+        else:
+            result, counts, missing_props = self._diff(collections, self._filter, **options)
+        if result is None:
+            return {}
+        for count, missing in zip(counts, missing_props):
+            if not self._check_missing_props(count, missing):
+                return {}
+        return result
+
+    @staticmethod
+    def _connect(c1, c2):
         _log.info("connect.start")
-        # N.B. python3: isinstance(c1, str)
-        #      python2: isinstance(c1, basestring)
-        coll1 = (get_collection(cfg=c1) if isinstance(c1, str) else c1)
-        coll2 = (get_collection(cfg=c2) if isinstance(c2, str) else c2)
-        collections = [coll1, coll2]
+        coll1 = (get_collection(c1) if isinstance(c1, str) else c1)
+        coll2 = (get_collection(c2) if isinstance(c2, str) else c2)
         _log.info("connect.end")
+        return [coll1, coll2]
+
+    def _diff(self, collections, fltr, only_missing=False, only_values=False, allow_dup=False,
+              stream=False, spill=None, tmpdir=None, fingerprint=False, columnar=False):
+        """
+        Difference of the records of the collections matching a filter, see diff.
+
+        Returns:
+            tuple: (result or None if a record has no key, number of records of each
+                collection, number of missing properties of each collection)
+        """
+        if fingerprint:
+            fingerprint = self._fingerprint_path(collections)
+        if stream:
+            result, counts, missing_props = self._diff_stream(
+                collections, fltr, only_missing, only_values, allow_dup, spill, tmpdir, fingerprint)
+        else:
+            result, counts, missing_props = self._diff_memory(
+                collections, fltr, only_missing, only_values, allow_dup, fingerprint, columnar)
+        if fingerprint and result is not None and self._props:
+            result[self.CHANGED] = self._resolve_fingerprints(collections, fltr, result[self.CHANGED])
+        return result, counts, missing_props
 
+    def _diff_memory(self, collections, fltr, only_missing, only_values, allow_dup, fingerprint,
+                     columnar):
+        """
+        In-memory version of _diff, with Python sets.
+        """
         # Query DB.
         keys = [set(), set()]
         eqprops = [{}, {}]
-        numprops = [{}, {}]
-
-        # Build query fields.
-        fields = dict.fromkeys(self._info + self._all_props + [self._key_field], True)
-        if not '_id' in fields:  # explicitly remove _id if not given
-            fields['_id'] = False
+        numprops = self._numprops_store(columnar)
 
         # Initialize for query loop.
         info = {}  # per-key information
-        has_info, has_props = bool(self._info), bool(self._all_props)
-        has_numprops, has_eqprops = bool(self._prop_deltas), bool(self._props)
-        _log.info("query.start query={} fields={}".format(self._filter, fields))
+        has_numprops = bool(self._prop_deltas)
+        _log.info("query.start query={} fingerprint={}".format(fltr, fingerprint))
         t0 = time.time()
 
         # Main query loop.
+        counts, missing_props = [0, 0], [0, 0]
         for i, coll in enumerate(collections):
             _log.debug("collection {:d}".format(i))
-            count, missing_props = 0, 0
-            for rec in coll.find(filter=self._filter, projection=fields):
-                count += 1
-                # Extract key from record.
+            for rec in self._find(coll, fltr, fingerprint):
+                counts[i] += 1
+                # Extract key and properties from record.
                 try:
-                    key = rec[self._key_field]
-                except KeyError:
-                    _log.critical("Key '{}' not found in record: {}. Abort.".format(
-                        self._key_field, rec))
-                    return {}
+                    key, pvals, propval, rinfo, n_missing = self._extract(rec, i, fingerprint)
+                except KeyError as err:
+                    if err.args and err.args[0] == self._key_field:
+                        _log.critical("Key '{}' not found in record: {}. Abort.".format(
+                            self._key_field, rec))
+                        return None, counts, missing_props
+                    raise
                 if not allow_dup and key in keys[i]:
                     raise ValueError("Duplicate key: {}".format(key))
                 keys[i].add(key)
-                # Extract numeric properties.
+                missing_props[i] += n_missing
                 if has_numprops:
-                    pvals = {}
-                    for pkey in self._prop_deltas.keys():
-                        try:
-                            pvals[pkey] = float(rec[pkey])
-                        except KeyError:
-                            #print("@@ missing {} on {}".format(pkey, rec))
-                            missing_props += 1
-                            continue
-                        except (TypeError, ValueError):
-                            raise ValueError("Not a number: collection={c} key={k} {p}='{v}'"
-                                             .format(k=key, c=("old", "new")[i], p=pkey, v=rec[pkey]))
                     numprops[i][key] = pvals
-                # Extract properties for exact match.
-                if has_eqprops:
-                    try:
-                        propval = tuple([(p, str(rec[p])) for p in self._props])
-                    except KeyError:
-                        missing_props += 1
-                        #print("@@ missing {} on {}".format(pkey, rec))
-                        continue
+                if propval is not None:
                     eqprops[i][key] = propval
-
-                # Extract informational fields.
-                if has_info:
-                    if key not in info:
-                        info[key] = {}
-                    for k in self._info:
-                        info[key][k] = rec[k]
-
-            # Stop if we don't have properties on any record at all
-            if 0 < count == missing_props:
-                _log.critical("Missing one or more properties on all {:d} records"
-                              .format(count))
-                return {}
-            # ..but only issue a warning for partially missing properties.
-            elif missing_props > 0:
-                _log.warning("Missing one or more properties for {:d}/{:d} records"
-                             .format(missing_props, count))
+                if rinfo is not None:
+                    info.setdefault(key, {}).update(rinfo)
         t1 = time.time()
         _log.info("query.end sec={:f}".format(t1 - t0))
 
+        return self._compare(keys, eqprops, numprops, info, only_missing, only_values,
+                             columnar), counts, missing_props
+
+    def _numprops_store(self, columnar):
+        """
+        Old and new numeric properties by key: dicts, or _NumColumns if columnar.
+        """
+        if columnar and self._prop_deltas:
+            return [_NumColumns(self._prop_deltas), _NumColumns(self._prop_deltas)]
+        return [{}, {}]
+
+    def _compare(self, keys, eqprops, numprops, info, only_missing, only_values, columnar):
+        """
+        Compare the keys and the properties of the records read by _diff_memory.
+
+        Returns:
+            dict: the result, see diff
+        """
+        has_props = bool(self._all_props)
+        has_numprops, has_eqprops = bool(self._prop_deltas), bool(self._props)
+
         # Compute missing and new keys.
         if only_values:
             missing, new = [], []
@@ -188,7 +277,8 @@ class Differ(object):
         # Compute mis-matched properties.
         if has_props:
             changed = self._changed_props(keys, eqprops, numprops, info,
-                                          has_eqprops=has_eqprops, has_numprops=has_numprops)
+                                          has_eqprops=has_eqprops, has_numprops=has_numprops,
+                                          columnar=columnar)
         else:
             changed = []
 
@@ -196,47 +286,692 @@ class Differ(object):
         _log.debug("build_result.begin")
         result = {}
         if not only_values:
-            result[self.MISSING] = []
-            for key in missing:
-                rec = {self._key_field: key}
-                if has_info:
-                    rec.update(info.get(key, {}))
-                result[self.MISSING].append(rec)
+            result[self.MISSING] = [self._key_record(key, info.get(key)) for key in missing]
             if not only_missing:
-                result[self.NEW] = []
-                for key in new:
-                    rec = {self._key_field: key}
-                    if has_info:
-                        rec.update(info.get(key, {}))
-                    result[self.NEW].append(rec)
+                result[self.NEW] = [self._key_record(key, info.get(key)) for key in new]
         result[self.CHANGED] = changed
         _log.debug("build_result.end")
 
         return result
 
+    def _diff_incremental(self, collections, fltr, state, lu_field, only_missing, only_values,
+                          allow_dup, columnar):
+        """
+        Incremental version of _diff_memory, see diff. The fingerprints of the
+        exact-match changes are resolved here.
+        """
+        fingerprint = self._fingerprint_path(collections)
+        config = self._state_config(fltr, lu_field, fingerprint)
+        saved = self._load_state(state, config)
+        records = []
+        counts, missing_props = [0, 0], [0, 0]
+        t0 = time.time()
+        for i, coll in enumerate(collections):
+            watermark, recs = saved[i] if saved else (None, {})
+            if watermark is None:
+                recs = {}
+            # Take the new watermark first, so that records updated during the run
+            # are read again by the next one.
+            new_watermark = self._last_updated(coll, fltr, lu_field)
+            criteria = fltr
+            if watermark is not None:
+                updated = {lu_field: {"$gt": watermark}}
+                criteria = {"$and": [fltr, updated]} if fltr else updated
+            _log.info("incremental.start collection={:d} watermark={}".format(i, watermark))
+            try:
+                n_updated = self._read_state(coll, criteria, i, recs, allow_dup or watermark is not None,
+                                             fingerprint)
+                if watermark is not None:
+                    # Drop deleted records, read those without (recent) lu_field.
+                    keys = self._scan_keys(coll, fltr, i, allow_dup)
+                    for key in set(recs) - keys:
+                        del recs[key]
+                    for criteria in self._key_batches(fltr, list(keys - set(recs))):
+                        n_updated += self._read_state(coll, criteria, i, recs, True, fingerprint)
+            except KeyError as err:
+                if err.args and err.args[0] == self._key_field:
+                    _log.critical("Key '{}' not found in a record. Abort.".format(self._key_field))
+                    return None, counts, missing_props
+                raise
+            _log.info("incremental.end collection={:d} updated={:d} total={:d}"
+                      .format(i, n_updated, len(recs)))
+            counts[i] = len(recs)
+            missing_props[i] = sum(rec[3] for rec in recs.values())
+            records.append((new_watermark, recs))
+        _log.info("query.end sec={:f}".format(time.time() - t0))
+        self._save_state(state, config, records)
+
+        keys, eqprops, numprops, info = [], [{}, {}], self._numprops_store(columnar), {}
+        for i, (_, recs) in enumerate(records):
+            keys.append(set(recs))
+            for key, (pvals, propval, rinfo, _) in recs.items():
+                numprops[i][key] = pvals
+                if propval is not None:
+                    eqprops[i][key] = propval
+                if rinfo is not None:
+                    info.setdefault(key, {}).update(rinfo)
+        result = self._compare(keys, eqprops, numprops, info, only_missing, only_values, columnar)
+        if self._props:
+            result[self.CHANGED] = self._resolve_fingerprints(collections, fltr, result[self.CHANGED])
+        return result, counts, missing_props
+
+    def _read_state(self, coll, criteria, i, recs, allow_dup, fingerprint):
+        """
+        Read the records matching criteria into the state of a collection.
+
+        Args:
+            coll: Collection
+            criteria(dict): Filter for records
+            i(int): Index of the collection
+            recs(dict): {key: (numeric properties, fingerprint, info, number of
+                missing properties)}, updated
+            allow_dup(bool): Allow keys already in recs, otherwise fail with ValueError
+            fingerprint(str): Where the digests are computed, see _fingerprint_path
+
+        Returns:
+            int: number of records read
+
+        Raises:
+            KeyError: if a record has no key
+        """
+        n = 0
+        for rec in self._find(coll, criteria, fingerprint):
+            key, pvals, propval, rinfo, n_missing = self._extract(rec, i, fingerprint)
+            if not allow_dup and key in recs:
+                raise ValueError("Duplicate key: {}".format(key))
+            recs[key] = (pvals, propval, rinfo, n_missing)
+            n += 1
+        return n
+
+    def _scan_keys(self, coll, fltr, i, allow_dup):
+        """
+        Key-only scan of the records of a collection.
+
+        Returns:
+            set: the keys
+        """
+        keys, n = set(), 0
+        for rec in coll.find(filter=fltr, projection={self._key_field: True, '_id': False}):
+            keys.add(rec[self._key_field])
+            n += 1
+        if not allow_dup and n != len(keys):
+            raise ValueError("Duplicate keys in collection {:d}".format(i))
+        return keys
+
+    def _last_updated(self, coll, fltr, lu_field):
+        """
+        The latest lu_field value of the records of a collection, or None.
+        """
+        cursor = coll.find(filter=fltr, projection={lu_field: True, '_id': False})
+        doc = next(iter(cursor.sort(lu_field, DESCENDING).limit(1)), None)
+        try:
+            return get_mongolike(doc, lu_field) if doc else None
+        except KeyError:
+            return None
+
+    def _state_config(self, fltr, lu_field, fingerprint):
+        """
+        Settings of the Differ that a saved state depends on, including where the
+        digests of the exact-match properties are computed.
+        """
+        return {"key": self._key_field, "props": self._props, "info": self._info,
+                "deltas": sorted(self._prop_deltas), "filter": fltr, "lu_field": lu_field,
+                "fingerprint": fingerprint}
+
+    @staticmethod
+    def _load_state(path, config):
+        """
+        Load the state saved by _save_state.
+
+        Returns:
+            list: (watermark, records) of each collection, or None if there is no
+                state for these settings
+        """
+        try:
+            with open(path, "rb") as f:
+                saved = pickle.load(f)
+        except FileNotFoundError:
+            _log.info("state.none path={}".format(path))
+            return None
+        if saved["config"] != config:
+            _log.warning("Diff state {} was saved with other settings, ignoring it".format(path))
+            return None
+        return saved["collections"]
+
+    @staticmethod
+    def _save_state(path, config, records):
+        """
+        Save the watermark and the records of each collection, replacing the file
+        atomically.
+        """
+        tmp = "{}.{:d}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump({"config": config, "collections": records}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def _fields(self, props=None):
+        """
+        Projection of the queries.
+        """
+        props = self._all_props if props is None else props
+        fields = dict.fromkeys(self._info + props + [self._key_field], True)
+        if not '_id' in fields:  # explicitly remove _id if not given
+            fields['_id'] = False
+        return fields
+
+    def _fingerprint_path(self, collections):
+        """
+        Where the digests of the exact-match properties are computed: "server" if
+        both collections evaluate the aggregation of _fingerprint_fields, otherwise
+        "client".
+        """
+        if not self._props:
+            return "client"
+        for coll in collections:
+            if not supports_aggregation(coll):
+                _log.info("fingerprint.client reason=no aggregation")
+                return "client"
+            try:
+                list(coll.aggregate([{"$limit": 1}, {"$project": self._fingerprint_fields()}]))
+            except (NotImplementedError, OperationFailure) as err:
+                _log.info("fingerprint.client reason={}".format(err))
+                return "client"
+        _log.info("fingerprint.server")
+        return "server"
+
+    def _fingerprint_fields(self):
+        """
+        Projection of the server-side fingerprint: the FINGERPRINT field is the
+        $toHashedIndexKey of the exact-match properties of the types in
+        HASHED_TYPES, or null if a property is missing, and the properties of the
+        other types are returned as they are.
+        """
+        fields = self._fields(list(self._prop_deltas))
+        hashed = []
+        for p in self._props:
+            is_hashed = {"$in": [{"$type": "$" + p}, self.HASHED_TYPES]}
+            hashed.append({"$cond": [is_hashed, "$" + p, None]})
+            if p not in fields:
+                fields[p] = {"$cond": [is_hashed, "$$REMOVE", "$" + p]}
+        types = [{"$type": "$" + p} for p in self._props]
+        fields[self.FINGERPRINT] = {"$cond": [{"$in": ["missing", types]}, None,
+                                              {"$toHashedIndexKey": hashed}]}
+        return fields
+
+    def _find(self, coll, fltr, fingerprint=False, sort=False):
+        """
+        Query the records of a collection.
+
+        Args:
+            coll: Collection
+            fltr(dict): Filter for records
+            fingerprint(str): "server" to aggregate with the projection of
+                _fingerprint_fields, see _fingerprint_path
+            sort(bool): Sort the records by key
+
+        Returns:
+            iterable: the records
+        """
+        if fingerprint == "server":
+            pipeline = [{"$match": fltr}, {"$project": self._fingerprint_fields()}]
+            if sort:
+                pipeline.append({"$sort": {self._key_field: ASCENDING}})
+            return coll.aggregate(pipeline, allowDiskUse=True)
+        cursor = coll.find(filter=fltr, projection=self._fields())
+        return cursor.sort(self._key_field, ASCENDING) if sort else cursor
+
+    def _extract(self, rec, i, fingerprint=False):
+        """
+        Extract the key, the properties and the informational fields of a record.
+
+        Args:
+            rec(dict): Record
+            i(int): Index of the collection of the record, 0 (old) or 1 (new)
+            fingerprint(str): Return the MD5 of the exact-match properties instead
+                of their values: of the FINGERPRINT field of the record and its
+                properties of the other types if "server", otherwise of all the
+                properties.
+
+        Returns:
+            tuple: (key, numeric properties, exact-match properties, info, number of
+                missing properties). The exact-match properties and the info are None
+                if an exact-match property is missing.
+
+        Raises:
+            KeyError: if the record has no key or informational field
+        """
+        key = rec[self._key_field]
+        missing_props = 0
+        # Extract numeric properties.
+        pvals = {}
+        for pkey in self._prop_deltas.keys():
+            try:
+                pvals[pkey] = float(rec[pkey])
+            except KeyError:
+                missing_props += 1
+                continue
+            except (TypeError, ValueError):
+                raise ValueError("Not a number: collection={c} key={k} {p}='{v}'"
+                                 .format(k=key, c=("old", "new")[i], p=pkey, v=rec[pkey]))
+        # Extract properties for exact match.
+        propval = None
+        if fingerprint == "server" and self._props:
+            if rec[self.FINGERPRINT] is None:  # a property is missing
+                return key, pvals, None, None, missing_props + 1
+            propval = (rec[self.FINGERPRINT],) + tuple([(p, str(rec[p])) for p in self._props
+                                                        if p in rec])
+            propval = hashlib.md5(repr(propval).encode()).digest()
+        elif self._props:
+            try:
+                propval = tuple([(p, str(rec[p])) for p in self._props])
+            except KeyError:
+                return key, pvals, None, None, missing_props + 1
+            if fingerprint:
+                propval = hashlib.md5(repr(propval).encode()).digest()
+        # Extract informational fields.
+        rinfo = {k: rec[k] for k in self._info} if self._info else None
+        return key, pvals, propval, rinfo, missing_props
+
+    def _check_missing_props(self, count, missing_props):
+        """
+        Log the records of a collection missing properties.
+
+        Returns:
+            bool: False if all records miss properties
+        """
+        # Stop if we don't have properties on any record at all
+        if 0 < count == missing_props:
+            _log.critical("Missing one or more properties on all {:d} records"
+                          .format(count))
+            return False
+        # ..but only issue a warning for partially missing properties.
+        elif missing_props > 0:
+            _log.warning("Missing one or more properties for {:d}/{:d} records"
+                         .format(missing_props, count))
+        return True
+
+    def _key_record(self, key, info):
+        rec = {self._key_field: key}
+        if info:
+            rec.update(info)
+        return rec
+
     def _changed_props(self, keys=None, eqprops=None, numprops=None, info=None,
-                       has_numprops=False, has_eqprops=False):
+                       has_numprops=False, has_eqprops=False, columnar=False):
+        if columnar and has_numprops:
+            return self._changed_props_columnar(list(keys[0].intersection(keys[1])), eqprops,
+                                                numprops, info, has_eqprops)
         changed = []
-        _up = lambda d, v: d.update(v) or d   # functional dict.update()
         for key in keys[0].intersection(keys[1]):
-            # Numeric property comparisons.
-            if has_numprops:
-                for pkey in self._prop_deltas:
-                    oldval, newval = numprops[0][key][pkey], numprops[1][key][pkey]
-                    if self._prop_deltas[pkey].cmp(oldval, newval):
-                        change = {self.CHANGED_MATCH_KEY: self.CHANGED_MATCH_DELTA, self._key_field: key, "property": pkey,
-                                  self.CHANGED_OLD: "{:f}".format(oldval), self.CHANGED_NEW: "{:f}".format(newval),
-                                  "rule": self._prop_deltas[pkey],
-                                  self.CHANGED_DELTA: "{:f}".format(newval - oldval)}
-                        changed.append(_up(change, info[key]) if info else change)
-            # Exact property comparison.
-            if has_eqprops:
-                if not eqprops[0][key] == eqprops[1][key]:
-                    change = {self.CHANGED_MATCH_KEY: self.CHANGED_MATCH_EXACT, self._key_field: key,
-                              self.CHANGED_OLD: eqprops[0][key], self.CHANGED_NEW: eqprops[1][key]}
-                    changed.append(_up(change, info[key]) if info else change)
+            nums = (numprops[0][key], numprops[1][key]) if has_numprops else (None, None)
+            eqs = (eqprops[0][key], eqprops[1][key]) if has_eqprops else (None, None)
+            changed.extend(self._changed_key(key, nums, eqs, info.get(key)))
+        return changed
+
+    def _changed_props_columnar(self, keys, eqprops, numprops, info, has_eqprops):
+        """
+        Columnar version of _changed_props: evaluate each delta on the arrays of the
+        old and new values of a numeric property, aligned by key.
+
+        Args:
+            keys(list): The keys of both collections
+            eqprops(list): old and new {key: exact-match properties}
+            numprops(list): old and new _NumColumns
+            info(dict): {key: informational fields}
+            has_eqprops(bool): Compare the exact-match properties too
+
+        Returns:
+            list: the changes, in the same order as _changed_props
+        """
+        import numpy as np
+
+        _log.debug("columnar.start keys={:d} props={:d}".format(len(keys), len(self._prop_deltas)))
+        for cols in numprops:
+            missing = cols.incomplete.keys() & keys
+            if missing:  # KeyError as in _changed_key
+                raise KeyError(cols.incomplete[missing.pop()][0])
+        rows = [np.fromiter((cols.rows[key] for key in keys), dtype=np.intp, count=len(keys))
+                for cols in numprops]
+        matches = {}
+        for pkey, delta in self._prop_deltas.items():
+            old = np.frombuffer(numprops[0].values[pkey], dtype=float)[rows[0]]
+            new = np.frombuffer(numprops[1].values[pkey], dtype=float)[rows[1]]
+            matches[pkey] = delta.cmp_array(old, new)
+        matched_rows = set(np.flatnonzero(np.logical_or.reduce(list(matches.values()))).tolist())
+        _log.debug("columnar.end matched={:d}".format(len(matched_rows)))
+
+        changed = []
+        for row, key in enumerate(keys):
+            nums, matched = (None, None), None
+            if row in matched_rows:
+                nums = (numprops[0][key], numprops[1][key])
+                matched = [pkey for pkey in self._prop_deltas if matches[pkey][row]]
+            elif not has_eqprops:
+                continue
+            eqs = (eqprops[0][key], eqprops[1][key]) if has_eqprops else (None, None)
+            changed.extend(self._changed_key(key, nums, eqs, info.get(key), matched))
         return changed
 
+    def _changed_key(self, key, numprops, eqprops, info, matched=None):
+        """
+        Compare the properties of the old and new records of a key.
+
+        Args:
+            key: Key of the records
+            numprops(tuple): old and new numeric properties, or Nones
+            eqprops(tuple): old and new exact-match properties, or Nones
+            info(dict): Informational fields of the key, or None
+            matched(list): numeric properties already known to match their delta,
+                or None to compare them all
+
+        Returns:
+            list: the changes
+        """
+        changed = []
+        _up = lambda d, v: d.update(v) or d   # functional dict.update()
+        # Numeric property comparisons.
+        if numprops[0] is not None:
+            for pkey in self._prop_deltas if matched is None else matched:
+                oldval, newval = numprops[0][pkey], numprops[1][pkey]
+                if matched is not None or self._prop_deltas[pkey].cmp(oldval, newval):
+                    change = {self.CHANGED_MATCH_KEY: self.CHANGED_MATCH_DELTA, self._key_field: key, "property": pkey,
+                              self.CHANGED_OLD: "{:f}".format(oldval), self.CHANGED_NEW: "{:f}".format(newval),
+                              "rule": self._prop_deltas[pkey],
+                              self.CHANGED_DELTA: "{:f}".format(newval - oldval)}
+                    changed.append(_up(change, info) if info else change)
+        # Exact property comparison.
+        if eqprops[0] is not None:
+            if not eqprops[0] == eqprops[1]:
+                change = {self.CHANGED_MATCH_KEY: self.CHANGED_MATCH_EXACT, self._key_field: key,
+                          self.CHANGED_OLD: eqprops[0], self.CHANGED_NEW: eqprops[1]}
+                changed.append(_up(change, info) if info else change)
+        return changed
+
+    def _diff_stream(self, collections, fltr, only_missing, only_values, allow_dup, spill, tmpdir,
+                     fingerprint):
+        """
+        Streaming version of _diff: merge-join the records of both collections,
+        sorted by key.
+        """
+        has_props = bool(self._all_props)
+        counts, missing_props = [0, 0], [0, 0]
+        result = {self.CHANGED: []}
+        if not only_values:
+            result[self.MISSING] = []
+            if not only_missing:
+                result[self.NEW] = []
+
+        def records(i, cursor):
+            for rec in cursor:
+                counts[i] += 1
+                extracted = self._extract(rec, i, fingerprint)
+                missing_props[i] += extracted[4]
+                yield (sort_key(extracted[0]),) + extracted[:4]
+
+        _log.info("query.start query={} fingerprint={} spill={}".format(fltr, fingerprint, spill))
+        t0 = time.time()
+        with ExitStack() as stack:
+            streams = []
+            for i, coll in enumerate(collections):
+                cursor = self._find(coll, fltr, fingerprint, sort=not spill)
+                if spill:
+                    recs = self._external_sort(records(i, cursor), spill, tmpdir, stack)
+                else:
+                    recs = records(i, cursor)
+                streams.append(self._unique_keys(recs, i, allow_dup))
+
+            try:
+                old, new = next(streams[0], None), next(streams[1], None)
+                while old is not None or new is not None:
+                    if new is None or (old is not None and old[0] < new[0]):
+                        if not only_values:
+                            result[self.MISSING].append(self._key_record(old[1], old[4]))
+                        old = next(streams[0], None)
+                    elif old is None or new[0] < old[0]:
+                        if not (only_values or only_missing):
+                            result[self.NEW].append(self._key_record(new[1], new[4]))
+                        new = next(streams[1], None)
+                    else:
+                        if has_props:
+                            result[self.CHANGED].extend(self._joined_changes(old, new))
+                        old, new = next(streams[0], None), next(streams[1], None)
+            except KeyError as err:
+                if err.args and err.args[0] == self._key_field:
+                    _log.critical("Key '{}' not found in a record. Abort.".format(self._key_field))
+                    return None, counts, missing_props
+                raise
+        _log.info("query.end sec={:f}".format(time.time() - t0))
+        return result, counts, missing_props
+
+    def _diff_parallel(self, collections, configs, num_workers, partitions, options):
+        """
+        Parallel version of _diff: diff ranges of keys on a process pool and
+        concatenate their results.
+
+        Args:
+            collections(list): The collections
+            configs(tuple): The collections or their config files, opened by the workers
+            num_workers(int): Number of processes
+            partitions(int): Number of key ranges
+            options(dict): Keyword arguments of _diff
+
+        Returns:
+            tuple: see _diff
+        """
+        filters = self._partition_filters(collections[0], partitions)
+        _log.info("partitions.start n={:d} workers={:d}".format(len(filters), num_workers))
+        result, counts, missing_props = None, [0, 0], [0, 0]
+        pool = multiprocessing.Pool(min(num_workers, len(filters)), initializer=_init_partition_worker,
+                                    initargs=(self, configs, options))
+        try:
+            for part_result, part_counts, part_missing in pool.imap(_diff_partition, filters):
+                if part_result is None:
+                    return None, counts, missing_props
+                for change in part_result[self.CHANGED]:
+                    if change[self.CHANGED_MATCH_KEY] == self.CHANGED_MATCH_DELTA:
+                        change["rule"] = self._prop_deltas[change["property"]]  # not a copy
+                if result is None:
+                    result = part_result
+                else:
+                    for k, recs in part_result.items():
+                        result[k].extend(recs)
+                counts = [a + b for a, b in zip(counts, part_counts)]
+                missing_props = [a + b for a, b in zip(missing_props, part_missing)]
+        finally:
+            pool.terminate()
+            pool.join()
+        _log.info("partitions.end")
+        return result, counts, missing_props
+
+    def _partition_filters(self, coll, n):
+        """
+        Split the records matching the filter into at most n ranges of keys with
+        about the same number of records of a collection, see
+        helpers.key_range_filters.
+
+        Returns:
+            list: a filter selecting the records of each range
+        """
+        return key_range_filters(coll, self._key_field, n, self._filter)
+
+    def _resolve_fingerprints(self, collections, fltr, changed, batch_size=1000):
+        """
+        Replace the digests of the exact-match changes by the properties, fetched for
+        these keys only, and drop the changes whose properties are the same.
+
+        Args:
+            collections(list): The collections
+            fltr(dict): Filter for records
+            changed(list): Changes, see _changed_key
+            batch_size(int): Number of keys per query
+
+        Returns:
+            list: the changes
+        """
+        keys = [c[self._key_field] for c in changed
+                if c[self.CHANGED_MATCH_KEY] == self.CHANGED_MATCH_EXACT]
+        if not keys:
+            return changed
+        _log.info("fingerprint.resolve keys={:d}".format(len(keys)))
+        fields = self._fields(self._props)
+        propvals = [{}, {}]
+        for i, coll in enumerate(collections):
+            for criteria in self._key_batches(fltr, keys, batch_size):
+                for rec in coll.find(criteria, fields):
+                    try:
+                        propval = tuple([(p, str(rec[p])) for p in self._props])
+                    except KeyError:
+                        continue
+                    propvals[i][rec[self._key_field]] = propval
+        resolved = []
+        for change in changed:
+            if change[self.CHANGED_MATCH_KEY] == self.CHANGED_MATCH_EXACT:
+                # KeyError if a property is missing, as without fingerprints
+                key = change[self._key_field]
+                old, new = propvals[0][key], propvals[1][key]
+                if old == new:
+                    continue
+                change[self.CHANGED_OLD], change[self.CHANGED_NEW] = old, new
+            resolved.append(change)
+        return resolved
+
+    def _key_batches(self, fltr, keys, batch_size=1000):
+        """
+        Filters for the records with the given keys, batch_size keys at a time.
+
+        Yields:
+            dict: the filters
+        """
+        for start in range(0, len(keys), batch_size):
+            criteria = {self._key_field: {"$in": keys[start:start + batch_size]}}
+            yield {"$and": [fltr, criteria]} if fltr else criteria
+
+    def _joined_changes(self, old, new):
+        """
+        Changes between the old and new records of a key, see _unique_keys.
+        """
+        key = old[1]
+        info = None
+        if self._info:
+            info = dict(old[4] or {})
+            info.update(new[4] or {})
+        nums = (old[2], new[2]) if self._prop_deltas else (None, None)
+        eqs = (None, None)
+        if self._props:
+            if old[3] is None or new[3] is None:
+                raise KeyError(key)
+            eqs = (old[3], new[3])
+        return self._changed_key(key, nums, eqs, info)
+
+    def _unique_keys(self, records, i, allow_dup):
+        """
+        Check the order of sorted records and merge the records with the same key,
+        the last one winning as in the in-memory diff.
+
+        Args:
+            records: iterable of (sort key, key, numprops, eqprops, info) tuples
+            i(int): Index of the collection
+            allow_dup(bool): Merge duplicate keys, otherwise fail with ValueError
+
+        Yields:
+            tuple: (sort key, key, numprops, eqprops, info), one per key
+        """
+        current = None
+        for rec in records:
+            if current is not None:
+                if rec[0] == current[0]:
+                    if not allow_dup:
+                        raise ValueError("Duplicate key: {}".format(rec[1]))
+                    eqprops = rec[3] if rec[3] is not None else current[3]
+                    info = current[4]
+                    if rec[4] is not None:
+                        info = dict(info or {})
+                        info.update(rec[4])
+                    current = rec[:3] + (eqprops, info)
+                    continue
+                if rec[0] < current[0]:
+                    raise ValueError("Collection {:d} is not sorted by '{}' at key {}"
+                                     .format(i, self._key_field, rec[1]))
+                yield current
+            current = rec
+        if current is not None:
+            yield current
+
+    @staticmethod
+    def _external_sort(records, run_size, tmpdir, stack):
+        """
+        Sort records on their first item, in sorted runs of run_size records
+        spilled to temporary files (closed by stack) and merged.
+
+        Returns:
+            iterator: the sorted records
+        """
+        first = itemgetter(0)
+        runs = []
+        while True:
+            run = sorted(islice(records, run_size), key=first)
+            if len(run) < run_size and not runs:
+                return iter(run)
+            if run:
+                f = stack.enter_context(tempfile.TemporaryFile(dir=tmpdir))
+                for rec in run:
+                    pickle.dump(rec, f, pickle.HIGHEST_PROTOCOL)
+                runs.append((f, len(run)))
+            if len(run) < run_size:
+                break
+
+        def read(f, n):
+            f.seek(0)
+            for _ in range(n):
+                yield pickle.load(f)
+
+        return heapq.merge(*[read(f, n) for f, n in runs], key=first)
+
+
+#: differ, collections and _diff options of a partition worker process
+_partition_state = None
+
+
+def _init_partition_worker(differ, configs, options):
+    global _partition_state
+    _partition_state = differ, differ._connect(*configs), options
+
+
+def _diff_partition(fltr):
+    differ, collections, options = _partition_state
+    return differ._diff(collections, fltr, **options)
+
+
+class _NumColumns(object):
+    """
+    Numeric properties of the records of a collection, one array of values per
+    property, filled as the records are read. The columnar diff aligns them by key
+    with index arrays.
+    """
+
+    def __init__(self, props):
+        self.rows = {}  # {key: row}
+        self.values = {pkey: array('d') for pkey in props}
+        self.incomplete = {}  # {key: missing properties}, whose values are NaN
+
+    def __setitem__(self, key, pvals):
+        row = self.rows.get(key)
+        if row is None:
+            self.rows[key] = len(self.rows)
+            for pkey, col in self.values.items():
+                col.append(pvals.get(pkey, float("nan")))
+        else:  # duplicate key, the last record wins
+            for pkey, col in self.values.items():
+                col[row] = pvals.get(pkey, float("nan"))
+        if len(pvals) < len(self.values):
+            self.incomplete[key] = [pkey for pkey in self.values if pkey not in pvals]
+        else:
+            self.incomplete.pop(key, None)
+
+    def __getitem__(self, key):
+        row, missing = self.rows[key], self.incomplete.get(key, ())
+        return {pkey: col[row] for pkey, col in self.values.items() if pkey not in missing}
+
 
 class Delta(object):
     """
@@ -358,6 +1093,29 @@ class Delta(object):
         """
         return self._cmp(old, new)
 
+    def cmp_array(self, old, new):
+        """
+        Compare arrays of numeric values with delta expression, element-wise.
+        Same results as :meth:`cmp` on each pair of values.
+
+        Args:
+            old(numpy.ndarray): Old values
+            new(numpy.ndarray): New values
+
+        Returns:
+            numpy.ndarray: boolean array, True where the delta is large enough
+        """
+        import numpy as np
+
+        if self._sign:
+            if self._eq:
+                return ((old < 0) & (0 <= new)) | ((old > 0) & (0 >= new))
+            return ((old < 0) & (0 < new)) | ((old > 0) & (0 > new))
+        if self._pct:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return (old != 0) & self._cmp_val(100.0 * (new - old) / old)
+        return self._cmp_val(new - old)
+
     def _cmp_sign(self, a, b):
         if self._eq:
             return (a < 0 <= b) or (a > 0 >= b)
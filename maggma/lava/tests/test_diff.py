@@ -5,11 +5,17 @@ Test lava.diff module
 import os
 import logging
 import random
+import shutil
+import tempfile
 import unittest
 import json
+from unittest import mock
+
+import mongomock
 
 from maggma.lava.diff import Differ, Delta
 from maggma.helpers import get_database
+from maggma.memdb import MemoryDatabase
 
 __author__ = 'Dan Gunter <dkgunter@lbl.gov>'
 
@@ -235,6 +241,16 @@ class MyTestCase(unittest.TestCase):
         self.assertEquals(d.cmp(6, 8), False)
         self.assertEquals(d.cmp(6, 9), True)
 
+    def test_delta_array(self):
+        import numpy as np
+        values = [-2.5, -1.0, -0.0, 0.0, 0.5, 1.0, 3.0, float('nan'), float('inf')]
+        old = np.array([a for a in values for b in values])
+        new = np.array([b for a in values for b in values])
+        for expr in ("+-", "+-=", "+-1", "+1-2=", "+0.5", "-1=", "+-50%", "+10-20=%"):
+            d = Delta(expr)
+            self.assertEqual(d.cmp_array(old, new).tolist(),
+                             [d.cmp(a, b) for a, b in zip(old.tolist(), new.tolist())], expr)
+
     def test_delta_plus(self):
         """Delta class value 'plus only'.
         """
@@ -261,5 +277,180 @@ class MyTestCase(unittest.TestCase):
         self.assertEquals(d.cmp(25, 10), True)
         self.assertEquals(d.cmp(10, 25), False)
 
+
+class DiffModesTestCase(unittest.TestCase):
+    NUM_RECORDS = 50
+
+    def setUp(self):
+        random.seed(0)
+        self.tmpdir = tempfile.mkdtemp()
+        db = self.make_database()
+        self.collections = [db["diff1"], db["diff2"]]
+        for ei, coll in enumerate(self.collections):
+            for i in range(self.NUM_RECORDS):
+                if i % 10 != (3, 7)[ei]:  # some missing and new keys
+                    coll.insert_one(create_record(i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def make_database():
+        return mongomock.MongoClient().db
+
+    def diff(self, differ, **kwargs):
+        d = differ.diff(*self.collections, **kwargs)
+        for recs in d.values():
+            recs.sort(key=lambda r: (r['name'], r.get('property', '')))
+        return d
+
+    def test_same_as_in_memory(self):
+        df = Differ(key='name', props=['color', 'same'], info=['zero'],
+                    deltas={"energy": Delta("+-0.5")})
+        expected = self.diff(df)
+        self.assertTrue(all(expected[k] for k in (Differ.MISSING, Differ.NEW, Differ.CHANGED)))
+        self.assertEqual(self.diff(df, stream=True), expected)
+        for spill in (1, 7, 1000):
+            self.assertEqual(self.diff(df, stream=True, spill=spill), expected)
+        expected = self.diff(df, only_missing=True)
+        self.assertEqual(self.diff(df, stream=True, spill=7, only_missing=True), expected)
+        expected = self.diff(df, only_values=True)
+        self.assertEqual(self.diff(df, stream=True, only_values=True), expected)
+
+    def test_parallel(self):
+        df = Differ(key='name', props=['color'], info=['zero'], deltas={"energy": Delta("+-0.5")},
+                    fltr={'zero': 0})
+        expected = self.diff(df)
+        self.assertEqual(df._partition_filters(self.collections[0], 100)[0],
+                         {'$and': [{'zero': 0}, {'name': {'$lt': 'item-1'}}]})
+        self.assertEqual(self.diff(df, num_workers=2), expected)
+        self.assertEqual(self.diff(df, num_workers=2, partitions=3, stream=True), expected)
+        self.collections[1].insert_one(create_record(1))
+        self.assertRaises(ValueError, df.diff, *self.collections, num_workers=2)
+        # pymongo collections are not inherited by the workers
+        mongo = get_database({"database": "maggma_unittests"})["diff"]
+        self.assertRaises(ValueError, df.diff, mongo, self.collections[1], num_workers=2)
+        mongo.database.client.close()
+
+    def test_fingerprint(self):
+        df = Differ(key='name', props=['color', 'same'], info=['zero'],
+                    deltas={"energy": Delta("+-0.5")})
+        expected = self.diff(df)
+        self.assertEqual(self.diff(df, fingerprint=True), expected)
+        self.assertEqual(self.diff(df, fingerprint=True, stream=True, spill=7), expected)
+        self.assertEqual(self.diff(df, fingerprint=True, num_workers=2), expected)
+        # floats differing only after the decimal point
+        for i, coll in enumerate(self.collections):
+            coll.update_many({}, {'$set': {'ratio': 2.3 + 0.6 * i}})
+        df = Differ(key='name', props=['ratio'])
+        expected = self.diff(df)
+        self.assertEqual(len(expected[Differ.CHANGED]), 40)
+        self.assertEqual(self.diff(df, fingerprint=True), expected)
+        self.assertEqual(self.diff(df, fingerprint=True, stream=True), expected)
+
+    def test_fingerprint_server(self):
+        df = Differ(key='name', props=['color', 'ratio'])
+        # neither mongomock nor memdb evaluate the aggregation
+        self.assertEqual(df._fingerprint_path(self.collections), "client")
+        self.assertEqual(df._fingerprint_path([MemoryDatabase()["diff"]] * 2), "client")
+        fields = df._fingerprint_fields()
+        self.assertEqual(fields['ratio']['$cond'][1:], ["$$REMOVE", "$ratio"])
+        self.assertIn("$toHashedIndexKey", fields[Differ.FINGERPRINT]['$cond'][2])
+        # records as returned by the server: the floats are not hashed
+        old = {'name': 'a', Differ.FINGERPRINT: 42, 'ratio': 2.3}
+        new = dict(old, ratio=2.9)
+        digest = df._extract(old, 0, "server")[2]
+        self.assertEqual(df._extract(dict(old), 1, "server")[2], digest)
+        self.assertNotEqual(df._extract(new, 1, "server")[2], digest)
+        self.assertNotEqual(df._extract(dict(old, **{Differ.FINGERPRINT: 43}), 1, "server")[2], digest)
+        missing = {'name': 'a', Differ.FINGERPRINT: None}
+        self.assertEqual(df._extract(missing, 0, "server")[2:], (None, None, 1))
+
+    def test_columnar(self):
+        deltas = {"energy": Delta("+-0.5"), "zero": Delta("+-"), "energy_pct": Delta("+10-20=%")}
+        for coll in self.collections:
+            for rec in coll.find():
+                coll.update_one({'_id': rec['_id']},
+                                {'$set': {'energy_pct': rec['energy'] * random.choice((0, 1))}})
+        df = Differ(key='name', props=['color'], info=['zero'], deltas=deltas)
+        expected = self.diff(df)
+        self.assertEqual(self.diff(df, columnar=True), expected)
+        df = Differ(key='name', deltas=deltas)
+        self.assertEqual(self.diff(df, columnar=True, num_workers=2), self.diff(df))
+        # the last duplicate wins, a missing property fails as key by key
+        rec = create_record(1)
+        rec.update(energy=99, energy_pct=1)
+        self.collections[1].insert_one(rec)
+        self.assertEqual(self.diff(df, columnar=True, allow_dup=True), self.diff(df, allow_dup=True))
+        self.collections[0].update_one({'name': recname(2)}, {'$unset': {'energy': True}})
+        self.assertRaises(KeyError, df.diff, *self.collections, allow_dup=True)
+        self.assertRaises(KeyError, df.diff, *self.collections, allow_dup=True, columnar=True)
+
+    def test_incremental(self):
+        state = os.path.join(self.tmpdir, "state.pickle")
+        df = Differ(key='name', props=['color'], info=['zero'], deltas={"energy": Delta("+-0.5")})
+        for coll in self.collections:
+            coll.update_many({}, {'$set': {'_lu': 1}})
+        self.assertEqual(self.diff(df, state=state), self.diff(df))
+        # update, delete and insert records, one without lu_field
+        self.collections[0].update_one({'name': recname(1)}, {'$set': {'color': 'black', '_lu': 2}})
+        self.collections[1].update_one({'name': recname(2)}, {'$set': {'energy': 99, '_lu': 2}})
+        self.collections[1].delete_one({'name': recname(4)})
+        self.collections[1].insert_one(create_record(7))
+        expected = self.diff(df)
+        self.assertEqual(self.diff(df, state=state), expected)
+        self.assertEqual(self.diff(df, state=state, columnar=True), expected)
+        self.assertEqual(Differ._load_state(state, df._state_config({}, "_lu", "client"))[1][0], 2)
+        # float property changing only after the decimal point between two runs
+        df = Differ(key='name', props=['ratio'])
+        for coll in self.collections:
+            coll.update_many({}, {'$set': {'ratio': 2.3, '_lu': 3}})
+        self.assertEqual(self.diff(df, state=state)[Differ.CHANGED], [])
+        self.collections[1].update_one({'name': recname(1)}, {'$set': {'ratio': 2.9, '_lu': 4}})
+        # only the updated record is read
+        with mock.patch.object(Differ, '_extract', autospec=True, side_effect=Differ._extract) as extract:
+            changed = self.diff(df, state=state)[Differ.CHANGED]
+        self.assertEqual(extract.call_count, 1)
+        self.assertEqual([r['name'] for r in changed], [recname(1)])
+        self.assertEqual(changed, self.diff(df)[Differ.CHANGED])
+        # other settings ignore the state
+        df = Differ(key='name', props=['color', 'same'])
+        self.assertEqual(self.diff(df, state=state), self.diff(df))
+        self.assertRaises(ValueError, df.diff, *self.collections, state=state, stream=True)
+
+    def test_duplicates(self):
+        rec = create_record(1)
+        rec['color'] = 'black'
+        self.collections[1].insert_one(rec)
+        df = Differ(key='name', props=['color'])
+        self.assertRaises(ValueError, df.diff, *self.collections, stream=True)
+        self.assertRaises(ValueError, df.diff, *self.collections, stream=True, spill=7)
+        expected = self.diff(df, allow_dup=True)
+        self.assertIn('black', [dict(r[Differ.CHANGED_NEW])['color'] for r in expected[Differ.CHANGED]])
+        self.assertEqual(self.diff(df, allow_dup=True, stream=True, spill=7), expected)
+
+    def test_missing_key(self):
+        self.collections[0].insert_one({'color': 'red'})
+        self.assertEqual(Differ(key='name').diff(*self.collections, stream=True), {})
+        self.assertEqual(Differ(key='name').diff(*self.collections), {})
+
+    def test_missing_info(self):
+        self.collections[0].insert_one({'name': 'item-100', 'color': 'red'})
+        df = Differ(key='name', props=['color'], info=['zero'])
+        state = os.path.join(self.tmpdir, "state.pickle")
+        for kwargs in ({}, {'stream': True}, {'state': state}):
+            self.assertRaises(KeyError, df.diff, *self.collections, **kwargs)
+
+
+class NativeDiffModesTestCase(DiffModesTestCase):
+    """
+    Same cases on the collections of maggma.memdb, without MongoDB.
+    """
+
+    @staticmethod
+    def make_database():
+        return MemoryDatabase()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,792 @@
+"""
+A native in-memory collection engine.
+
+MemoryCollection implements the subset of the pymongo Collection interface
+used by stores and builders (find/sort/limit, insert, replace/update, delete,
+bulk_write, indexes), without the per-read deep copies and linear scans of
+mongomock. Single-field indexes serve equality, $in and range queries as well
+as sorts, e.g. the lu_field queries of Store.last_updated and Store.lu_filter.
+
+Supported query operators: $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin,
+$exists, $and, $or and $nor. Supported update operators: $set, $unset, $inc,
+$min and $max.
+
+Documents are stored and returned as shallow copies: modifying a returned
+document does not modify the collection, but modifying a nested object of a
+returned document does.
+"""
+import datetime
+import threading
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import count, islice
+
+import pymongo
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.results import (BulkWriteResult, DeleteResult, InsertManyResult,
+                             InsertOneResult, UpdateResult)
+
+
+# Comparison
+# ----------
+
+def _rank(value):
+    """
+    Rank of the type of a value in the MongoDB sort order. Values of different
+    ranks never match each other in comparison queries.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 7
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, (list, tuple)):
+        return 4
+    if isinstance(value, bytes):
+        return 5
+    if isinstance(value, ObjectId):
+        return 6
+    if isinstance(value, datetime.datetime):
+        return 8
+    return 9
+
+
+def sort_key(value):
+    """
+    Key to sort values of any type in the MongoDB order.
+    """
+    rank = _rank(value)
+    if rank in (0, 3, 4, 9):
+        return rank, str(value)
+    return rank, value
+
+
+def _resolve(doc, parts):
+    """
+    Values at a dot-notation path in a document. Arrays on the path are
+    traversed: "a.b" resolves to the "b" of each document in the array "a",
+    unless the part is an array index.
+
+    Args:
+        doc (dict): the document
+        parts ([str]): the path, split on dots
+
+    Returns:
+        list: the values found, empty if the path does not exist
+    """
+    values = [doc]
+    for part in parts:
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit():
+                    if int(part) < len(value):
+                        found.append(value[int(part)])
+                else:
+                    found.extend(v[part] for v in value if isinstance(v, dict) and part in v)
+        values = found
+    return values
+
+
+def _expand(values):
+    """
+    Values and the elements of the array values, as compared by queries.
+    """
+    expanded = list(values)
+    for value in values:
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _eq(values, target):
+    if target is None and not values:
+        return True
+    rank = _rank(target)
+    return any(_rank(v) == rank and v == target for v in _expand(values))
+
+
+_COMPARATORS = {
+    "$gt": lambda a, b: a > b,
+    "$gte": lambda a, b: a >= b,
+    "$lt": lambda a, b: a < b,
+    "$lte": lambda a, b: a <= b,
+}
+
+
+def _compare(values, op, target):
+    rank, cmp = _rank(target), _COMPARATORS[op]
+    return any(_rank(v) == rank and cmp(sort_key(v), sort_key(target))
+               for v in _expand(values))
+
+
+def _match_op(values, op, arg):
+    if op == "$eq":
+        return _eq(values, arg)
+    if op == "$ne":
+        return not _eq(values, arg)
+    if op in _COMPARATORS:
+        return _compare(values, op, arg)
+    if op == "$in":
+        return any(_eq(values, v) for v in arg)
+    if op == "$nin":
+        return not any(_eq(values, v) for v in arg)
+    if op == "$exists":
+        return bool(values) == bool(arg)
+    raise OperationFailure("unknown operator: {}".format(op))
+
+
+def _is_operator_dict(cond):
+    return isinstance(cond, dict) and bool(cond) and all(k.startswith("$") for k in cond)
+
+
+def match(doc, query):
+    """
+    Whether a document matches a query.
+
+    Args:
+        doc (dict): the document
+        query (dict): MongoDB query, see the module doc for the operators
+
+    Returns:
+        bool
+    """
+    for field, cond in query.items():
+        if field == "$and":
+            if not all(match(doc, q) for q in cond):
+                return False
+        elif field == "$or":
+            if not any(match(doc, q) for q in cond):
+                return False
+        elif field == "$nor":
+            if any(match(doc, q) for q in cond):
+                return False
+        elif field.startswith("$"):
+            raise OperationFailure("unknown top level operator: {}".format(field))
+        else:
+            values = _resolve(doc, field.split("."))
+            if _is_operator_dict(cond):
+                if not all(_match_op(values, op, arg) for op, arg in cond.items()):
+                    return False
+            elif not _eq(values, cond):
+                return False
+    return True
+
+
+# Projection and update
+# ---------------------
+
+def project(doc, projection):
+    """
+    Apply a MongoDB projection (inclusion or exclusion of fields) to a document.
+
+    Args:
+        doc (dict): the document
+        projection (dict or list): fields to include (or exclude, with falsy
+            values). _id is included unless explicitly excluded.
+
+    Returns:
+        dict: a new document
+    """
+    if projection is None:
+        return dict(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = dict.fromkeys(projection, True)
+    include_id = projection.get("_id", True)
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if fields and any(fields.values()):
+        result = {}
+        for field in fields:
+            _copy_path(doc, result, field.split("."))
+        if include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    result = dict(doc)
+    for field in fields:
+        _unset_path(result, field.split("."))
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def _copy_path(src, dst, parts):
+    head, rest = parts[0], parts[1:]
+    if not isinstance(src, dict) or head not in src:
+        return
+    if not rest:
+        dst[head] = src[head]
+    elif isinstance(src[head], dict):
+        _copy_path(src[head], dst.setdefault(head, {}), rest)
+
+
+def _set_path(doc, parts, value):
+    """
+    Set a value at a dot-notation path, copying the subdocuments along the path
+    so that documents shared with readers are not modified.
+    """
+    head, rest = parts[0], parts[1:]
+    if not rest:
+        doc[head] = value
+        return
+    sub = doc.get(head)
+    sub = dict(sub) if isinstance(sub, dict) else {}
+    doc[head] = sub
+    _set_path(sub, rest, value)
+
+
+def _unset_path(doc, parts):
+    head, rest = parts[0], parts[1:]
+    if not rest:
+        doc.pop(head, None)
+    elif isinstance(doc.get(head), dict):
+        doc[head] = dict(doc[head])
+        _unset_path(doc[head], rest)
+
+
+def _get_path(doc, parts):
+    for part in parts:
+        if not isinstance(doc, dict) or part not in doc:
+            return None, False
+        doc = doc[part]
+    return doc, True
+
+
+def apply_update(doc, update):
+    """
+    Apply update operators to a document.
+
+    Args:
+        doc (dict): the document, left unmodified
+        update (dict): {operator: {field: value}}
+
+    Returns:
+        dict: the updated document
+    """
+    doc = dict(doc)
+    for op, fields in update.items():
+        for field, value in fields.items():
+            parts = field.split(".")
+            if op == "$set":
+                _set_path(doc, parts, value)
+            elif op == "$unset":
+                _unset_path(doc, parts)
+            elif op == "$inc":
+                current, _ = _get_path(doc, parts)
+                _set_path(doc, parts, (current or 0) + value)
+            elif op in ("$max", "$min"):
+                current, exists = _get_path(doc, parts)
+                if not exists or (sort_key(value) > sort_key(current)) == (op == "$max"):
+                    _set_path(doc, parts, value)
+            else:
+                raise OperationFailure("unknown update operator: {}".format(op))
+    return doc
+
+
+def _upsert_base(query):
+    """
+    Document an upsert starts from: the equality conditions of the query.
+    """
+    doc = {}
+    for field, cond in query.items():
+        if field.startswith("$"):
+            continue
+        if _is_operator_dict(cond):
+            if "$eq" not in cond:
+                continue
+            cond = cond["$eq"]
+        _set_path(doc, field.split("."), cond)
+    return doc
+
+
+# Indexes
+# -------
+
+class Index:
+    """
+    Single-field index: a hash table from values to document ids for equality
+    queries and a sorted list of (value, id), rebuilt lazily after writes, for
+    range queries and sorts. Documents whose value is not a scalar (arrays,
+    subdocuments, missing field) are kept aside and always returned as
+    candidates, the query itself does the final filtering.
+    """
+
+    def __init__(self, field, unique=False):
+        self.field = field
+        self.unique = unique
+        self._parts = field.split(".")
+        self._values = {}  # _id: indexed value
+        self._hash = defaultdict(set)  # indexed value: {_id}
+        self._other = set()  # _ids of documents that cannot be indexed
+        self._sorted = None  # ([sort key], [_id]) sorted by key
+
+    def add(self, _id, doc):
+        values = _resolve(doc, self._parts)
+        value = values[0] if len(values) == 1 else None
+        if value is None or _rank(value) in (3, 4):
+            self._other.add(_id)
+        else:
+            if self.unique and any(_rank(self._values[i]) == _rank(value)
+                                   for i in self._hash.get(value, ())):
+                raise DuplicateKeyError("duplicate key: {}: {}".format(self.field, value))
+            self._values[_id] = value
+            self._hash[value].add(_id)
+        self._sorted = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_sorted"] = None
+        return state
+
+    def remove(self, _id):
+        if _id in self._values:
+            value = self._values.pop(_id)
+            ids = self._hash[value]
+            ids.discard(_id)
+            if not ids:
+                del self._hash[value]
+        self._other.discard(_id)
+        self._sorted = None
+
+    def _ensure_sorted(self):
+        if self._sorted is None:
+            entries = sorted(((sort_key(v), i) for i, v in self._values.items()),
+                             key=lambda x: x[0])
+            self._sorted = [k for k, _ in entries], [i for _, i in entries]
+        return self._sorted
+
+    def plan(self, cond):
+        """
+        Candidate document ids for a condition on the indexed field.
+
+        Args:
+            cond: query condition (value or operator dict)
+
+        Returns:
+            set: candidate ids, or None if the index cannot serve the condition
+        """
+        if not _is_operator_dict(cond):
+            cond = {"$eq": cond}
+        if "$eq" in cond or "$in" in cond:
+            targets = [cond["$eq"]] if "$eq" in cond else cond["$in"]
+            ids = set(self._other)
+            for target in targets:
+                if target is None or _rank(target) in (3, 4):
+                    return None
+                ids.update(self._hash.get(target, ()))
+            return ids
+        bounds = [(op, v) for op, v in cond.items() if op in _COMPARATORS]
+        if not bounds:
+            return None
+        keys, ids_by_key = self._ensure_sorted()
+        rank = _rank(bounds[0][1])
+        lo, hi = bisect_left(keys, (rank,)), bisect_left(keys, (rank + 1,))
+        for op, value in bounds:
+            if _rank(value) != rank:
+                return set(self._other)
+            key = sort_key(value)
+            if op == "$gt":
+                lo = max(lo, bisect_right(keys, key))
+            elif op == "$gte":
+                lo = max(lo, bisect_left(keys, key))
+            elif op == "$lt":
+                hi = min(hi, bisect_left(keys, key))
+            else:
+                hi = min(hi, bisect_right(keys, key))
+        ids = set(self._other)
+        ids.update(ids_by_key[lo:hi])
+        return ids
+
+    def ordered_ids(self, direction):
+        """
+        All document ids in the order of the indexed field, or None if some
+        documents cannot be ordered by the index.
+        """
+        if self._other:
+            return None
+        _, ids = self._ensure_sorted()
+        return reversed(ids) if direction == pymongo.DESCENDING else iter(ids)
+
+
+# Collection
+# ----------
+
+class MemoryCursor:
+    """
+    Cursor over the results of MemoryCollection.find. The query runs when the
+    cursor is first iterated.
+    """
+
+    def __init__(self, collection, filter=None, projection=None, sort=None,
+                 skip=0, limit=0):
+        self.collection = collection
+        self._filter = filter or {}
+        self._projection = projection
+        self._sort = None
+        self._skip = skip
+        self._limit = limit
+        self._results = None
+        if sort is not None:
+            self.sort(sort)
+
+    def sort(self, key_or_list, direction=pymongo.ASCENDING):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(list(self.clone()))
+        return self.collection.count_documents(self._filter)
+
+    def distinct(self, key):
+        return self.collection.distinct(key, self._filter)
+
+    def clone(self):
+        return MemoryCursor(self.collection, self._filter, self._projection, self._sort,
+                            self._skip, self._limit)
+
+    def close(self):
+        self._results = iter(())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._results is None:
+            self._results = iter(self.collection._execute(
+                self._filter, self._projection, self._sort, self._skip, self._limit))
+        return next(self._results)
+
+
+class MemoryCollection:
+    """
+    In-memory collection with the pymongo Collection interface subset described
+    in the module doc.
+    """
+
+    def __init__(self, name, database=None):
+        """
+        Args:
+            name (str): collection name
+            database (MemoryDatabase): database holding the collection
+        """
+        self.name = name
+        self.database = database if database is not None else MemoryDatabase()
+        self._docs = {}  # _id: document
+        self._seq = {}  # _id: insertion number, to return documents in natural order
+        self._counter = count()
+        self._indexes = {}  # field: Index
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        return self.database["{}.{}".format(self.name, name)]
+
+    @property
+    def db(self):
+        """
+        The database holding the collection, not a sub-collection named "db".
+        """
+        return self.database
+
+    def __getattr__(self, name):
+        # sub-collection, as in pymongo
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    # Indexes
+
+    def create_index(self, keys, unique=False, **kwargs):
+        """
+        Create a single-field index. For compound keys, only the first field is
+        indexed.
+
+        Args:
+            keys (str or list): field name or [(field, direction)]
+            unique (bool): whether the values of the field must be unique
+
+        Returns:
+            str: index name
+        """
+        field = keys if isinstance(keys, str) else keys[0][0]
+        with self._lock:
+            if field != "_id" and field not in self._indexes:
+                index = Index(field, unique)
+                for _id, doc in self._docs.items():
+                    index.add(_id, doc)
+                self._indexes[field] = index
+        return "{}_1".format(field)
+
+    def index_information(self):
+        info = {"_id_": {"key": [("_id", pymongo.ASCENDING)]}}
+        for field, index in self._indexes.items():
+            info["{}_1".format(field)] = {"key": [(field, pymongo.ASCENDING)],
+                                          "unique": index.unique}
+        return info
+
+    def drop_index(self, name):
+        with self._lock:
+            self._indexes.pop(name[:-2] if name.endswith("_1") else name, None)
+
+    # Reads
+
+    def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, **kwargs):
+        return MemoryCursor(self, filter, projection, sort, skip, limit)
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        return next(self.find(filter, projection, limit=1, **kwargs), None)
+
+    def count_documents(self, filter=None, **kwargs):
+        with self._lock:
+            return sum(1 for _ in self._matching_ids(filter or {}))
+
+    def count(self, filter=None, **kwargs):
+        return self.count_documents(filter)
+
+    def estimated_document_count(self, **kwargs):
+        return len(self._docs)
+
+    def distinct(self, key, filter=None, **kwargs):
+        parts = key.split(".")
+        values, seen = [], set()
+        with self._lock:
+            for _id in self._matching_ids(filter or {}):
+                for value in _expand(_resolve(self._docs[_id], parts)):
+                    if isinstance(value, list):
+                        continue
+                    marker = (_rank(value), repr(value))
+                    if marker not in seen:
+                        seen.add(marker)
+                        values.append(value)
+        return values
+
+    def _plan(self, query):
+        """
+        Candidate ids for a query from the indexes, or None for all documents.
+        """
+        candidates = None
+        for field, cond in query.items():
+            if field == "_id" and not isinstance(cond, (dict, list)):
+                ids = {cond} if cond in self._docs else set()
+            elif field in self._indexes:
+                ids = self._indexes[field].plan(cond)
+            else:
+                continue
+            if ids is not None:
+                candidates = ids if candidates is None else candidates & ids
+        return candidates
+
+    def _matching_ids(self, query):
+        candidates = self._plan(query)
+        if candidates is None:
+            ids = list(self._docs)
+        else:
+            ids = sorted(candidates, key=self._seq.__getitem__)
+        return (i for i in ids if match(self._docs[i], query))
+
+    def _execute(self, query, projection, sort, skip, limit):
+        with self._lock:
+            index = None
+            if sort and len(sort) == 1 and sort[0][0] in self._indexes:
+                index = self._indexes[sort[0][0]]
+                ordered = index.ordered_ids(sort[0][1])
+                if ordered is None:
+                    index = None
+            if index is not None:
+                candidates = self._plan(query)
+                docs = (self._docs[i] for i in ordered
+                        if candidates is None or i in candidates)
+                docs = (d for d in docs if match(d, query))
+            else:
+                docs = (self._docs[i] for i in self._matching_ids(query))
+                if sort:
+                    docs = list(docs)
+                    for field, direction in reversed(sort):
+                        parts = field.split(".")
+                        docs.sort(key=lambda d: sort_key(next(iter(_resolve(d, parts)), None)),
+                                  reverse=direction == pymongo.DESCENDING)
+            stop = skip + limit if limit else None
+            return [project(d, projection) for d in islice(docs, skip, stop)]
+
+    # Writes
+
+    def _add(self, doc):
+        if "_id" not in doc:
+            doc["_id"] = ObjectId()
+        _id = doc["_id"]
+        if _id in self._docs:
+            raise DuplicateKeyError("duplicate key: _id: {}".format(_id))
+        doc = dict(doc)
+        added = []
+        try:
+            for index in self._indexes.values():
+                index.add(_id, doc)
+                added.append(index)
+        except DuplicateKeyError:
+            for index in added:
+                index.remove(_id)
+            raise
+        self._docs[_id] = doc
+        self._seq[_id] = next(self._counter)
+        return _id
+
+    def _remove(self, _id):
+        for index in self._indexes.values():
+            index.remove(_id)
+        del self._docs[_id]
+        del self._seq[_id]
+
+    def _replace(self, _id, doc):
+        doc = dict(doc)
+        doc["_id"] = _id
+        old = self._docs[_id]
+        for index in self._indexes.values():
+            index.remove(_id)
+        try:
+            for index in self._indexes.values():
+                index.add(_id, doc)
+        except DuplicateKeyError:
+            for index in self._indexes.values():
+                index.remove(_id)
+                index.add(_id, old)
+            raise
+        self._docs[_id] = doc
+
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            return InsertOneResult(self._add(document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        with self._lock:
+            return InsertManyResult([self._add(doc) for doc in documents], True)
+
+    def _update(self, filter, update, upsert, multi, replace):
+        if not replace and not all(k.startswith("$") for k in update):
+            raise ValueError("update only works with $ operators")
+        if replace and any(k.startswith("$") for k in update):
+            raise ValueError("replacement can not include $ operators")
+        result = {"n": 0, "nModified": 0}
+        with self._lock:
+            ids = list(self._matching_ids(filter))
+            if not multi:
+                ids = ids[:1]
+            for _id in ids:
+                old = self._docs[_id]
+                new = dict(update) if replace else apply_update(old, update)
+                result["n"] += 1
+                if new != {k: v for k, v in old.items() if k != "_id" or not replace}:
+                    self._replace(_id, new)
+                    result["nModified"] += 1
+            if not ids and upsert:
+                doc = _upsert_base(filter)
+                if replace:
+                    doc = dict(update, **({"_id": doc["_id"]} if "_id" in doc else {}))
+                else:
+                    doc = apply_update(doc, update)
+                result["upserted"] = self._add(doc)
+                result["n"] = 1
+        return result
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        return UpdateResult(self._update(filter, replacement, upsert, False, True), True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        return UpdateResult(self._update(filter, update, upsert, False, False), True)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        return UpdateResult(self._update(filter, update, upsert, True, False), True)
+
+    def _delete(self, filter, multi):
+        with self._lock:
+            ids = list(self._matching_ids(filter))
+            if not multi:
+                ids = ids[:1]
+            for _id in ids:
+                self._remove(_id)
+        return {"n": len(ids)}
+
+    def delete_one(self, filter, **kwargs):
+        return DeleteResult(self._delete(filter, False), True)
+
+    def delete_many(self, filter, **kwargs):
+        return DeleteResult(self._delete(filter, True), True)
+
+    def drop(self):
+        with self._lock:
+            self._docs.clear()
+            self._seq.clear()
+            self._indexes.clear()
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """
+        Apply InsertOne, ReplaceOne, UpdateOne/Many and DeleteOne/Many requests.
+        """
+        result = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0,
+                  "nRemoved": 0, "upserted": []}
+        with self._lock:
+            for n, request in enumerate(requests):
+                kind = type(request).__name__
+                if kind == "InsertOne":
+                    self._add(request._doc)
+                    result["nInserted"] += 1
+                    continue
+                if kind in ("DeleteOne", "DeleteMany"):
+                    result["nRemoved"] += self._delete(request._filter, kind == "DeleteMany")["n"]
+                    continue
+                if kind not in ("ReplaceOne", "UpdateOne", "UpdateMany"):
+                    raise TypeError("unsupported bulk write request: {}".format(kind))
+                res = self._update(request._filter, request._doc, request._upsert,
+                                   kind == "UpdateMany", kind == "ReplaceOne")
+                if "upserted" in res:
+                    result["nUpserted"] += 1
+                    result["upserted"].append({"index": n, "_id": res["upserted"]})
+                else:
+                    result["nMatched"] += res["n"]
+                    result["nModified"] += res["nModified"]
+        return BulkWriteResult(result, True)
+
+
+class MemoryDatabase:
+    """
+    Set of MemoryCollections, created on first access.
+    """
+
+    collection_class = MemoryCollection
+
+    def __init__(self, name="db"):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = self.collection_class(name, self)
+            return self._collections[name]
+
+    def collection_names(self):
+        return list(self._collections)
+
+    def drop_collection(self, name):
+        with self._lock:
+            self._collections.pop(getattr(name, "name", name), None)
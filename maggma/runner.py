@@ -1,26 +1,47 @@
+import asyncio
+import inspect
 import logging
 import multiprocessing
 import queue
+import threading
+import time
 from collections import defaultdict
-from itertools import cycle
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import itertools
+from itertools import islice
 import abc
+import datetime
+import pickle
+import uuid
 
-from monty.json import MSONable
+from monty.json import MSONable, MontyDecoder
 
 from maggma.helpers import get_mpi
-from maggma.utils import grouper
+from maggma.memdb import sort_key
+from maggma.utils import Chunker, chunks, sizeof
 
 
 class BaseProcessor(MSONable, metaclass=abc.ABCMeta):
 
-    def __init__(self, builders):
+    #: whether process can run several builders at the same time from different
+    #: threads. If so, process must accept a num_workers keyword argument.
+    supports_concurrency = False
+
+    def __init__(self, builders, max_pending_writes=2, resume=False):
         """
         Initialize with a list of builders
 
         Args:
             builders(list): list of builders
+            max_pending_writes (int): number of processed chunks that may wait
+                for a background thread to write them with update_targets. If 0,
+                update_targets runs synchronously.
+            resume (bool): skip the items that an interrupted run of a builder
+                already wrote to the targets, see Checkpoint.
         """
         self.builders = builders
+        self.max_pending_writes = max_pending_writes
+        self.resume = resume
 
         self.logger = logging.getLogger(type(self).__name__)
         self.logger.addHandler(logging.NullHandler())
@@ -37,38 +58,629 @@ class BaseProcessor(MSONable, metaclass=abc.ABCMeta):
         """
         pass
 
+    def start(self):
+        """
+        Acquire the resources (e.g. worker processes) shared by the builds,
+        called by Runner.run before processing the builders.
+        """
+        pass
+
+    def close(self):
+        """
+        Release the resources acquired by start.
+        """
+        pass
+
+
+class TargetWriter:
+    """
+    Writes chunks of processed items with builder.update_targets on a
+    background thread, so that items keep being dispatched and processed while
+    the targets are written.
+
+    At most max_pending chunks wait to be written; put blocks beyond that. An
+    exception raised by update_targets is re-raised by the next put or by close.
+    """
+
+    def __init__(self, builder, max_pending=2, checkpoint=None):
+        """
+        Args:
+            builder (Builder): the builder whose targets are updated
+            max_pending (int): maximum number of chunks waiting to be written.
+                If 0, put calls update_targets synchronously.
+            checkpoint (Checkpoint): if given, every written chunk is committed
+                to the checkpoint.
+        """
+        self.builder = builder
+        self.checkpoint = checkpoint
+        self._error = None
+        self._thread = None
+        if max_pending > 0:
+            self._queue = queue.Queue(max_pending)
+            self._thread = threading.Thread(target=self._write, daemon=True)
+            self._thread.start()
+
+    def put(self, items, seqs=None):
+        """
+        Queue a chunk of processed items for update_targets.
+
+        Args:
+            items (list): processed items
+            seqs (list): positions of the items in get_items, for the checkpoint
+        """
+        self._raise_error()
+        if self._thread is None:
+            self._update_targets(items, seqs)
+        else:
+            self._queue.put((items, seqs))
+
+    def _update_targets(self, items, seqs):
+        self.builder.update_targets(self.builder.stamp_items(items))
+        if self.checkpoint is not None and seqs is not None:
+            self.checkpoint.commit(seqs)
+
+    def close(self, raise_error=True):
+        """
+        Wait for all queued chunks to be written.
+
+        Args:
+            raise_error (bool): re-raise the exception of update_targets, if
+                any. Otherwise it is only logged, so that closing the writer
+                while handling another exception does not replace it.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if raise_error:
+            self._raise_error()
+        elif self._error is not None:
+            error, self._error = self._error, None
+            self.builder.logger.error("Writing the targets failed: {!r}".format(error))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self):
+        while True:
+            packet = self._queue.get()
+            if packet is None:
+                break
+            # after a failure keep draining the queue so put never blocks forever
+            if self._error is None:
+                try:
+                    self._update_targets(*packet)
+                except Exception as exc:
+                    self._error = exc
+
+
+class Checkpoint:
+    """
+    Progress of a builder run, saved in the meta collection of the first target
+    of the builder so that an interrupted run can be resumed.
+
+    Items are numbered in the order get_items yields them. A chunk is committed
+    once update_targets has written it, and the checkpoint records how many
+    leading items have all been committed (chunks may be written out of order
+    by the parallel processors), the number of committed chunks, the key of the
+    last of these items (see Builder.item_key), the start time of the build
+    and the id of the run.
+
+    On resume, the items up to that key are skipped, which requires get_items
+    to yield items sorted by unique keys, and the start time of the build is
+    restored so that the sources changed since then are built again by the
+    next incremental build. Items committed beyond the key are processed
+    again, update_targets is expected to be idempotent.
+    """
+
+    def __init__(self, builder, resume=False):
+        """
+        Args:
+            builder (Builder): the builder being run
+            resume (bool): start from the checkpoint of the previous run, if
+                any. Otherwise the checkpoint is reset.
+        """
+        self.builder = builder
+        self.store = builder.targets[0] if builder.targets else None
+        # builders of the same class with the same first target are told apart
+        # by the collections they read and write
+        names = [s.collection.name for s in builder.sources + builder.targets
+                 if s.collection is not None]
+        self.checkpoint_id = "checkpoint.{}:{}".format(type(builder).__name__, ",".join(names))
+        self.run_id = uuid.uuid4().hex
+        self.n_items = 0
+        self.n_chunks = 0
+        self.key = None
+        self._committed = set()  # committed positions >= n_items
+        self._keys = {}  # position: key of the items being processed
+        self._lock = threading.Lock()
+        if resume and self.store is not None:
+            doc = self.store.meta.find_one({"_id": self.checkpoint_id})
+            if doc:
+                self.run_id = doc["run_id"]
+                self.n_items = doc["n_items"]
+                self.n_chunks = doc["n_chunks"]
+                self.key = doc.get("key")
+                if doc.get("build_start") is not None:
+                    builder.build_start = doc["build_start"]
+
+    def skip(self, items):
+        """
+        Skip the items committed by the previous run, i.e. the items up to the
+        key of the checkpoint.
+
+        Args:
+            items (iterable): the items from get_items
+
+        Returns:
+            iterator: the remaining items
+
+        Raises:
+            RuntimeError: if the items have no key, or (while iterating) are not
+                sorted by unique keys
+        """
+        items = iter(items)
+        if not self.n_items:
+            return items
+        if self.key is None:
+            raise RuntimeError(
+                "{} has no item_key, checkpoint {} cannot be resumed, rerun it without resume"
+                .format(type(self.builder).__name__, self.run_id))
+        self.builder.logger.info("Resuming run {} after key {}".format(self.run_id, self.key))
+        return self._skip_to_key(items)
+
+    def _skip_to_key(self, items):
+        last = sort_key(self.key)
+        previous = None
+        for item in items:
+            key = self.builder.item_key(item)
+            current = None if key is None else sort_key(key)
+            if current is None or (previous is not None and current <= previous):
+                raise RuntimeError(
+                    "The items of {} are not sorted by unique item_key at {}, checkpoint {} "
+                    "cannot be resumed, rerun it without resume"
+                    .format(type(self.builder).__name__, key, self.run_id))
+            previous = current
+            if current > last:
+                yield item
+
+    def track(self, start, items):
+        """
+        Register the keys of items about to be processed.
+
+        Args:
+            start (int): position of the first item
+            items (list): the items
+        """
+        for seq, item in enumerate(items, start):
+            key = self.builder.item_key(item)
+            if key is not None:
+                self._keys[seq] = key
+
+    def commit(self, seqs):
+        """
+        Record that a chunk was written and save the checkpoint.
+
+        Args:
+            seqs (list): positions of the items of the chunk
+        """
+        with self._lock:
+            self._committed.update(seqs)
+            while self.n_items in self._committed:
+                self._committed.remove(self.n_items)
+                self.key = self._keys.pop(self.n_items, self.key)
+                self.n_items += 1
+            self.n_chunks += 1
+            if self.store is not None:
+                self.store.meta.update_one(
+                    {"_id": self.checkpoint_id},
+                    {"$set": {"run_id": self.run_id, "n_items": self.n_items,
+                              "n_chunks": self.n_chunks, "key": self.key,
+                              "build_start": self.builder.build_start,
+                              "updated": datetime.datetime.utcnow()}},
+                    upsert=True)
+
+    def clear(self):
+        """
+        Remove the checkpoint once the run is complete.
+        """
+        if self.store is not None:
+            self.store.meta.delete_one({"_id": self.checkpoint_id})
+
+
+class BatchSizer:
+    """
+    Number of items sent to a worker per message.
+
+    A fixed batch size is used as is. With batch_size=0 the size adapts to the
+    measured per-item processing time, so that the processing time of a batch
+    stays around target_time and the per-message pickling/IPC overhead is
+    amortized over many small items.
+    """
+
+    def __init__(self, batch_size=1, target_time=0.1, max_batch_size=1000):
+        """
+        Args:
+            batch_size (int): fixed batch size, or 0 to adapt it
+            target_time (float): targeted processing time of a batch in seconds,
+                used only if adaptive.
+            max_batch_size (int): upper bound on the adaptive batch size
+        """
+        self.adaptive = not batch_size
+        self.target_time = target_time
+        self.max_batch_size = max_batch_size
+        self.size = 1 if self.adaptive else batch_size
+        self._time_per_item = None
+
+    def record(self, n_items, elapsed):
+        """
+        Record the time it took to process a batch and adapt the batch size.
+
+        Args:
+            n_items (int): number of items in the batch
+            elapsed (float): processing time of the batch in seconds
+        """
+        if not self.adaptive or not n_items:
+            return
+        time_per_item = elapsed / n_items
+        # exponential moving average to smooth out outliers
+        if self._time_per_item is None:
+            self._time_per_item = time_per_item
+        else:
+            self._time_per_item = 0.8 * self._time_per_item + 0.2 * time_per_item
+        if self._time_per_item > 0:
+            size = int(self.target_time / self._time_per_item)
+        else:
+            size = self.max_batch_size
+        self.size = max(1, min(size, self.max_batch_size))
+
+
+def target_chunker(builder):
+    """
+    Chunker of (position in get_items, processed item) pairs, which completes
+    the chunks passed to update_targets according to the builder's chunk_size,
+    chunk_max_bytes and chunk_max_age.
+    """
+    return Chunker(builder.chunk_size, builder.chunk_max_bytes, builder.chunk_max_age,
+                   sizeof=lambda pair: sizeof(pair[1]))
+
+
+def put_chunks(writer, chunks):
+    """
+    Write chunks of (position, processed item) pairs with a TargetWriter.
+    """
+    for chunk in chunks:
+        seqs, items = zip(*chunk)
+        writer.put(list(items), list(seqs))
+
+
+def process_batch(builder, items):
+    """
+    Process a batch of items with the given builder.
+
+    Args:
+        builder (Builder): the builder
+        items (list): items to process
+
+    Returns:
+        tuple: (list of processed items, processing time in seconds)
+    """
+    t0 = time.time()
+    processed_items = [builder.process_item(item) for item in items]
+    return processed_items, time.time() - t0
+
+
+class Shard:
+    """
+    A shard of the items of a builder (see Builder.get_shards), sent to a
+    worker in place of a batch of items. The worker reads the items itself.
+    """
+
+    __slots__ = ("spec",)
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+def item_batches(items, checkpoint, sizer):
+    """
+    Split the items of get_items into the batches sent to the workers.
+
+    Args:
+        items (iterator): the items left to process
+        checkpoint (Checkpoint): checkpoint of the run, tracks the batches
+        sizer (BatchSizer): size of the batches
+
+    Yields:
+        tuple: (position of the first item of the batch in get_items, batch)
+    """
+    start = checkpoint.n_items
+    while True:
+        batch = list(islice(items, sizer.size))
+        if not batch:
+            return
+        checkpoint.track(start, batch)
+        yield start, batch
+        start += len(batch)
+
+
+def process_work(builder, start, work, batch_size):
+    """
+    Process a batch of items, or the items of a shard, which are read in
+    batches of batch_size.
+
+    Args:
+        builder (Builder): the builder
+        start (int): position of the first item of a batch in get_items, None
+            for a shard
+        work (list or Shard): the batch or the shard
+        batch_size (int): number of items of a shard processed at once
+
+    Yields:
+        tuple: (start, list of processed items, processing time in seconds)
+    """
+    if isinstance(work, Shard):
+        builder.connect_sources()
+        for batch in chunks(builder.get_shard_items(work.spec), batch_size):
+            yield (None,) + process_batch(builder, batch)
+    else:
+        yield (start,) + process_batch(builder, work)
+
+
+def positions(start, n_items):
+    """
+    Positions in get_items of processed items, None for the items of a shard.
+    """
+    if start is None:
+        return itertools.repeat(None, n_items)
+    return range(start, start + n_items)
+
 
 class SerialProcessor(BaseProcessor):
     """
     Simple serial processor. Usefull for debugging or example code
     """
 
-    def process(self, builder_id):
+    supports_concurrency = True
+
+    def process(self, builder_id, num_workers=None):
         """
         Run the builder serially
 
         Args:
             builder_id (int): the index of the builder in the builders list
+            num_workers (int): ignored, the builder runs in the calling thread
+        """
+        builder = self.builders[builder_id]
+
+        # establish connection to the sources and targets
+        builder.connect()
+
+        cursor = builder.get_items()
+        checkpoint = Checkpoint(builder, self.resume)
+        items = checkpoint.skip(cursor)
+        writer = TargetWriter(builder, self.max_pending_writes, checkpoint)
+        chunker = target_chunker(builder)
+
+        try:
+            for seq, item in enumerate(items, checkpoint.n_items):
+                checkpoint.track(seq, [item])
+                put_chunks(writer, chunker.add((seq, builder.process_item(item))))
+        except Exception:
+            # commit the chunks already processed
+            writer.close(raise_error=False)
+            raise
+        put_chunks(writer, [chunker.flush()] if len(chunker) else [])
+        writer.close()
+        builder.update_watermarks()
+        checkpoint.clear()
+
+
+def process_one(builder, seq, item):
+    """
+    Process an item, keeping its position in get_items.
+    """
+    return seq, builder.process_item(item)
+
+
+class ThreadPoolProcessor(BaseProcessor):
+    """
+    Processes the items in a pool of threads, for builders whose process_item
+    mostly waits on I/O (HTTP or database requests). The items are not pickled
+    and no process is forked. At most 2 * num_workers items are in flight.
+    """
+
+    supports_concurrency = True
+
+    def __init__(self, builders, num_workers=0, max_pending_writes=2, resume=False):
+        """
+        Args:
+            builders(list): list of builders
+            num_workers (int): number of threads. Will be set to
+                min(32, number of cpus + 4) if not positive.
+            max_pending_writes (int): see BaseProcessor
+            resume (bool): see BaseProcessor
+        """
+        self.num_workers = (num_workers if num_workers > 0
+                            else min(32, multiprocessing.cpu_count() + 4))
+        super(ThreadPoolProcessor, self).__init__(builders, max_pending_writes, resume)
+
+    def process(self, builder_id, num_workers=None):
+        """
+        Run the builder in a thread pool.
+
+        Args:
+            builder_id (int): the index of the builder in the builders list
+            num_workers (int): number of threads for this builder, defaults to
+                self.num_workers
         """
         builder = self.builders[builder_id]
-        chunk_size = builder.chunk_size
+        num_workers = num_workers or self.num_workers
 
         # establish connection to the sources and targets
         builder.connect()
 
         cursor = builder.get_items()
+        checkpoint = Checkpoint(builder, self.resume)
+        writer = TargetWriter(builder, self.max_pending_writes, checkpoint)
+        chunker = target_chunker(builder)
+        executor = ThreadPoolExecutor(num_workers)
+        pending = set()
+        try:
+            for seq, item in enumerate(checkpoint.skip(cursor), checkpoint.n_items):
+                if len(pending) >= 2 * num_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    put_chunks(writer, chunker.extend(future.result() for future in done))
+                checkpoint.track(seq, [item])
+                pending.add(executor.submit(process_one, builder, seq, item))
+            done, pending = wait(pending)
+            put_chunks(writer, chunker.extend(future.result() for future in done))
+        except Exception:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+            writer.close(raise_error=False)
+            raise
+        executor.shutdown()
+        if len(chunker):
+            put_chunks(writer, [chunker.flush()])
+        writer.close()
+        builder.update_watermarks()
+        checkpoint.clear()
+        builder.finalize(cursor)
+
 
-        for chunk in grouper(cursor,chunk_size):
-            self.logger.info("Processing batch of {} items".format(chunk_size))
-            processed_items = [builder.process_item(item) for item in filter(None,chunk)]
-            builder.update_targets(processed_items)
+class AsyncProcessor(BaseProcessor):
+    """
+    Processes the items concurrently in an asyncio event loop, for builders
+    with an `async def process_item` (a regular process_item is called
+    directly). At most `concurrency` items are processed at the same time.
+    Each call of process runs its own event loop, so Runner can run several
+    builders in parallel.
+    """
+
+    supports_concurrency = True
+
+    def __init__(self, builders, concurrency=100, max_pending_writes=2, resume=False):
+        """
+        Args:
+            builders(list): list of builders
+            concurrency (int): maximum number of items being processed at once
+            max_pending_writes (int): see BaseProcessor
+            resume (bool): see BaseProcessor
+        """
+        self.concurrency = max(1, concurrency)
+        super(AsyncProcessor, self).__init__(builders, max_pending_writes, resume)
+
+    def process(self, builder_id, num_workers=None):
+        """
+        Run the builder in a new event loop.
+
+        Args:
+            builder_id (int): the index of the builder in the builders list
+            num_workers (int): ignored, the concurrency is set by self.concurrency
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.process_async(builder_id))
+        finally:
+            loop.close()
+
+    async def process_async(self, builder_id):
+        """
+        Run the builder in the running event loop.
+
+        Args:
+            builder_id (int): the index of the builder in the builders list
+        """
+        builder = self.builders[builder_id]
+        loop = asyncio.get_event_loop()
+
+        # establish connection to the sources and targets
+        builder.connect()
+
+        cursor = builder.get_items()
+        checkpoint = Checkpoint(builder, self.resume)
+        writer = TargetWriter(builder, self.max_pending_writes, checkpoint)
+        chunker = target_chunker(builder)
+
+        async def write(done):
+            chunks = chunker.extend(task.result() for task in done)
+            if chunks:
+                # do not block the event loop while the writer queue is full
+                await loop.run_in_executor(None, put_chunks, writer, chunks)
+
+        pending = set()
+        try:
+            for seq, item in enumerate(checkpoint.skip(cursor), checkpoint.n_items):
+                if len(pending) >= self.concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                    await write(done)
+                checkpoint.track(seq, [item])
+                pending.add(asyncio.ensure_future(self._process_item(builder, seq, item)))
+            if pending:
+                done, pending = await asyncio.wait(pending)
+                await write(done)
+        except Exception:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            writer.close(raise_error=False)
+            raise
+        if len(chunker):
+            put_chunks(writer, [chunker.flush()])
+        writer.close()
+        builder.update_watermarks()
+        checkpoint.clear()
+        builder.finalize(cursor)
+
+    @staticmethod
+    async def _process_item(builder, seq, item):
+        processed_item = builder.process_item(item)
+        if inspect.isawaitable(processed_item):
+            processed_item = await processed_item
+        return seq, processed_item
 
 
 class MPIProcessor(BaseProcessor):
+    """
+    Demand-driven MPI processor.
+
+    The master keeps up to `prefetch` batches in flight per worker. Each batch of
+    processed items a worker returns is its request for more work: the master
+    sends it the next batch with a non-blocking send and only then updates the
+    targets, so workers keep processing their queued batches while the targets
+    are written.
 
-    def __init__(self, builders):
+    If the builder supports sharding (see Builder.get_shards), the master sends
+    shards instead of items, one at a time per worker, and the workers read the
+    items of their shard from the sources themselves.
+    """
+
+    #: message tags
+    WORK_TAG, RESULT_TAG = 1, 2
+
+    def __init__(self, builders, batch_size=1, prefetch=2, max_pending_writes=2,
+                 resume=False, shards_per_worker=4):
+        """
+        Args:
+            builders(list): list of builders
+            batch_size (int): number of items sent to a worker per message. If 0,
+                the batch size adapts to the measured per-item processing time.
+            prefetch (int): number of batches kept in flight per worker
+            max_pending_writes (int): see BaseProcessor
+            resume (bool): see BaseProcessor. Not supported by sharded builds.
+            shards_per_worker (int): number of shards per worker requested from
+                builders supporting sharding
+        """
         (self.comm, self.rank, self.size) = get_mpi()
-        super(MPIProcessor, self).__init__(builders)
+        self.batch_size = batch_size
+        self.prefetch = max(1, prefetch)
+        self.shards_per_worker = shards_per_worker
+        super(MPIProcessor, self).__init__(builders, max_pending_writes, resume)
 
     def process(self, builder_id):
         """
@@ -86,210 +698,666 @@ class MPIProcessor(BaseProcessor):
             self.worker()
 
     def master(self, builder_id):
+        from mpi4py import MPI
+
         self.logger.info("Building with MPI. {} workers in the pool.".format(self.size - 1))
 
         builder = self.builders[builder_id]
-        chunk_size = builder.chunk_size
+        sizer = BatchSizer(self.batch_size)
 
         # establish connection to the sources and targets
         builder.connect()
 
-        # cycle through the workers, there could be less workers than the items to process
-        worker_id = cycle(range(1, self.size))
-
-        n = 0
-        workers = []
-        # distribute the items to process (in chunks of size chunk_size)
-        cursor = builder.get_items()
-        for item in cursor:
-            if n % chunk_size == 0:
-                self.logger.info("processing chunks of size {}".format(chunk_size))
-                processed_chunk = self._process_chunk(chunk_size, workers)
-                builder.update_targets(processed_chunk)
-            packet = (builder_id, item)
-            wid = next(worker_id)
-            workers.append(wid)
-            self.comm.send(packet, dest=wid)
-            n += 1
+        shards = builder.get_shards(self.shards_per_worker * (self.size - 1))
+        if shards is None:
+            cursor = builder.get_items()
+            checkpoint = Checkpoint(builder, self.resume)
+            work = item_batches(checkpoint.skip(cursor), checkpoint, sizer)
+            prefetch = self.prefetch
+        else:
+            self.logger.info("Sending {} shards to the workers".format(len(shards)))
+            if self.resume:
+                self.logger.warning("Sharded builds cannot be resumed, building all shards")
+            cursor, checkpoint = None, None
+            work = ((None, Shard(shard)) for shard in shards)
+            prefetch = 1
+        in_flight = defaultdict(int)  # number of batches sent to each worker
+        requests = []  # pending non-blocking sends
+
+        def dispatch(wid):
+            packet = next(work, None)
+            if packet is not None:
+                requests.append(self.comm.isend((builder_id,) + packet, dest=wid,
+                                                tag=self.WORK_TAG))
+                in_flight[wid] += 1
+
+        # fill the pipeline of every worker
+        for _ in range(prefetch):
+            for wid in range(1, self.size):
+                dispatch(wid)
+
+        chunker = target_chunker(builder)
+        writer = TargetWriter(builder, self.max_pending_writes, checkpoint)
+        status = MPI.Status()
+        while any(in_flight.values()):
+            batch_start, processed_batch, elapsed, done = self.comm.recv(
+                source=MPI.ANY_SOURCE, tag=self.RESULT_TAG, status=status)
+            wid = status.Get_source()
+            if batch_start is not None:
+                sizer.record(len(processed_batch), elapsed)
+            if done:
+                in_flight[wid] -= 1
+                # hand out more work before spending time on the targets
+                dispatch(wid)
+            requests = [r for r in requests if not r.Test()]
+
+            put_chunks(writer, chunker.extend(
+                zip(positions(batch_start, len(processed_batch)), processed_batch)))
+            if chunker.expired:
+                put_chunks(writer, [chunker.flush()])
 
         # in case the total number of items is not divisible by chunk_size, process the leftovers.
-        if workers:
-            processed_chunk = self._process_chunk(chunk_size, workers)
-            builder.update_targets(processed_chunk)
+        if len(chunker):
+            put_chunks(writer, [chunker.flush()])
 
         # kill workers
-        for _ in range(self.size - 1):
-            self.comm.send(None, dest=next(worker_id))
+        MPI.Request.Waitall(requests)
+        for wid in range(1, self.size):
+            self.comm.send(None, dest=wid, tag=self.WORK_TAG)
+        writer.close()
+        builder.update_watermarks()
+        if checkpoint is not None:
+            checkpoint.clear()
 
         # finalize
         builder.finalize(cursor)
 
-    def _process_chunk(self, chunk_size, workers):
+    def worker(self):
+        """
+        Where shit gets done!
+        Call the builder's process_item method on each item of a batch, or of a
+        shard, and send back the processed items along with their position in
+        get_items and their processing time. The last message of a batch or
+        shard is flagged as done.
+        """
+        while True:
+            packet = self.comm.recv(source=0, tag=self.WORK_TAG)
+            if packet is None:
+                break
+            builder_id, start, work = packet
+            builder = self.builders[builder_id]
+            result = None
+            for next_result in process_work(builder, start, work, builder.chunk_size):
+                if result is not None:
+                    self.comm.send(result + (False,), dest=0, tag=self.RESULT_TAG)
+                result = next_result
+            if result is None:
+                result = (start, [], 0.0)
+            self.comm.send(result + (True,), dest=0, tag=self.RESULT_TAG)
+
+
+class MPICollectiveProcessor(BaseProcessor):
+    """
+    MPI processor based on collective communication, in rounds. In each round
+    the master reads the next items_per_rank * size items of get_items, splits
+    them into one contiguous part per rank (sizes differ by at most one item)
+    and scatters the pickled parts with Scatterv. Every rank, the master
+    included, processes its part and the processed parts are gathered back
+    with Gatherv, in the order of the items, and written to the targets on a
+    background thread while the next round runs.
+
+    The memory used on the master is bounded by the size of a round. Compared
+    to MPIProcessor, no rank is dedicated to distributing work, but every
+    round waits for its slowest rank, so it suits items of uniform cost.
+    """
+
+    def __init__(self, builders, items_per_rank=100, max_pending_writes=2, resume=False):
+        """
+        Args:
+            builders(list): list of builders
+            items_per_rank (int): number of items processed by each rank per round
+            max_pending_writes (int): see BaseProcessor
+            resume (bool): see BaseProcessor
+        """
+        (self.comm, self.rank, self.size) = get_mpi()
+        self.items_per_rank = max(1, items_per_rank)
+        super(MPICollectiveProcessor, self).__init__(builders, max_pending_writes, resume)
+
+    def process(self, builder_id):
+        """
+        Run the builder, must be called by all the ranks.
+
+        Args:
+            builder_id (int): the index of the builder in the builders list
+        """
+        self.comm.Barrier()
+        if self.rank == 0:
+            self.master(builder_id)
+        else:
+            while self._round(builder_id) is not None:
+                pass
+
+    @staticmethod
+    def split(items, n):
         """
-        process chunk_size items.
+        Split items into n contiguous parts whose sizes differ by at most one.
 
         Args:
-            chunk_size (int):
-            workers (list): lis tpf worker ids
+            items (list): items to split
+            n (int): number of parts
 
         Returns:
-            list : list of processed items
+            list: the parts, the first len(items) % n being one item longer
+        """
+        size, extra = divmod(len(items), n)
+        parts, start = [], 0
+        for i in range(n):
+            end = start + size + (1 if i < extra else 0)
+            parts.append(items[start:end])
+            start = end
+        return parts
+
+    def master(self, builder_id):
+        self.logger.info("Building with MPI collectives. {} ranks.".format(self.size))
+
+        builder = self.builders[builder_id]
+        builder.connect()
+        cursor = builder.get_items()
+        checkpoint = Checkpoint(builder, self.resume)
+        writer = TargetWriter(builder, self.max_pending_writes, checkpoint)
+        chunker = target_chunker(builder)
+        self._running = True
+        try:
+            batches = item_batches(checkpoint.skip(cursor), checkpoint,
+                                   BatchSizer(self.items_per_rank * self.size))
+            while True:
+                start, batch = next(batches, (None, None))
+                processed_items = self._round(builder_id, batch)
+                if processed_items is None:
+                    break
+                put_chunks(writer, chunker.extend(zip(positions(start, len(batch)),
+                                                      processed_items)))
+        except Exception:
+            if self._running:
+                # release the other ranks
+                self._round(builder_id)
+            writer.close(raise_error=False)
+            raise
+        if len(chunker):
+            put_chunks(writer, [chunker.flush()])
+        writer.close()
+        builder.update_watermarks()
+        checkpoint.clear()
+        builder.finalize(cursor)
+
+    def _round(self, builder_id, items=None):
+        """
+        Scatter the items of a round, process the part of this rank and gather
+        the processed items on the master. items are given on the master only,
+        None (or an error on the master) ends the run on all the ranks.
+
+        Returns:
+            list: the processed items on the master, an empty list on the other
+                ranks, or None when the run is over.
+        """
+        from mpi4py import MPI
+
+        if self.rank == 0:
+            if items is None:
+                self.comm.bcast(None, root=0)
+                self._running = False
+                return None
+            payloads = [pickle.dumps(part, pickle.HIGHEST_PROTOCOL)
+                        for part in self.split(items, self.size)]
+            counts = [len(payload) for payload in payloads]
+            sendbuf = [bytearray(b"".join(payloads)), (counts, None), MPI.BYTE]
+        else:
+            counts, sendbuf = None, None
+        counts = self.comm.bcast(counts, root=0)
+        if counts is None:
+            return None
+        part = bytearray(counts[self.rank])
+        self.comm.Scatterv(sendbuf, [part, MPI.BYTE], root=0)
+
+        try:
+            result = (process_batch(self.builders[builder_id], pickle.loads(part))[0], None)
+        except Exception as exc:
+            result = (None, exc)
+        payload = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        sizes = self.comm.gather(len(payload), root=0)
+        recvbuf = [bytearray(sum(sizes)), (sizes, None), MPI.BYTE] if self.rank == 0 else None
+        self.comm.Gatherv([bytearray(payload), MPI.BYTE], recvbuf, root=0)
+        if self.rank != 0:
+            return []
+
+        processed_items, offset = [], 0
+        for size in sizes:
+            processed_part, error = pickle.loads(recvbuf[0][offset:offset + size])
+            if error is not None:
+                self.comm.bcast(None, root=0)
+                self._running = False
+                raise error
+            processed_items.extend(processed_part)
+            offset += size
+        return processed_items
+
+
+def pool_worker(task_queue, result_queue, control_queue, builders, result_batch_size):
+    """
+    Main function of the worker processes of a WorkerPool.
+
+    Tasks are (job id, builder id, start, batch or Shard) tuples, see
+    process_work. A builder is taken from builders when the worker was forked,
+    otherwise it is rebuilt from the handle that the pool sends once on
+    control_queue, see WorkerPool.open_job.
+
+    The sources of a builder are connected (see Builder.connect_sources) when
+    the worker receives the first task of a job, since the workers may have
+    been started before the builder connected.
+
+    The processed items of a job are buffered until result_batch_size items are
+    collected, the task queue is empty or a task of another job is received,
+    and sent as (job id, None,
+    (items, positions, processing time, number of completed tasks)). A failed
+    task is reported as (job id, exception, None).
+
+    Args:
+        task_queue (multiprocessing.Queue): queue of tasks, None stops the worker
+        result_queue (multiprocessing.Queue): queue of results
+        control_queue (multiprocessing.Queue): queue of (builder id, handle)
+        builders (list): the builders if the worker was forked, else None
+        result_batch_size (int): number of processed items sent at once
+    """
+    builders = dict(enumerate(builders)) if builders is not None else {}
+    buffers = {}  # job id: [processed items, positions, elapsed, completed tasks]
+    connected = set()  # job ids
+
+    def flush(job_id):
+        result_queue.put((job_id, None, tuple(buffers.pop(job_id))))
+
+    while True:
+        try:
+            packet = task_queue.get_nowait()
+        except queue.Empty:
+            # idle: send what has been processed so far
+            for job_id in list(buffers):
+                flush(job_id)
+            packet = task_queue.get()
+        if packet is None:
+            break
+        job_id, builder_id, start, work = packet
+        for other_job_id in [j for j in buffers if j != job_id]:
+            flush(other_job_id)
+        while builder_id not in builders:
+            handle_id, handle = control_queue.get()
+            builders[handle_id] = MontyDecoder().process_decoded(handle)
+        builder = builders[builder_id]
+        try:
+            if job_id not in connected:
+                builder.connect_sources()
+                connected.add(job_id)
+            for start, processed_batch, elapsed in process_work(builder, start, work,
+                                                                result_batch_size):
+                buf = buffers.setdefault(job_id, [[], [], 0.0, 0])
+                buf[0].extend(processed_batch)
+                buf[1].extend(positions(start, len(processed_batch)))
+                buf[2] += elapsed
+                if len(buf[0]) >= result_batch_size:
+                    flush(job_id)
+        except Exception as exc:
+            buffers.pop(job_id, None)
+            try:
+                pickle.dumps(exc)
+            except Exception:
+                exc = RuntimeError(repr(exc))
+            result_queue.put((job_id, exc, None))
+            continue
+        buffers.setdefault(job_id, [[], [], 0.0, 0])[3] += 1
+    for job_id in list(buffers):
+        flush(job_id)
+
+
+class WorkerPool:
+    """
+    Pool of worker processes that lives across the builds of a processor.
+    Several builds (jobs) can use the pool at the same time, the results of
+    the workers are routed to the job they belong to by a background thread.
+
+    Forked workers inherit the builders. With the spawn and forkserver start
+    methods, a builder is sent to each worker once, as its MSON dict, the
+    first time a job uses it, rather than pickling the builders (and their
+    connections) into every process.
+    """
+
+    def __init__(self, builders, num_workers, result_batch_size=100, start_method=None,
+                 preload=None):
+        """
+        Args:
+            builders (list): the builders of the processor
+            num_workers (int): number of worker processes
+            result_batch_size (int): see pool_worker
+            start_method (str): multiprocessing start method, "fork", "spawn" or
+                "forkserver". Defaults to the platform default.
+            preload (list): modules imported by the forkserver before forking
+                the workers, e.g. the modules of the builders. maggma.runner is
+                always preloaded.
+        """
+        self.builders = builders
+        ctx = multiprocessing.get_context(start_method)
+        if ctx.get_start_method() == "forkserver":
+            ctx.set_forkserver_preload(["maggma.runner"] + list(preload or []))
+        forked = ctx.get_start_method() == "fork"
+        self._initialized = set(range(len(builders))) if forked else set()
+        self.task_queue = ctx.Queue(4 * num_workers)
+        self.result_queue = ctx.Queue()
+        self.control_queues = [ctx.Queue() for _ in range(num_workers)]
+        self.processes = []
+        for control_queue in self.control_queues:
+            proc = ctx.Process(target=pool_worker, daemon=True,
+                               args=(self.task_queue, self.result_queue, control_queue,
+                                     builders if forked else None, result_batch_size))
+            proc.start()
+            self.processes.append(proc)
+        self._jobs = {}
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closing = False
+        # start the router after the workers, forking a threaded process is unsafe
+        self._router = threading.Thread(target=self._route, daemon=True)
+        self._router.start()
+
+    def open_job(self, builder_id):
         """
-        status = []
-        processed_chunk = []
-        self.logger.info("{} items sent for processing".format(chunk_size))
+        Start a job, sending the builder to the workers if needed.
+
+        Args:
+            builder_id (int): the index of the builder in the builders list
 
-        # get processed item from the workers
-        while workers:
+        Returns:
+            PoolJob
+        """
+        with self._lock:
+            if builder_id not in self._initialized:
+                handle = self.builders[builder_id].as_dict()
+                for control_queue in self.control_queues:
+                    control_queue.put((builder_id, handle))
+                self._initialized.add(builder_id)
+            job = PoolJob(next(self._job_ids), builder_id, self)
+            self._jobs[job.job_id] = job
+            return job
+
+    def close_job(self, job):
+        with self._lock:
+            self._jobs.pop(job.job_id, None)
+
+    def _route(self):
+        while not self._closing:
             try:
-                processed_item = self.comm.recv()
-                status.append(True)
-                processed_chunk.append(processed_item)
-            except:
-                raise
-            workers.pop()
+                job_id, error, result = self.result_queue.get(timeout=0.1)
+            except queue.Empty:
+                if not self._closing and not all(p.is_alive() for p in self.processes):
+                    with self._lock:
+                        for job in self._jobs.values():
+                            job.results.put(RuntimeError("A worker process died"))
+                continue
+            with self._lock:
+                job = self._jobs.get(job_id)
+            # the results of closed (e.g. failed) jobs are dropped
+            if job is not None:
+                job.results.put(error if error is not None else result)
+
+    def close(self):
+        """
+        Stop the workers.
+        """
+        for _ in self.processes:
+            self.task_queue.put(None)
+        # the router keeps reading the results, so that the workers can exit
+        for p in self.processes:
+            p.join()
+        self._closing = True
+        self._router.join()
 
-        if status:
-            if not all(status):
-                raise RuntimeError("processing failed")
 
-        return processed_chunk
+class PoolJob:
+    """
+    A build running on a WorkerPool.
+    """
 
-    def worker(self):
+    def __init__(self, job_id, builder_id, pool):
+        self.job_id = job_id
+        self.builder_id = builder_id
+        self.pool = pool
+        self.results = queue.Queue()
+        self.n_sent = 0  # number of tasks sent
+        self.n_done = 0  # number of tasks whose results were received
+
+    def put(self, start, work):
         """
-        Where shit gets done!
-        Call the builder's process_item method and send back the processed item
+        Send a task, a batch of items or a Shard. Blocks when the task queue of
+        the pool is full.
+        """
+        self.pool.task_queue.put((self.job_id, self.builder_id, start, work))
+        self.n_sent += 1
+
+    def collect(self, chunker, sizer=None, block=False):
+        """
+        Collect the processed items received so far.
 
         Args:
-            comm (MPI.comm): mpi communicator, must be given when using MPI.
+            chunker (Chunker): chunker of (position in get_items, processed item)
+                pairs the items are added to
+            sizer (BatchSizer): records the processing time of each batch
+            block (bool): wait for at least one result
+
+        Returns:
+            list: the chunks completed by the collected items
         """
+        completed = []
         while True:
-            packet = self.comm.recv(source=0)
-            if packet is None:
+            try:
+                result = self.results.get(timeout=0.1) if block else self.results.get_nowait()
+            except queue.Empty:
+                if block:
+                    continue
                 break
-            builder_id, item = packet
-            processed_item = self.builders[builder_id].process_item(item)
-            self.comm.ssend(processed_item, 0)
+            if isinstance(result, Exception):
+                raise result
+            processed_items, seqs, elapsed, n_done = result
+            if sizer is not None:
+                sizer.record(len(processed_items), elapsed)
+            completed.extend(chunker.extend(zip(seqs, processed_items)))
+            self.n_done += n_done
+            block = False
+        if chunker.expired:
+            completed.append(chunker.flush())
+        return completed
+
+    def close(self):
+        self.pool.close_job(self)
 
 
 class MultiprocProcessor(BaseProcessor):
+    """
+    Processes the items in a pool of worker processes, see WorkerPool. The
+    pool lives between start and close (Runner.run calls them), otherwise a
+    pool is started for each call of process.
+    """
+
+    supports_concurrency = True
 
-    def __init__(self, builders, num_workers):
+    def __init__(self, builders, num_workers, batch_size=1, result_batch_size=100,
+                 max_pending_writes=2, resume=False, shards_per_worker=4, start_method=None,
+                 preload=None):
+        """
+        Args:
+            builders(list): list of builders
+            num_workers (int): number of worker processes. Will be set to
+                (number of cpus - 1) if not positive.
+            batch_size (int): number of items sent to a worker per message. If 0,
+                the batch size adapts to the measured per-item processing time.
+            result_batch_size (int): number of processed items a worker collects
+                before sending them back to the master in a single message.
+            max_pending_writes (int): see BaseProcessor
+            resume (bool): see BaseProcessor. Not supported by sharded builds.
+            shards_per_worker (int): number of shards per worker requested from
+                builders supporting sharding, see Builder.get_shards. The
+                workers read the items of their shards from the sources.
+            start_method (str): multiprocessing start method of the workers,
+                see WorkerPool
+            preload (list): modules preloaded by the forkserver, see WorkerPool
+        """
         # multiprocessing only if mpi is not used, no mixing
         self.num_workers = (num_workers if num_workers > 0
                             else multiprocessing.cpu_count() - 1)
-        super(MultiprocProcessor, self).__init__(builders)
+        self.batch_size = batch_size
+        self.result_batch_size = result_batch_size
+        self.shards_per_worker = shards_per_worker
+        self.start_method = start_method
+        self.preload = preload
+        self.pool = None
+        super(MultiprocProcessor, self).__init__(builders, max_pending_writes, resume)
         self.logger.info("Building with multiprocessing, {} workers in the pool"
                          .format(self.num_workers))
 
-    def process(self, builder_id):
+    def start(self):
+        if self.pool is None:
+            self.pool = WorkerPool(self.builders, self.num_workers, self.result_batch_size,
+                                   self.start_method, self.preload)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def process(self, builder_id, num_workers=None):
         """
         Run the builder using the builtin multiprocessing.
         Adapted from pymatgen-db
 
         Args:
             builder_id (int): the index of the builder in the builders list
+            num_workers (int): share of the worker pool used by the builder, when
+                several builders run at the same time: at most num_workers of
+                its tasks are sent to the pool and not done yet. Defaults to
+                the whole pool.
         """
         builder = self.builders[builder_id]
-        chunk_size = builder.chunk_size
-        # Need <=len(self.builders) queues, etc. iff want Runner to run
-        # builders in parallel. Holding off for now for simplicity.
-        self._queue = multiprocessing.Queue(chunk_size)
-        manager = multiprocessing.Manager()
-        self.processed_items = manager.list()
 
         # establish connection to the sources and targets
         builder.connect()
 
-        processes = self._start_worker_processes()
-        # send items to process
-        cursor = builder.get_items()
-        for n, item in enumerate(cursor):
-            if n == 0:
-                self.logger.info(
-                    "Waiting for {} processed items before updating targets"
-                    .format(chunk_size))
-            if len(self.processed_items) >= chunk_size:
-                builder.update_targets(self.processed_items[:chunk_size])
-                del self.processed_items[:chunk_size]
-                self.logger.info(
-                    "Waiting for {} processed items before updating targets"
-                    .format(chunk_size))
-            packet = (builder_id, item)
-            self._queue.put(packet)  # blocks when queue is full
-
-        for _ in range(self.num_workers):
-            self._queue.put(None)
-
-        # handle the leftovers
-        status = []
-        for p in processes:
-            p.join()
-            status.append(not bool(p.exitcode))
-        while len(self.processed_items):
-            builder.update_targets(self.processed_items[:chunk_size])
-            del self.processed_items[:chunk_size]
-            self.logger.info(
-                "Waiting for {} processed items before updating targets"
-                .format(chunk_size))
+        own_pool = self.pool is None
+        if own_pool:
+            self.start()
+        try:
+            self._process(builder_id, builder, num_workers)
+        finally:
+            if own_pool:
+                self.close()
+
+    def _process(self, builder_id, builder, num_workers=None):
+        sizer = BatchSizer(self.batch_size)
+        chunker = target_chunker(builder)
+        shards = builder.get_shards(self.shards_per_worker * self.num_workers)
+        if shards is None:
+            cursor = builder.get_items()
+            checkpoint = Checkpoint(builder, self.resume)
+        else:
+            self.logger.info("Sending {} shards to the workers".format(len(shards)))
+            if self.resume:
+                self.logger.warning("Sharded builds cannot be resumed, building all shards")
+            cursor, checkpoint = None, None
+        writer = TargetWriter(builder, self.max_pending_writes, checkpoint)
+        job = self.pool.open_job(builder_id)
+        self.logger.info(
+            "Waiting for {} processed items before updating targets"
+            .format(builder.chunk_size))
+        try:
+            if shards is None:
+                work = item_batches(checkpoint.skip(cursor), checkpoint, sizer)
+            else:
+                work = ((None, Shard(shard)) for shard in shards)
+            # send items to process in batches
+            for start, batch in work:
+                put_chunks(writer, job.collect(chunker, sizer))
+                while num_workers and job.n_sent - job.n_done >= num_workers:
+                    put_chunks(writer, job.collect(chunker, sizer, block=True))
+                job.put(start, batch)  # blocks when queue is full
+            while job.n_done < job.n_sent:
+                put_chunks(writer, job.collect(chunker, sizer, block=True))
+        except Exception:
+            writer.close(raise_error=False)
+            raise
+        finally:
+            job.close()
+
+        if len(chunker):
+            put_chunks(writer, [chunker.flush()])
+        writer.close()
+        builder.update_watermarks()
+        if checkpoint is not None:
+            checkpoint.clear()
 
         # finalize
-        if not all(status):
-            self.logger.error("Some worker processes exited abnormally.")
         builder.finalize(cursor)
 
-    def _start_worker_processes(self):
-        """
-        Start worker pool for processing items.
-        """
-        processes = []
-
-        # start the workers
-        for i in range(self.num_workers):
-            proc = multiprocessing.Process(target=self.worker)
-            proc.start()
-            processes.append(proc)
-
-        return processes
-
-    def worker(self):
-        """
-        Call the builder's process_item method and put the processed item in the shared dict.
-        """
-        while True:
-            try:
-                packet = self._queue.get()
-                if packet is None:
-                    break
-                builder_id, item = packet
-                processed_item = self.builders[builder_id].process_item(item)
-                self.processed_items.append(processed_item)
-            except queue.Empty:
-                break
-
 
 class Runner(MSONable):
 
-    def __init__(self, builders, num_workers=0, processor=None):
+    #: processors that can be selected by name
+    PROCESSORS = {"serial": SerialProcessor, "multiproc": MultiprocProcessor,
+                  "mpi": MPIProcessor, "mpi_collective": MPICollectiveProcessor,
+                  "thread": ThreadPoolProcessor, "async": AsyncProcessor}
+
+    def __init__(self, builders, num_workers=0, processor=None, max_parallel_builders=1,
+                 resume=False):
         """
         Initialize with a list of builders
 
         Args:
             builders(list): list of builders
-            num_workers (int): number of processes. Used only for multiprocessing.
-                Will be automatically set to (number of cpus - 1) if set to 0.
-            processor(BaseProcessor): set this if custom processor is needed(must
-                subclass BaseProcessor though)
+            num_workers (int): number of processes, or threads for the "thread"
+                processor. Will be automatically set if set to 0.
+            processor(BaseProcessor or str): set this if custom processor is
+                needed (must subclass BaseProcessor though), or the name of a
+                processor in PROCESSORS. Defaults to "mpi" when running under
+                MPI with several ranks, "multiproc" otherwise.
+            max_parallel_builders (int): maximum number of builders to run at the
+                same time. Builders run in parallel as soon as the builders they
+                depend on are done, if the processor supports it. The worker
+                processes are shared among the running builders.
+            resume (bool): resume the builders from the checkpoints of an
+                interrupted run, see Checkpoint.
         """
         self.builders = builders
         self.num_workers = num_workers
+        self.max_parallel_builders = max_parallel_builders
+        self.resume = resume
         self.logger = logging.getLogger(type(self).__name__)
         self.logger.addHandler(logging.NullHandler())
-        default_processor = MPIProcessor(builders) if self.use_mpi else MultiprocProcessor(builders, num_workers)
-        self.processor = default_processor if processor is None else processor
+        if processor is None:
+            processor = "mpi" if self.use_mpi else "multiproc"
+        if isinstance(processor, str):
+            processor = self._make_processor(processor)
+        self.processor = processor
+        if resume:
+            self.processor.resume = True
         self.dependency_graph = self._get_builder_dependency_graph()
         self.has_run = []  # for bookkeeping builder runs
 
+    def _make_processor(self, name):
+        """
+        Instantiate a processor by name, see PROCESSORS.
+        """
+        if name not in self.PROCESSORS:
+            raise ValueError("Unknown processor {}, choose from {}".format(
+                name, sorted(self.PROCESSORS)))
+        cls = self.PROCESSORS[name]
+        if cls in (MultiprocProcessor, ThreadPoolProcessor):
+            return cls(self.builders, self.num_workers)
+        return cls(self.builders)
+
     @property
     def use_mpi(self):
         try:
@@ -338,8 +1406,47 @@ class Runner(MSONable):
                 - update targets
                 - finalize aka cleanup(close all connections etc)
         """
-        for i in range(len(self.builders)):
-            self._build_dependencies(i)
+        self.processor.start()
+        try:
+            if self.max_parallel_builders > 1 and self.processor.supports_concurrency:
+                self._run_parallel()
+            else:
+                for i in range(len(self.builders)):
+                    self._build_dependencies(i)
+        finally:
+            self.processor.close()
+
+    def _run_parallel(self):
+        """
+        Run every builder whose dependencies are satisfied at the same time, up to
+        max_parallel_builders, splitting the worker budget among them.
+        """
+        budget = max(1, getattr(self.processor, "num_workers", self.max_parallel_builders))
+        pending = [i for i in range(len(self.builders)) if i not in self.has_run]
+        running = {}  # future: (builder_id, num_workers)
+        with ThreadPoolExecutor(self.max_parallel_builders) as executor:
+            while pending or running:
+                ready = [i for i in pending
+                         if all(j in self.has_run for j in self.dependency_graph.get(i, []))]
+                ready = ready[:self.max_parallel_builders - len(running)]
+                for k, i in enumerate(ready):
+                    if budget == 0:
+                        break
+                    # share the free workers among the builders being started
+                    num_workers = max(1, budget // (len(ready) - k))
+                    budget -= num_workers
+                    self.logger.info("building: {} with {} workers".format(i, num_workers))
+                    future = executor.submit(self.processor.process, i, num_workers=num_workers)
+                    running[future] = (i, num_workers)
+                    pending.remove(i)
+                if not running:
+                    raise RuntimeError("Cyclic dependencies between builders {}".format(pending))
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    builder_id, num_workers = running.pop(future)
+                    budget += num_workers
+                    future.result()
+                    self.has_run.append(builder_id)
 
     def _build_dependencies(self, builder_id):
         """
@@ -1,14 +1,25 @@
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import datetime
-import json
+import os
+import queue
+import threading
+import time
 
 import mongomock
 import pymongo
-from pymongo import MongoClient
+from pymongo import ReplaceOne
+from pymongo.errors import AutoReconnect, OperationFailure
 from pydash import identity
 
 from monty.json import MSONable
 
+from maggma.diskdb import DiskDatabase
+from maggma.helpers import client_registry, key_range_filters
+from maggma.memdb import MemoryDatabase
+from maggma.utils import get_mongolike, iter_json_objects
+
 
 class Store(MSONable, metaclass=ABCMeta):
     """
@@ -16,6 +27,9 @@ class Store(MSONable, metaclass=ABCMeta):
     Defines the interface for all data going in and out of a Builder
     """
 
+    #: _id of the meta document caching the lu_field high-water mark
+    _WATERMARK_ID = "lu_watermark"
+
     def __init__(self, lu_field='_lu', lu_key=(identity, identity)):
         """
         Args:
@@ -35,6 +49,21 @@ class Store(MSONable, metaclass=ABCMeta):
     def connect(self):
         pass
 
+    def close(self):
+        """
+        Release the resources (e.g. database connections) held by the store.
+        """
+        pass
+
+    @property
+    def connected(self):
+        """
+        Whether the store is connected and usable in the current process.
+        Default behavior is to check that there is a collection, which worker
+        processes forked after connect inherit.
+        """
+        return self.collection is not None
+
     def __call__(self):
         return self.collection
 
@@ -42,14 +71,59 @@ class Store(MSONable, metaclass=ABCMeta):
     def meta(self):
         return self.collection.db["{}.meta".format(self.collection.name)]
 
+    def ensure_lu_index(self):
+        """
+        Ensure an index on lu_field, so that last_updated and lu_filter queries
+        do not scan the collection.
+        """
+        try:
+            self.collection.create_index(self.lu_field)
+        except OperationFailure:
+            # e.g. read-only access, the queries still work without the index
+            pass
+
+    @property
+    def watermark(self):
+        """
+        The lu_field high-water mark recorded by update_watermark, or None.
+        """
+        doc = self.meta.find_one({"_id": self._WATERMARK_ID}, {"_id": 0})
+        if doc:
+            try:
+                return get_mongolike(doc, self.lu_field)
+            except KeyError:
+                pass
+        return None
+
     @property
     def last_updated(self):
+        """
+        The latest lu_field value of the documents in the store, from the
+        (indexed) collection. Unlike watermark, it goes back down when documents
+        are deleted, so that lu_filter picks them up again.
+        """
         doc = next(self.collection.find({}, {"_id": 0, self.lu_field: 1}).sort(
             [(self.lu_field, pymongo.DESCENDING)]).limit(1), None)
         # Handle when collection has docs but `NoneType` lu_field.
         return (doc[self.lu_field] if (doc and doc[self.lu_field])
                 else datetime.datetime.min)
 
+    def update_watermark(self, lu=None):
+        """
+        Cache the high-water mark of lu_field in the meta collection, see
+        Builder.get_watermark. The cached value never decreases.
+
+        Args:
+            lu: lu_field value to record, as stored in the documents. If None,
+                the latest lu_field value in the collection is recorded.
+        """
+        if lu is None:
+            lu = self.last_updated
+            if lu == datetime.datetime.min:
+                return
+        self.meta.update_one({"_id": self._WATERMARK_ID},
+                             {"$max": {self.lu_field: lu}}, upsert=True)
+
     def lu_filter(self, targets):
         """Creates a MongoDB filter for new documents.
 
@@ -66,6 +140,60 @@ class Store(MSONable, metaclass=ABCMeta):
         lu_list = [t.last_updated for t in targets]
         return {self.lu_field: {"$gt": self.lu_key[1](max(lu_list))}}
 
+    def key_ranges(self, key, n, criteria=None):
+        """
+        Split the documents into at most n contiguous ranges of key values with
+        about the same number of documents, e.g. to let workers read their part
+        of the collection themselves. The key values must be of a single type,
+        see helpers.key_range_filters.
+
+        Args:
+            key (str): field to split on
+            n (int): number of ranges
+            criteria (dict): restrict the documents to those matching it
+
+        Returns:
+            list: a criteria dict selecting the documents of each range
+        """
+        return key_range_filters(self.collection, key, n, criteria)
+
+    def update(self, docs, key, batch_size=1000, ordered=False, retries=3):
+        """
+        Bulk upsert documents, replacing any existing document with the same key.
+
+        The documents are sent as bulk_write operations of batch_size documents.
+        A batch that fails with a transient (AutoReconnect) error is retried,
+        which is safe since replacing a document is idempotent.
+
+        Args:
+            docs ([dict]): documents to write
+            key (str or [str]): field(s) identifying a document, dot-notation
+                is supported
+            batch_size (int): number of documents per bulk_write call
+            ordered (bool): whether the writes of a batch must be done in order,
+                stopping at the first error
+            retries (int): number of times a batch is retried on transient errors
+        """
+        keys = [key] if isinstance(key, str) else list(key)
+        batch = []
+        for doc in docs:
+            criteria = {k: get_mongolike(doc, k) for k in keys}
+            batch.append(ReplaceOne(criteria, doc, upsert=True))
+            if len(batch) == batch_size:
+                self._bulk_write(batch, ordered, retries)
+                batch = []
+        if batch:
+            self._bulk_write(batch, ordered, retries)
+
+    def _bulk_write(self, requests, ordered, retries):
+        for attempt in range(retries + 1):
+            try:
+                return self.collection.bulk_write(requests, ordered=ordered)
+            except AutoReconnect:
+                if attempt == retries:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+
     def __eq__(self, other):
         return hash(self) == hash(other)
 
@@ -101,6 +229,8 @@ class MongoStore(Store):
         self.username = username
         self.password = password
         self.__collection = None
+        self.__client = None
+        self.__pid = None
         self.kwargs = kwargs
         super(MongoStore, self).__init__(**kwargs)
 
@@ -108,12 +238,39 @@ class MongoStore(Store):
     def collection(self):
         return self.__collection
 
+    @property
+    def connected(self):
+        """
+        Whether the store was connected in the current process: a MongoClient
+        inherited from the parent of a forked process is not fork-safe.
+        """
+        return self.__client is not None and self.__pid == os.getpid()
+
     def connect(self):
-        conn = MongoClient(self.host, self.port)
-        db = conn[self.database]
-        if self.username is not "":
+        """
+        Connect with a MongoClient shared with the other stores on the same
+        server, see helpers.ClientRegistry. In a forked process, the client
+        inherited from the parent is replaced (it still belongs to the parent,
+        so it is not released).
+        """
+        if self.connected:
+            return
+        self.__pid = os.getpid()
+        self.__client = client_registry.acquire(self.host, self.port, self.username,
+                                                self.password, self.database)
+        db = self.__client[self.database]
+        if self.username != "":
             db.authenticate(self.username, self.password)
         self.__collection = db[self.collection_name]
+        self.ensure_lu_index()
+
+    def close(self):
+        """
+        Release the shared MongoClient, it is closed once no store uses it.
+        """
+        if self.connected:
+            client_registry.release(self.__client)
+        self.__client = None
 
     def __hash__(self):
         return hash((self.collection_name, self.lu_field))
@@ -124,8 +281,18 @@ class MemoryStore(Store):
     An in memory Store
     """
 
-    def __init__(self, name, **kwargs):
+    def __init__(self, name, engine="mongomock", **kwargs):
+        """
+        Args:
+            name (str): collection name
+            engine (str): "mongomock", or "native" for the engine of maggma.memdb,
+                which has indexes and does not deep copy documents on reads.
+            lu_field (str): see Store doc
+        """
+        if engine not in ("mongomock", "native"):
+            raise ValueError("Unknown MemoryStore engine: {}".format(engine))
         self.name = name
+        self.engine = engine
         self.__collection = None
         self.kwargs = kwargs
         super(MemoryStore, self).__init__(**kwargs)
@@ -135,30 +302,142 @@ class MemoryStore(Store):
         return self.__collection
 
     def connect(self):
-        self.__collection = mongomock.MongoClient().db[self.name]
+        if self.engine == "native":
+            self.__collection = MemoryDatabase()[self.name]
+        else:
+            self.__collection = mongomock.MongoClient().db[self.name]
+        self.ensure_lu_index()
 
     def __hash__(self):
         return hash((self.name, self.lu_field))
 
 
+class DiskStore(Store):
+    """
+    A Store persisted in a local directory, without a running MongoDB.
+    Documents live in an append-only, memory-mapped file with persistent
+    indexes (see maggma.diskdb), so reconnecting does not re-ingest anything.
+    Only the first process to connect writes the directory, the others (e.g.
+    the workers of a processor) read it.
+    """
+
+    def __init__(self, path, collection_name, key=None, **kwargs):
+        """
+        Args:
+            path (str): directory of the database
+            collection_name (str): collection name
+            key (str): field to index, e.g. the key used with Store.update
+            lu_field (str): see Store doc
+        """
+        self.path = path
+        self.collection_name = collection_name
+        self.key = key
+        self.__collection = None
+        self.kwargs = kwargs
+        super(DiskStore, self).__init__(**kwargs)
+
+    @property
+    def collection(self):
+        return self.__collection
+
+    def connect(self):
+        self.__collection = DiskDatabase.open(self.path)[self.collection_name]
+        if self.key:
+            self.__collection.create_index(self.key)
+        self.ensure_lu_index()
+
+    def close(self):
+        """
+        Flush the documents and indexes to disk.
+        """
+        if self.__collection is not None:
+            self.__collection.database.close()
+
+    def __hash__(self):
+        return hash((self.path, self.collection_name, self.lu_field))
+
+
 class JSONStore(MemoryStore):
     """
     A Store for access to a single or multiple JSON files
     """
 
-    def __init__(self, paths, **kwargs):
+    def __init__(self, paths, batch_size=1000, num_threads=None, **kwargs):
+        """
+        Args:
+            paths (str or [str]): paths to the JSON files. Each file holds a JSON
+                array of documents, a single document or a sequence of documents
+                (e.g. JSON-lines), optionally gzip, bz2 or xz compressed.
+            batch_size (int): number of documents inserted at a time
+            num_threads (int): number of files read in parallel, defaults to
+                the number of cpus
+        """
         paths = paths if isinstance(paths, (list, tuple)) else [paths]
         self.paths = paths
-        self.kwargs = kwargs
+        self.batch_size = batch_size
+        self.num_threads = num_threads
         super(JSONStore, self).__init__("collection", **kwargs)
+        # after MemoryStore.__init__, which sets the kwargs without engine
+        self.kwargs = kwargs
 
     def connect(self):
+        """
+        Stream the documents of the files into the collection. The files are
+        parsed incrementally, on several threads, and the documents inserted in
+        batches, so memory use does not grow with the size of the files.
+        """
         super(JSONStore, self).connect()
-        for path in self.paths:
-            with open(path) as f:
-                objects = list(json.load(f))
-                objects = [objects] if not isinstance(objects, list) else objects
-                self.collection.insert_many(objects)
+        num_threads = min(len(self.paths), self.num_threads or os.cpu_count() or 1)
+        if num_threads <= 1:
+            for path in self.paths:
+                for batch in self._read_batches(path):
+                    self.collection.insert_many(batch)
+            return
+
+        batches = queue.Queue(2 * num_threads)
+        # set if the inserts fail, so that the readers stop instead of waiting
+        # forever for room in the queue
+        stop = threading.Event()
+
+        def put(batch):
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def read(path):
+            try:
+                for batch in self._read_batches(path):
+                    if stop.is_set():
+                        return
+                    put(batch)
+            finally:
+                put(None)
+
+        with ThreadPoolExecutor(num_threads) as executor:
+            futures = [executor.submit(read, path) for path in self.paths]
+            try:
+                n_done = 0
+                while n_done < len(futures):
+                    batch = batches.get()
+                    if batch is None:
+                        n_done += 1
+                    else:
+                        self.collection.insert_many(batch)
+            finally:
+                stop.set()
+            for future in futures:
+                future.result()
+
+    def _read_batches(self, path):
+        docs = iter_json_objects(path)
+        while True:
+            batch = list(islice(docs, self.batch_size))
+            if not batch:
+                break
+            yield batch
 
     def __hash__(self):
         return hash((*self.paths, self.lu_field))
@@ -168,10 +447,11 @@ class DatetimeStore(MemoryStore):
     """Utility store intended for use with `Store.lu_filter`."""
 
     def __init__(self, dt, **kwargs):
-        self.__dt = dt
-        self.kwargs = kwargs
+        self.dt = dt
         super(DatetimeStore, self).__init__("date", **kwargs)
+        # after MemoryStore.__init__, which sets the kwargs without engine
+        self.kwargs = kwargs
 
     def connect(self):
         super(DatetimeStore, self).connect()
-        self.collection.insert_one({self.lu_field: self.__dt})
+        self.collection.insert_one({self.lu_field: self.dt})
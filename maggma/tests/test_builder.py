@@ -0,0 +1,87 @@
+import datetime
+import shutil
+import tempfile
+import unittest
+
+from maggma.builder import Builder
+from maggma.runner import SerialProcessor
+from maggma.stores import DiskStore
+
+
+class DoublingBuilder(Builder):
+
+    def __init__(self, source, target, **kwargs):
+        super(DoublingBuilder, self).__init__([source], [target], chunk_size=4, **kwargs)
+        self.source, self.target = source, target
+        self.built = []
+
+    def get_items(self):
+        for key in self.get_new_keys():
+            yield self.source.collection.find_one({"task_id": key}, {"_id": 0})
+
+    def process_item(self, item):
+        return {"task_id": item["task_id"], "value": 2 * item["value"]}
+
+    def update_targets(self, items):
+        self.built.extend(item["task_id"] for item in items)
+        self.target.update(items, key="task_id")
+
+
+class CrashingBuilder(DoublingBuilder):
+
+    def process_item(self, item):
+        if item["task_id"] == 5:
+            raise ValueError("crash")
+        return super(CrashingBuilder, self).process_item(item)
+
+
+class TestIncrementalBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source, self.target = DiskStore(self.path, "source"), DiskStore(self.path, "target")
+        self.source.connect()
+        t0 = datetime.datetime(2017, 1, 1)
+        self.source.collection.insert_many(
+            [{"task_id": i, "value": i, "_lu": t0 + datetime.timedelta(days=i)} for i in range(10)])
+
+    def tearDown(self):
+        self.source.close()
+        shutil.rmtree(self.path)
+
+    def build(self, incremental=True):
+        builder = DoublingBuilder(self.source, self.target, incremental=incremental)
+        SerialProcessor([builder]).process(0)
+        return builder
+
+    def test_incremental(self):
+        builder = self.build()
+        self.assertEqual(builder.built, list(range(10)))
+        self.assertEqual(self.target.watermark, builder.build_start)
+        doc = self.target.collection.find_one({"task_id": 3})
+        self.assertEqual((doc["value"], doc["_lu"]), (6, builder.build_start))
+
+        self.assertEqual(self.build().built, [])
+        self.source.collection.update_many({"task_id": {"$in": [2, 7]}},
+                                           {"$set": {"value": 0, "_lu": datetime.datetime.utcnow()}})
+        self.assertEqual(self.build().built, [2, 7])
+        self.assertEqual(self.target.collection.find_one({"task_id": 7})["value"], 0)
+        self.assertEqual(self.build(incremental=False).built, list(range(10)))
+
+    def test_interrupted(self):
+        builder = self.build()
+        self.source.collection.update_many({}, {"$set": {"_lu": datetime.datetime.utcnow()}})
+        crashing = CrashingBuilder(self.source, self.target, incremental=True)
+        self.assertRaises(ValueError, SerialProcessor([crashing]).process, 0)
+        self.assertEqual(crashing.built, [0, 1, 2, 3])
+        # the items written before the crash do not advance the watermark
+        self.assertEqual(self.target.watermark, builder.build_start)
+        self.assertEqual(self.build().built, list(range(10)))
+
+    def test_new_keys(self):
+        other = DiskStore(self.path, "other")
+        other.connect()
+        other.collection.insert_many([{"task_id": i} for i in (12, 3, 11, 3)] + [{"value": 1}])
+        builder = DoublingBuilder(self.source, self.target)
+        builder.sources.append(other)
+        self.assertEqual(list(builder.get_new_keys()), list(range(10)) + [11, 12])
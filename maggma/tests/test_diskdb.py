@@ -0,0 +1,124 @@
+import datetime
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymongo import DESCENDING
+
+from maggma.diskdb import DiskDatabase, RecordFile
+from maggma.stores import DiskStore
+
+
+def read_and_write(path):
+    coll = DiskDatabase.open(path)["test"]
+    try:
+        coll.insert_one({"task_id": -1})
+    except PermissionError:
+        return coll.count_documents({}), False
+    return coll.count_documents({}), True
+
+
+class TestDiskCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.t0 = datetime.datetime(2017, 1, 1)
+        self.docs = [{"task_id": i, "_lu": self.t0 + datetime.timedelta(days=i),
+                      "data": {"x": list(range(i))}} for i in range(50)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_persistence(self):
+        coll = DiskDatabase(self.path)["test"]
+        coll.create_index("task_id", unique=True)
+        coll.insert_many([dict(d) for d in self.docs])
+        coll.update_one({"task_id": 3}, {"$set": {"data.x": "updated"}})
+        coll.delete_many({"task_id": {"$gte": 40}})
+        coll.close()
+
+        coll = DiskDatabase(self.path)["test"]
+        self.assertEqual(coll.count_documents({}), 40)
+        self.assertIn("task_id_1", coll.index_information())
+        self.assertEqual(coll.find_one({"task_id": 3})["data"]["x"], "updated")
+        self.assertEqual(coll.find_one({"task_id": 5}, {"_id": 0}), self.docs[5])
+
+        # records appended after the last flush are replayed
+        coll.insert_one({"task_id": 100})
+        coll.delete_one({"task_id": 0})
+        coll._docs.records.flush()
+        coll = DiskDatabase(self.path)["test"]
+        self.assertEqual(coll.count_documents({}), 40)
+        self.assertEqual(coll.find_one({"task_id": 100})["task_id"], 100)
+        self.assertEqual(coll.find_one({"task_id": 0}), None)
+
+    def test_truncated_record(self):
+        coll = DiskDatabase(self.path)["test"]
+        coll.insert_many([dict(d) for d in self.docs[:3]])
+        coll.close()
+        with open(os.path.join(self.path, "test.records"), "ab") as f:
+            f.write(b"\x00\x40\x00\x00")
+        coll = DiskDatabase(self.path)["test"]
+        self.assertEqual(coll.count_documents({}), 3)
+        coll.insert_one({"task_id": 3})
+        coll.close()
+        self.assertEqual(DiskDatabase(self.path)["test"].count_documents({}), 4)
+
+    def test_forked_reader(self):
+        coll = DiskDatabase.open(self.path)["test"]
+        coll.insert_many([dict(d) for d in self.docs[:3]])
+        coll.flush()
+        coll.insert_one({"task_id": 3})
+        # a record the writer is appending
+        records = coll._docs.records
+        records._file.write(RecordFile.DOC + b"\x40\x00")
+        records._file.flush()
+        size = os.path.getsize(records.path)
+        with multiprocessing.get_context("fork").Pool(1) as pool:
+            self.assertEqual(pool.apply(read_and_write, (self.path,)), (4, False))
+        self.assertEqual(os.path.getsize(records.path), size)
+        self.assertTrue(records.writable)
+
+    def test_compact(self):
+        coll = DiskDatabase(self.path)["test"]
+        coll.insert_many([dict(d) for d in self.docs])
+        for i in range(10):
+            coll.replace_one({"task_id": i}, {"task_id": i, "replaced": True})
+        coll.flush()
+        size = os.path.getsize(os.path.join(self.path, "test.records"))
+        coll.compact()
+        self.assertLess(os.path.getsize(os.path.join(self.path, "test.records")), size)
+        self.assertEqual(DiskDatabase(self.path)["test"].count_documents({"replaced": True}), 10)
+
+
+class TestDiskStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store(self):
+        store = DiskStore(self.path, "tasks", key="task_id")
+        store.connect()
+        t0 = datetime.datetime(2017, 1, 1)
+        store.update([{"task_id": i, "_lu": t0 + datetime.timedelta(days=i)} for i in range(10)],
+                     key="task_id")
+        store.update_watermark()
+        self.assertEqual(store.meta.name, store.collection.name + ".meta")
+        store.close()
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ["LOCK", "tasks.index", "tasks.meta.index", "tasks.meta.records",
+                          "tasks.records"])
+
+        store = DiskStore(self.path, "tasks", key="task_id")
+        store.connect()
+        self.assertEqual(set(store.collection.index_information()),
+                         {"_id_", "task_id_1", "_lu_1"})
+        self.assertEqual(store.last_updated, t0 + datetime.timedelta(days=9))
+        doc = next(store.collection.find().sort([("_lu", DESCENDING)]).limit(1))
+        self.assertEqual(doc["task_id"], 9)
+        store.close()
@@ -0,0 +1,118 @@
+import datetime
+import unittest
+
+import mongomock
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, UpdateOne, InsertOne, DeleteOne
+from pymongo.errors import DuplicateKeyError
+
+from maggma.memdb import MemoryDatabase
+from maggma.stores import MemoryStore
+
+
+def make_docs():
+    t0 = datetime.datetime(2017, 1, 1)
+    docs = []
+    for i in range(30):
+        doc = {"task_id": i, "name": "mat-{:02d}".format(i % 7), "energy": (i % 5) - 2.5,
+               "_lu": t0 + datetime.timedelta(days=i), "tags": ["a", "b"] if i % 2 else ["c"],
+               "output": {"gap": i / 10.0, "sites": [{"el": "Si"}, {"el": "O" if i % 3 else "C"}]}}
+        if i % 4 == 0:
+            del doc["energy"]
+        docs.append(doc)
+    return docs
+
+
+class TestMemoryCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.native = MemoryDatabase()["test"]
+        self.mock = mongomock.MongoClient().db["test"]
+        for coll in (self.native, self.mock):
+            coll.insert_many(make_docs())
+        self.native.create_index("task_id", unique=True)
+        self.native.create_index("_lu")
+        self.native.create_index("name")
+
+    def assertSameResults(self, query, projection=None, sort=None, limit=0):
+        results = []
+        for coll in (self.native, self.mock):
+            cursor = coll.find(query, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            if limit:
+                cursor = cursor.limit(limit)
+            results.append([{k: v for k, v in d.items() if k != "_id"} for d in cursor])
+        if not sort:
+            results = [sorted(r, key=lambda d: d.get("task_id", -1)) for r in results]
+        self.assertEqual(results[0], results[1], "query {}".format(query))
+
+    def test_queries(self):
+        t = datetime.datetime(2017, 1, 10)
+        for query in [{}, {"task_id": 3}, {"task_id": {"$in": [1, 2, 40]}},
+                      {"name": "mat-03"}, {"_lu": {"$gt": t}}, {"_lu": {"$gte": t, "$lt": t.replace(day=20)}},
+                      {"energy": {"$exists": False}}, {"energy": {"$lte": -0.5}},
+                      {"energy": None}, {"tags": "a"}, {"tags": {"$nin": ["c"]}},
+                      {"output.gap": {"$gt": 1.5}}, {"output.sites.el": "C"},
+                      {"output.sites.1.el": "O"}, {"task_id": {"$ne": 2}, "name": {"$ne": "mat-01"}},
+                      {"$or": [{"task_id": 1}, {"name": "mat-02"}]},
+                      {"$and": [{"task_id": {"$gt": 5}}, {"task_id": {"$lt": 9}}]},
+                      {"$nor": [{"task_id": {"$gt": 5}}]}, {"name": {"$gt": 3}}]:
+            self.assertSameResults(query)
+
+    def test_projection_sort_limit(self):
+        self.assertSameResults({}, {"task_id": 1, "output.gap": 1})
+        self.assertSameResults({}, {"_id": 0, "output": 0, "tags": 0})
+        self.assertSameResults({}, sort=[("_lu", DESCENDING)], limit=3)
+        self.assertSameResults({"name": "mat-01"}, sort=[("task_id", DESCENDING)])
+        self.assertSameResults({}, sort=[("name", ASCENDING), ("task_id", DESCENDING)])
+        self.assertSameResults({}, sort=[("energy", ASCENDING), ("task_id", ASCENDING)])
+        self.assertEqual(self.native.distinct("name", {"task_id": {"$lt": 3}}),
+                         ["mat-00", "mat-01", "mat-02"])
+        self.assertEqual(self.native.count_documents({"tags": "c"}), 15)
+
+    def test_writes(self):
+        for coll in (self.native, self.mock):
+            coll.update_one({"task_id": 1}, {"$set": {"output.gap": 9.0, "new": 1}, "$inc": {"energy": 2}})
+            coll.update_many({"name": "mat-02"}, {"$unset": {"tags": 1}})
+            coll.replace_one({"task_id": 2}, {"task_id": 2, "replaced": True})
+            coll.replace_one({"task_id": 100}, {"task_id": 100}, upsert=True)
+            coll.update_one({"task_id": 101}, {"$max": {"_lu": datetime.datetime(2000, 1, 1)}},
+                            upsert=True)
+            coll.delete_many({"task_id": {"$gt": 25, "$lt": 100}})
+            coll.delete_one({"name": "mat-03"})
+            coll.bulk_write([InsertOne({"task_id": 200}), ReplaceOne({"task_id": 5}, {"task_id": 5}),
+                             UpdateOne({"task_id": 6}, {"$min": {"energy": -10}}),
+                             DeleteOne({"task_id": 7})], ordered=False)
+        self.assertSameResults({})
+        self.assertSameResults({"_lu": {"$lt": datetime.datetime(2017, 1, 10)}})
+        self.assertSameResults({"name": "mat-02"})
+
+    def test_isolation(self):
+        doc = self.native.find_one({"task_id": 1})
+        doc["name"] = "changed"
+        self.assertEqual(self.native.find_one({"task_id": 1})["name"], "mat-01")
+        self.assertEqual(self.native.find_one({"name": "changed"}), None)
+
+    def test_unique(self):
+        self.assertRaises(DuplicateKeyError, self.native.insert_one, {"task_id": 1})
+        self.assertRaises(DuplicateKeyError, self.native.update_one,
+                          {"task_id": 2}, {"$set": {"task_id": 1}})
+        self.assertEqual(self.native.count_documents({"task_id": 2}), 1)
+        self.assertEqual(self.native.count_documents({}), 30)
+
+
+class TestNativeMemoryStore(unittest.TestCase):
+
+    def test_store(self):
+        store = MemoryStore("collection", engine="native")
+        store.connect()
+        self.assertEqual(store.meta.name, store.collection.name + ".meta")
+        self.assertIs(store.meta.db, store.collection.db)
+        self.assertIn("_lu_1", store.collection.index_information())
+        docs = make_docs()
+        store.update(docs, key="task_id")
+        self.assertEqual(store.last_updated, docs[-1]["_lu"])
+        store.update_watermark()
+        self.assertEqual(store.meta.find_one()["_lu"], docs[-1]["_lu"])
+        lu_filter = {"_lu": {"$gt": docs[-3]["_lu"]}}
+        self.assertEqual(store.collection.count_documents(lu_filter), 2)
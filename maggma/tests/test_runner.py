@@ -1,11 +1,19 @@
+import asyncio
+import datetime
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 import json
 
 from maggma.helpers import get_database
-from maggma.stores import MemoryStore
+from maggma.stores import MemoryStore, DiskStore
 from maggma.builder import Builder
-from maggma.runner import Runner
+from maggma.runner import Runner, SerialProcessor, MultiprocProcessor, BatchSizer, TargetWriter, \
+    Checkpoint, MPICollectiveProcessor, ThreadPoolProcessor, AsyncProcessor, PoolJob
 
 __author__ = 'Kiran Mathew'
 __email__ = 'kmathew@lbl.gov'
@@ -42,3 +50,455 @@ class TestRunner(unittest.TestCase):
         ans = {1: [0]}
         self.assertDictEqual(rnr.dependency_graph, ans)
 
+
+class CountingBuilder(Builder):
+
+    def __init__(self, N, sources, targets, chunk_size=3):
+        super(CountingBuilder, self).__init__(sources, targets, chunk_size)
+        self.N = N
+        self.chunks = []
+
+    def get_items(self):
+        for i in range(self.N):
+            yield i
+
+    def process_item(self, item):
+        return 2 * item
+
+    def update_targets(self, items):
+        self.chunks.append(list(items))
+
+    def finalize(self, cursor=None):
+        pass
+
+
+class LookupBuilder(CountingBuilder):
+
+    def process_item(self, item):
+        return self.sources[0].collection.find_one({"task_id": item})["value"]
+
+
+class TestMultiprocProcessor(unittest.TestCase):
+
+    def test_process(self):
+        builder = CountingBuilder(20, [MemoryStore("src")], [MemoryStore("tgt")])
+        proc = MultiprocProcessor([builder], num_workers=2, result_batch_size=4)
+        proc.process(0)
+        processed = [i for chunk in builder.chunks for i in chunk]
+        self.assertEqual(sorted(processed), [2 * i for i in range(20)])
+        self.assertTrue(all(len(chunk) <= 3 for chunk in builder.chunks))
+
+    def test_process_batched(self):
+        for batch_size in (5, 0):
+            builder = CountingBuilder(23, [MemoryStore("src")], [MemoryStore("tgt")])
+            proc = MultiprocProcessor([builder], num_workers=2, batch_size=batch_size)
+            proc.process(0)
+            processed = [i for chunk in builder.chunks for i in chunk]
+            self.assertEqual(sorted(processed), [2 * i for i in range(23)])
+
+    def test_persistent_pool(self):
+        builders = [CountingBuilder(n, [MemoryStore("src")], [MemoryStore("tgt")]) for n in (7, 11)]
+        proc = MultiprocProcessor(builders, num_workers=2)
+        proc.start()
+        try:
+            pool = proc.pool
+            proc.process(0)
+            proc.process(1)
+            self.assertIs(proc.pool, pool)
+        finally:
+            proc.close()
+        self.assertIsNone(proc.pool)
+        for n, builder in zip((7, 11), builders):
+            self.assertEqual(sorted(i for c in builder.chunks for i in c), [2 * i for i in range(n)])
+
+    def test_worker_budget(self):
+        builder = CountingBuilder(20, [MemoryStore("src")], [MemoryStore("tgt")])
+        proc = MultiprocProcessor([builder], num_workers=3)
+        in_flight = []
+        put = PoolJob.put
+
+        def recording_put(job, start, work):
+            in_flight.append(job.n_sent - job.n_done)
+            put(job, start, work)
+
+        with mock.patch.object(PoolJob, "put", recording_put):
+            proc.process(0, num_workers=1)
+        self.assertEqual(max(in_flight), 0)
+        self.assertEqual(sorted(i for c in builder.chunks for i in c), [2 * i for i in range(20)])
+
+    def test_connect_sources(self):
+        # the pool is started before the builder connects, the workers
+        # connect the sources themselves
+        path = tempfile.mkdtemp()
+        try:
+            source = DiskStore(path, "src")
+            source.connect()
+            source.collection.insert_many([{"task_id": i, "value": 3 * i} for i in range(10)])
+            source.close()
+            builder = LookupBuilder(10, [DiskStore(path, "src")], [MemoryStore("tgt")])
+            proc = MultiprocProcessor([builder], num_workers=2)
+            proc.start()
+            try:
+                proc.process(0)
+            finally:
+                proc.close()
+            self.assertEqual(sorted(i for c in builder.chunks for i in c), [3 * i for i in range(10)])
+        finally:
+            shutil.rmtree(path)
+
+    def test_spawn(self):
+        builder = CountingBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")])
+        MultiprocProcessor([builder], num_workers=2, start_method="spawn").process(0)
+        self.assertEqual(sorted(i for c in builder.chunks for i in c), [2 * i for i in range(10)])
+
+    def test_error(self):
+        builder = FailingBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")])
+        proc = MultiprocProcessor([builder], num_workers=2)
+        self.assertRaises(ValueError, proc.process, 0)
+        self.assertIsNone(proc.pool)
+
+
+class TestBatchSizer(unittest.TestCase):
+
+    def test_fixed(self):
+        sizer = BatchSizer(10)
+        sizer.record(10, 5.0)
+        self.assertEqual(sizer.size, 10)
+
+    def test_adaptive(self):
+        sizer = BatchSizer(0, target_time=0.1, max_batch_size=500)
+        self.assertEqual(sizer.size, 1)
+        sizer.record(1, 0.001)
+        self.assertEqual(sizer.size, 100)
+        sizer.record(100, 0.0)
+        self.assertEqual(sizer.size, 125)
+        sizer.record(10, 10.0)
+        self.assertEqual(sizer.size, 1)
+
+
+class ConcurrencyProbe:
+    """
+    Counts the process_item calls in flight. Each call waits until `expected`
+    calls are in flight, or until a deadline, so that the peak count is the
+    concurrency of the processor, whatever the speed of the machine.
+    """
+
+    def __init__(self, expected, timeout=10):
+        self.expected = expected
+        self.in_flight = self.peak = 0
+        self.deadline = time.time() + timeout
+        self.condition = threading.Condition()
+
+    def _enter(self):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+
+    def wait(self):
+        with self.condition:
+            self._enter()
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: self.peak >= self.expected, self.deadline - time.time())
+            self.in_flight -= 1
+
+    async def async_wait(self):
+        self._enter()
+        while self.peak < self.expected and time.time() < self.deadline:
+            await asyncio.sleep(0.001)
+        self.in_flight -= 1
+
+
+class BlockingBuilder(CountingBuilder):
+
+    def process_item(self, item):
+        self.probe.wait()
+        return 2 * item
+
+
+class AsyncBuilder(CountingBuilder):
+
+    async def process_item(self, item):
+        await self.probe.async_wait()
+        if item == self.fail_at:
+            raise ValueError("cannot process")
+        return 2 * item
+
+
+class TestIOProcessors(unittest.TestCase):
+
+    def test_thread_pool(self):
+        builder = BlockingBuilder(40, [MemoryStore("src")], [MemoryStore("tgt")])
+        builder.probe = ConcurrencyProbe(20)
+        ThreadPoolProcessor([builder], num_workers=20).process(0)
+        self.assertEqual(builder.probe.peak, 20)
+        self.assertEqual(sorted(i for c in builder.chunks for i in c), [2 * i for i in range(40)])
+        self.assertTrue(all(len(chunk) <= 3 for chunk in builder.chunks))
+        builder = FailingBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")])
+        self.assertRaises(ValueError, ThreadPoolProcessor([builder], 2).process, 0)
+
+    def test_async(self):
+        builder = AsyncBuilder(40, [MemoryStore("src")], [MemoryStore("tgt")])
+        builder.fail_at = None
+        builder.probe = ConcurrencyProbe(20)
+        AsyncProcessor([builder], concurrency=20).process(0)
+        self.assertEqual(builder.probe.peak, 20)
+        self.assertEqual(sorted(i for c in builder.chunks for i in c), [2 * i for i in range(40)])
+        builder.fail_at = 7
+        builder.probe = ConcurrencyProbe(4)
+        self.assertRaises(ValueError, AsyncProcessor([builder], concurrency=4).process, 0)
+        # regular process_item
+        builder = CountingBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")])
+        AsyncProcessor([builder]).process(0)
+        self.assertEqual(sorted(i for c in builder.chunks for i in c), [2 * i for i in range(10)])
+
+    def test_runner_selection(self):
+        builders = [CountingBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")])]
+        self.assertIsInstance(Runner(builders, processor="async").processor, AsyncProcessor)
+        rnr = Runner(builders, num_workers=3, processor="thread")
+        self.assertEqual(rnr.processor.num_workers, 3)
+        rnr.run()
+        self.assertEqual(sorted(i for c in builders[0].chunks for i in c), [2 * i for i in range(10)])
+        self.assertRaises(ValueError, Runner, builders, processor="gpu")
+
+
+class TestMPICollectiveProcessor(unittest.TestCase):
+
+    def test_split(self):
+        split = MPICollectiveProcessor.split
+        self.assertEqual(split(list(range(7)), 3), [[0, 1, 2], [3, 4], [5, 6]])
+        self.assertEqual(split([0, 1], 4), [[0], [1], [], []])
+        self.assertEqual(split([], 2), [[], []])
+
+
+class FailingBuilder(CountingBuilder):
+
+    def update_targets(self, items):
+        raise ValueError("cannot write")
+
+
+class TestTargetWriter(unittest.TestCase):
+
+    def test_write(self):
+        for max_pending in (0, 2):
+            builder = CountingBuilder(0, [], [])
+            writer = TargetWriter(builder, max_pending)
+            for i in range(5):
+                writer.put([i])
+            writer.close()
+            self.assertEqual(builder.chunks, [[0], [1], [2], [3], [4]])
+
+    def test_error(self):
+        writer = TargetWriter(FailingBuilder(0, [], []))
+        writer.put([1])
+        self.assertRaises(ValueError, writer.close)
+
+    def test_serial_error(self):
+        builder = FailingBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")])
+        self.assertRaises(ValueError, SerialProcessor([builder]).process, 0)
+
+    def test_close_error(self):
+        builder = FailingBuilder(0, [], [])
+        writer = TargetWriter(builder)
+        writer.put([1])
+        with self.assertLogs(builder.logger, "ERROR"):
+            writer.close(raise_error=False)
+        # the exception of process_item is not replaced by the write error
+        builder = FailingBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")])
+        builder.process_item = lambda item: item if item < 5 else {}[item]
+        with self.assertLogs(builder.logger, "ERROR"):
+            self.assertRaises(KeyError, SerialProcessor([builder]).process, 0)
+
+    def test_serial(self):
+        builder = CountingBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")])
+        SerialProcessor([builder]).process(0)
+        self.assertEqual(builder.chunks, [[0, 2, 4], [6, 8, 10], [12, 14, 16], [18]])
+
+        builder = CountingBuilder(10, [MemoryStore("src")], [MemoryStore("tgt")], chunk_size=5)
+        # 2 * item pickles to 5 bytes for item < 128
+        builder.chunk_max_bytes = 15
+        SerialProcessor([builder]).process(0)
+        self.assertEqual(builder.chunks, [[0, 2, 4], [6, 8, 10], [12, 14, 16], [18]])
+
+    def test_multiproc_chunk_bytes(self):
+        builder = CountingBuilder(20, [MemoryStore("src")], [MemoryStore("tgt")], chunk_size=10)
+        builder.chunk_max_bytes = 15
+        MultiprocProcessor([builder], num_workers=2).process(0)
+        self.assertTrue(all(len(chunk) <= 3 for chunk in builder.chunks))
+        self.assertEqual(sorted(i for c in builder.chunks for i in c), [2 * i for i in range(20)])
+
+
+class ShardedBuilder(Builder):
+
+    def __init__(self, source, target):
+        super(ShardedBuilder, self).__init__([source], [target], chunk_size=7)
+        self.chunks = []
+
+    def get_items(self):
+        raise AssertionError("the items must be read by the workers")
+
+    def get_shards(self, n):
+        return self.sources[0].key_ranges(self.key, n)
+
+    def get_shard_items(self, shard):
+        return self.sources[0].collection.find(shard, {"_id": 0})
+
+    def process_item(self, item):
+        return 2 * item["task_id"]
+
+    def update_targets(self, items):
+        self.chunks.append(list(items))
+
+
+class TestShardedBuild(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = DiskStore(self.path, "src")
+        self.source.connect()
+        self.source.collection.insert_many([{"task_id": i} for i in range(50)])
+
+    def tearDown(self):
+        self.source.close()
+        shutil.rmtree(self.path)
+
+    def test_multiproc(self):
+        builder = ShardedBuilder(self.source, MemoryStore("tgt"))
+        MultiprocProcessor([builder], num_workers=2, result_batch_size=4).process(0)
+        processed = sorted(i for chunk in builder.chunks for i in chunk)
+        self.assertEqual(processed, [2 * i for i in range(50)])
+        self.assertTrue(all(len(chunk) <= 7 for chunk in builder.chunks))
+
+
+class CrashingBuilder(CountingBuilder):
+    """
+    Fails to write its crash_at th chunk, unless crash_at is None.
+    """
+
+    def __init__(self, N, sources, targets, crash_at=None):
+        super(CrashingBuilder, self).__init__(N, sources, targets)
+        self.crash_at = crash_at
+
+    def item_key(self, item):
+        return item
+
+    def update_targets(self, items):
+        if len(self.chunks) == self.crash_at:
+            raise ValueError("crash")
+        super(CrashingBuilder, self).update_targets(items)
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        # the checkpoint must survive reconnecting to the target
+        self.path = tempfile.mkdtemp()
+        self.source, self.target = MemoryStore("src"), DiskStore(self.path, "tgt")
+        self.target.connect()
+
+    def tearDown(self):
+        self.target.close()
+        shutil.rmtree(self.path)
+
+    def run_builder(self, processor_cls, crash_at=None, resume=False, **kwargs):
+        builder = CrashingBuilder(20, [self.source], [self.target], crash_at)
+        processor = processor_cls([builder], resume=resume, **kwargs)
+        if crash_at is None:
+            processor.process(0)
+        else:
+            self.assertRaises(ValueError, processor.process, 0)
+        return builder
+
+    def test_commit(self):
+        builder = CrashingBuilder(20, [], [self.target])
+        builder.build_start = datetime.datetime(2018, 1, 1)
+        checkpoint = Checkpoint(builder)
+        checkpoint.track(0, range(6))
+        checkpoint.commit([3, 4, 5])
+        self.assertEqual(checkpoint.n_items, 0)
+        checkpoint.commit([0, 1, 2])
+        self.assertEqual(checkpoint.n_items, 6)
+        self.assertEqual(checkpoint.checkpoint_id, "checkpoint.CrashingBuilder:tgt")
+        doc = self.target.meta.find_one({"_id": checkpoint.checkpoint_id})
+        self.assertEqual(doc["n_items"], 6)
+        self.assertEqual(doc["n_chunks"], 2)
+        self.assertEqual(doc["key"], 5)
+        self.assertEqual(doc["run_id"], checkpoint.run_id)
+
+        builder.build_start = datetime.datetime(2019, 1, 1)
+        resumed = Checkpoint(builder, resume=True)
+        self.assertEqual(resumed.run_id, checkpoint.run_id)
+        self.assertEqual(builder.build_start, datetime.datetime(2018, 1, 1))
+        self.assertEqual(list(resumed.skip(range(8))), [6, 7])
+        # items skipped by key, even if they changed since the checkpoint
+        self.assertEqual(list(resumed.skip([1, 4, 7, 9])), [7, 9])
+        self.assertRaises(RuntimeError, list, resumed.skip([1, 7, 3, 8]))
+        self.assertRaises(RuntimeError, list, resumed.skip([1, 1, 7]))
+        # no resume without keys
+        builder.item_key = lambda item: None
+        keyless = Checkpoint(builder)
+        keyless.track(0, range(3))
+        keyless.commit([0, 1, 2])
+        self.assertRaises(RuntimeError, Checkpoint(builder, resume=True).skip, range(8))
+        self.assertEqual(Checkpoint(builder).n_items, 0)
+        checkpoint.clear()
+        self.assertIsNone(self.target.meta.find_one({"_id": checkpoint.checkpoint_id}))
+
+    def test_checkpoint_id(self):
+        other = MemoryStore("other")
+        other.connect()
+        builders = [CrashingBuilder(20, [source], [self.target]) for source in (self.source, other)]
+        self.source.connect()
+        checkpoints = [Checkpoint(b) for b in builders]
+        self.assertNotEqual(checkpoints[0].checkpoint_id, checkpoints[1].checkpoint_id)
+        checkpoints[0].track(0, [0])
+        checkpoints[0].commit([0])
+        self.assertEqual(Checkpoint(builders[0], resume=True).key, 0)
+        self.assertEqual(Checkpoint(builders[1], resume=True).n_items, 0)
+
+    def test_serial_resume(self):
+        self.run_builder(SerialProcessor, crash_at=3)
+        builder = self.run_builder(SerialProcessor, resume=True)
+        self.assertEqual(builder.chunks, [[18, 20, 22], [24, 26, 28], [30, 32, 34], [36, 38]])
+        self.assertIsNone(self.target.meta.find_one({"_id": "checkpoint.CrashingBuilder:src,tgt"}))
+        # a new run without resume starts over
+        builder = self.run_builder(SerialProcessor)
+        self.assertEqual(len(builder.chunks), 7)
+
+    def test_multiproc_resume(self):
+        self.run_builder(MultiprocProcessor, crash_at=2, num_workers=2, max_pending_writes=0)
+        n_items = self.target.meta.find_one({"_id": "checkpoint.CrashingBuilder:src,tgt"})["n_items"]
+        builder = self.run_builder(MultiprocProcessor, resume=True, num_workers=2)
+        processed = sorted(i for chunk in builder.chunks for i in chunk)
+        self.assertEqual(processed, [2 * i for i in range(n_items, 20)])
+
+
+class TestParallelRunner(unittest.TestCase):
+
+    def setUp(self):
+        stores = [MemoryStore(str(i)) for i in range(5)]
+        # 0 and 1 are independent, 2 depends on both of them
+        self.builders = [CountingBuilder(10, [stores[0]], [stores[1]]),
+                         CountingBuilder(10, [stores[0]], [stores[2]]),
+                         CountingBuilder(10, [stores[1], stores[2]], [stores[3]])]
+
+    def test_serial_processor(self):
+        rnr = Runner(self.builders, processor=SerialProcessor(self.builders),
+                     max_parallel_builders=3)
+        rnr.run()
+        self.assertEqual(rnr.has_run[-1], 2)
+        self.assertEqual(sorted(rnr.has_run), [0, 1, 2])
+        self.assertTrue(all(b.chunks for b in self.builders))
+
+    def test_multiproc_processor(self):
+        rnr = Runner(self.builders, processor=MultiprocProcessor(self.builders, 4),
+                     max_parallel_builders=2)
+        rnr.run()
+        self.assertEqual(rnr.has_run[-1], 2)
+        for b in self.builders:
+            self.assertEqual(sorted(i for c in b.chunks for i in c), [2 * i for i in range(10)])
+
+    def test_error(self):
+        self.builders[1] = FailingBuilder(10, [MemoryStore("0")], [MemoryStore("2")])
+        rnr = Runner(self.builders, processor=SerialProcessor(self.builders),
+                     max_parallel_builders=3)
+        self.assertRaises(ValueError, rnr.run)
+        self.assertNotIn(2, rnr.has_run)
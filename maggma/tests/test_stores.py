@@ -1,9 +1,16 @@
+import bz2
+import gzip
+import json
 import os
+import shutil
+import tempfile
 import unittest
 
 import mongomock.collection
+from monty.json import MontyDecoder, MontyEncoder
 
 from maggma.stores import *
+from maggma.helpers import client_registry, get_collection, key_range_filters
 
 module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
 db_dir = os.path.abspath(os.path.join(module_dir, "..", "..", "test_files", "settings_files"))
@@ -22,5 +29,179 @@ class TestMemoryStore(unittest.TestCase):
         self.assertEqual(self.memstore(), self.memstore.collection)
         self.assertEqual(self.memstore.meta.name, "collection.db.collection.meta")
 
+    def test_engine_serialization(self):
+        t0 = datetime.datetime(2017, 1, 1)
+        for store in (MemoryStore("collection", engine="native", lu_field="lu"),
+                      JSONStore(["a.json"], batch_size=4, engine="native", lu_field="lu"),
+                      DatetimeStore(t0, engine="native", lu_field="lu")):
+            # as rebuilt by the spawned workers
+            copy = MontyDecoder().process_decoded(json.loads(json.dumps(store, cls=MontyEncoder)))
+            self.assertEqual((copy.engine, copy.lu_field), ("native", "lu"))
+        self.assertEqual(copy.dt, t0)
 
 
+
+    def test_update(self):
+        self.memstore.connect()
+        self.memstore.update([{"task_id": i, "a": i} for i in range(5)], key="task_id",
+                             batch_size=2)
+        self.assertEqual(len(list(self.memstore.collection.find())), 5)
+        self.memstore.update([{"task_id": 3, "a": 30}, {"task_id": 5, "a": 5}], key="task_id")
+        self.assertEqual(len(list(self.memstore.collection.find())), 6)
+        self.assertEqual(self.memstore.collection.find_one({"task_id": 3})["a"], 30)
+
+        self.memstore.update([{"d": {"k": 1}, "c": 1}, {"d": {"k": 1}, "c": 2}], key=["d.k"])
+        self.assertEqual(self.memstore.collection.find_one({"d.k": 1})["c"], 2)
+
+    def test_key_ranges(self):
+        self.memstore.connect()
+        self.memstore.collection.insert_many([{"task_id": i, "a": i % 2} for i in range(10)])
+        ranges = self.memstore.key_ranges("task_id", 3)
+        self.assertEqual(ranges[0], {"task_id": {"$lt": 3}})
+        self.assertEqual(ranges[2], {"task_id": {"$gte": 6}})
+        found = [sorted(d["task_id"] for d in self.memstore.collection.find(r)) for r in ranges]
+        self.assertEqual(found, [[0, 1, 2], [3, 4, 5], [6, 7, 8, 9]])
+        ranges = self.memstore.key_ranges("task_id", 20, {"a": 1})
+        self.assertEqual(len(ranges), 5)
+        self.assertEqual(sum(self.memstore.collection.count_documents(r) for r in ranges), 5)
+        # documents with the same key are not split
+        self.memstore.collection.insert_many([{"task_id": 3} for _ in range(10)])
+        ranges = self.memstore.key_ranges("task_id", 4)
+        self.assertEqual([self.memstore.collection.count_documents(r) for r in ranges], [3, 12, 5])
+
+    def test_key_ranges_buckets(self):
+        class BucketCollection:
+            def aggregate(self, pipeline, allowDiskUse=False):
+                self.pipeline = pipeline
+                return [{"_id": {"min": 0, "max": 4}}, {"_id": {"min": 4, "max": 9}}]
+
+        collection = BucketCollection()
+        self.assertEqual(key_range_filters(collection, "task_id", 2, {"a": 1}),
+                         [{"$and": [{"a": 1}, {"task_id": {"$lt": 4}}]},
+                          {"$and": [{"a": 1}, {"task_id": {"$gte": 4}}]}])
+        self.assertEqual(collection.pipeline[1], {"$bucketAuto": {"groupBy": "$task_id", "buckets": 2}})
+
+    def test_last_updated(self):
+        self.memstore.connect()
+        self.assertIn("_lu_1", self.memstore.collection.index_information())
+        self.assertEqual(self.memstore.last_updated, datetime.datetime.min)
+        t0 = datetime.datetime(2017, 1, 1)
+        t1 = datetime.datetime(2018, 1, 1)
+        self.memstore.collection.insert_many([{"a": 1, "_lu": t0}, {"a": 2, "_lu": t1}])
+        self.assertEqual(self.memstore.last_updated, t1)
+        self.memstore.update_watermark()
+        self.assertEqual(self.memstore.meta.find_one()["_lu"], t1)
+        # the cached watermark never decreases, last_updated follows the documents
+        self.memstore.collection.delete_many({"a": 2})
+        self.assertEqual(self.memstore.last_updated, t0)
+        self.memstore.update_watermark(t0)
+        self.assertEqual(self.memstore.watermark, t1)
+        self.assertEqual(self.memstore.lu_filter(self.memstore), {"_lu": {"$gt": t0}})
+
+    def test_lu_filter_after_wipe(self):
+        src, tgt = MemoryStore("src"), MemoryStore("tgt")
+        src.connect()
+        tgt.connect()
+        t0 = datetime.datetime(2017, 1, 1)
+        docs = [{"a": i, "_lu": t0 + datetime.timedelta(days=i)} for i in range(5)]
+        src.collection.insert_many([dict(d) for d in docs])
+        tgt.collection.insert_many([dict(d) for d in docs])
+        tgt.update_watermark()
+        self.assertEqual(src.collection.count_documents(src.lu_filter([tgt])), 0)
+        tgt.collection.delete_many({})
+        self.assertEqual(src.collection.count_documents(src.lu_filter([tgt])), 5)
+
+
+class TestJSONStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.docs = [{"task_id": i, "data": list(range(i))} for i in range(25)]
+        self.paths = [os.path.join(self.tmpdir, f) for f in ("a.json", "b.json.gz", "c.jsonl.bz2")]
+        with open(self.paths[0], "w") as f:
+            json.dump(self.docs[:10], f, indent=2)
+        with gzip.open(self.paths[1], "wt") as f:
+            json.dump(self.docs[10], f)
+        with bz2.open(self.paths[2], "wt") as f:
+            for doc in self.docs[11:]:
+                f.write(json.dumps(doc) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_connect(self):
+        for num_threads in (1, 3):
+            jsonstore = JSONStore(self.paths, batch_size=4, num_threads=num_threads)
+            jsonstore.connect()
+            docs = list(jsonstore.collection.find({}, {"_id": 0}).sort("task_id"))
+            self.assertEqual(docs, self.docs)
+
+    def test_bad_file(self):
+        with open(self.paths[0], "w") as f:
+            f.write('[{"task_id": 1}, {"task_id": ')
+        jsonstore = JSONStore(self.paths, num_threads=2)
+        self.assertRaises(ValueError, jsonstore.connect)
+
+    def test_insert_error(self):
+        # the readers, blocked on the full queue, must not hang the failed connect
+        docs = [{"_id": i} for i in range(200)]
+        paths = [os.path.join(self.tmpdir, f) for f in ("d.json", "e.json")]
+        for path in paths:
+            with open(path, "w") as f:
+                json.dump(docs, f)
+        jsonstore = JSONStore(paths, batch_size=10, num_threads=2)
+        self.assertRaises(pymongo.errors.PyMongoError, jsonstore.connect)
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def test_shared_client(self):
+        c1 = client_registry.acquire("localhost", 27017)
+        c2 = client_registry.acquire("localhost", 27017)
+        c3 = client_registry.acquire("localhost", 27018)
+        c4 = client_registry.acquire("localhost", 27017, "user", "pass", "db")
+        self.assertIs(c1, c2)
+        self.assertIsNot(c1, c3)
+        self.assertIsNot(c1, c4)
+        self.assertEqual(client_registry.count(c1), 2)
+        client_registry.release(c1)
+        self.assertEqual(client_registry.count(c1), 1)
+        for c in (c2, c3, c4):
+            client_registry.release(c)
+        self.assertEqual(client_registry.count(c1), 0)
+        # releasing an unknown client is a no-op
+        client_registry.release(c1)
+
+    def test_store_fork(self):
+        store = MongoStore("db", "collection")
+        store.ensure_lu_index = lambda: None  # no server needed
+        store.connect()
+        client = store.collection.database.client
+        self.assertTrue(store.connected)
+        # pretend we are in a forked child process
+        store._MongoStore__pid = -1
+        client_registry._pid = -1
+        self.assertFalse(store.connected)
+        store.connect()
+        self.assertIsNot(store.collection.database.client, client)
+        self.assertEqual(client_registry.count(client), 0)
+        store.close()
+
+    def test_fork(self):
+        c1 = client_registry.acquire("localhost", 27017)
+        # pretend we are in a forked child process
+        client_registry._pid = -1
+        c2 = client_registry.acquire("localhost", 27017)
+        self.assertIsNot(c1, c2)
+        client_registry.release(c1)
+        self.assertEqual(client_registry.count(c2), 1)
+        client_registry.release(c2)
+
+
+class TestGetCollection(unittest.TestCase):
+
+    def test_get_collection(self):
+        # the client does not connect until the collection is used
+        coll = get_collection(os.path.join(db_dir, "db.json"))
+        self.assertEqual(coll.full_name, "maggma_unittests.tmp")
+        coll.database.client.close()
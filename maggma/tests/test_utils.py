@@ -1,5 +1,11 @@
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
-from maggma.utils import get_mongolike, make_mongolike, put_mongolike, recursive_update
+from maggma.utils import get_mongolike, make_mongolike, put_mongolike, recursive_update, \
+    iter_json_objects, dot_path, extract_paths, merge_dicts, chunks, Chunker, sizeof
 
 
 class UtilsTests(unittest.TestCase):
@@ -23,6 +29,31 @@ class UtilsTests(unittest.TestCase):
         self.assertEqual(make_mongolike(d, "e.f.g", "a.b"), {"a": {"b": 3}})
         self.assertEqual(make_mongolike(d, "a.0.b", "e.f"), {"e": {"f": 1}})
 
+    def test_dot_path(self):
+        d = {"a": [{"b": 1}, {"c": {"d": 2}}], "e": {"f": {"g": 3}}}
+        path = dot_path("a.1.c.d")
+        self.assertIs(path, dot_path("a.1.c.d"))
+        self.assertEqual(path.get(d), 2)
+        self.assertRaises(KeyError, dot_path("e.x").get, d)
+        self.assertEqual(dot_path("a.5.b").get(d, None), None)
+
+        dot_path("a.1.c.x").set(d, 4)
+        dot_path("e.h.i").set(d, 5)
+        self.assertEqual(d["a"][1]["c"], {"d": 2, "x": 4})
+        self.assertEqual(d["e"], {"f": {"g": 3}, "h": {"i": 5}})
+        # scalars along the path raise TypeError, as indexing them does
+        self.assertRaises(TypeError, dot_path("e.f.g.h").set, d, 6)
+        self.assertRaises(TypeError, dot_path("e.f.g.h.i").set, d, 6)
+        self.assertRaises(TypeError, dot_path("e.f.g.h").get, d)
+        self.assertEqual(dot_path("e.f.g").put(1), {"e": {"f": {"g": 1}}})
+
+    def test_extract_paths(self):
+        docs = [{"a": {"b": i}, "c": [i, -i]} for i in range(5)] + [{"c": []}]
+        columns = extract_paths(docs, ["a.b", "c.1", "c"], default=-1)
+        self.assertEqual(columns["a.b"], [0, 1, 2, 3, 4, -1])
+        self.assertEqual(columns["c.1"], [0, -1, -2, -3, -4, -1])
+        self.assertEqual(columns["c"], [d["c"] for d in docs])
+
     def test_recursiveupdate(self):
         d = {"a": {"b": 3}, "c": [4]}
 
@@ -37,3 +68,90 @@ class UtilsTests(unittest.TestCase):
 
         recursive_update(d, {"a": {"b": [7]}})
         self.assertEqual(d["a"]["b"], [7])
+
+    def test_merge_dicts(self):
+        d = {"a": {"b": 1, "c": [1, 2]}, "d": [{"id": 1, "x": 1}, {"id": 2, "x": 2}], "e": 0}
+        changes = merge_dicts(d, {"a": {"b": 1, "c": [2, 3]}, "d": [{"id": 2, "x": 3}],
+                                  "f": {"g": 1}},
+                              list_strategy="union", list_key="id", track_changes=True)
+        self.assertEqual(d["a"]["c"], [1, 2, 3])
+        self.assertEqual(d["d"], [{"id": 1, "x": 1}, {"id": 2, "x": 3}])
+        self.assertEqual(changes, {"a.c": [1, 2, 3], "d": d["d"], "f": {"g": 1}})
+
+        merge_dicts(d, {"a": {"c": [4]}}, list_strategy="append")
+        self.assertEqual(d["a"]["c"], [1, 2, 3, 4])
+        merge_dicts(d, {"a": {"c": [5]}}, list_strategy=lambda old, new: new + old)
+        self.assertEqual(d["a"]["c"], [5, 1, 2, 3, 4])
+        self.assertEqual(merge_dicts(d, {"e": 0, "a": {"b": 1}}, track_changes=True), {})
+        self.assertRaises(ValueError, merge_dicts, d, {}, list_strategy="zip")
+
+        # deeper than the recursion limit
+        deep, update = {}, {}
+        for _ in range(5000):
+            deep, update = {"x": deep}, {"x": update}
+        update_leaf = update
+        while update_leaf:
+            update_leaf = update_leaf["x"]
+        update_leaf["y"] = 1
+        changes = merge_dicts(deep, update, track_changes=True)
+        self.assertEqual(len(changes), 1)
+        self.assertTrue(list(changes)[0].endswith("x.y"))
+
+    def test_chunks(self):
+        items = [0, {}, "", None, 1, 2, 3]
+        self.assertEqual(list(chunks(items, 3)), [[0, {}, ""], [None, 1, 2], [3]])
+        self.assertEqual(list(chunks([], 3)), [])
+        self.assertEqual(list(chunks("abcde", 10, max_bytes=2, sizeof=len)),
+                         [["a", "b"], ["c", "d"], ["e"]])
+        self.assertEqual(list(chunks(["abc", "d"], 10, max_bytes=2, sizeof=len)), [["abc"], ["d"]])
+        self.assertEqual(list(chunks(range(3), 10, max_age=0)), [[0], [1], [2]])
+
+    def test_sizeof(self):
+        self.assertEqual(sizeof({"a": 1}), 12)
+        # documents BSON can't encode fall back to pickle
+        items = [{1: "a"}, {"a": {2, 3}}, {"a": Chunker(1)}]
+        self.assertTrue(all(sizeof(item) > 0 for item in items))
+        self.assertEqual(len(list(chunks(items, 10, max_bytes=10 ** 6))), 1)
+
+    def test_chunker(self):
+        chunker = Chunker(2)
+        self.assertEqual(chunker.add(0), [])
+        self.assertEqual(chunker.extend(range(1, 6)), [[0, 1], [2, 3], [4, 5]])
+        self.assertEqual(chunker.add(6), [])
+        self.assertFalse(chunker.expired)
+        self.assertEqual(chunker.flush(), [6])
+
+        chunker = Chunker(1, max_bytes=2, sizeof=len)
+        self.assertEqual(chunker.extend(["a", "bcd"]), [["a"], ["bcd"]])
+        chunker = Chunker(10, max_age=0.05)
+        chunker.add(1)
+        time.sleep(0.06)
+        self.assertTrue(chunker.expired)
+        self.assertEqual(chunker.add(2), [[1, 2]])
+
+    def test_iter_json_objects(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "docs.json")
+        docs = [{"a": i, "b": [1.5, "x" * i]} for i in range(20)]
+        try:
+            with open(path, "w") as f:
+                json.dump(docs, f)
+            for read_size in (1, 7, 1 << 20):
+                self.assertEqual(list(iter_json_objects(path, read_size)), docs)
+            with open(path, "w") as f:
+                f.write("\n".join(json.dumps(d) for d in docs))
+            self.assertEqual(list(iter_json_objects(path, 5)), docs)
+            with open(path, "w") as f:
+                f.write("[1, 23, 456]")
+            self.assertEqual(list(iter_json_objects(path, 1)), [1, 23, 456])
+            # invalid JSON fails at the bad document, not at the end of the file
+            with open(path, "w") as f:
+                f.write('{"a": 1}\n{"a": x}\n')
+                f.write("\n".join(json.dumps(d) for d in docs * 100))
+            read = []
+            with self.assertRaises(ValueError):
+                for doc in iter_json_objects(path, 16):
+                    read.append(doc)
+            self.assertEqual(read, [{"a": 1}])
+        finally:
+            shutil.rmtree(tmpdir)
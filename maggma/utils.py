@@ -1,7 +1,17 @@
 # coding: utf-8
+import functools
 import itertools
+import json
+import operator
+import pickle
+import time
+from collections.abc import Mapping
 from datetime import datetime, timedelta
 
+from bson import BSON
+from bson.errors import InvalidDocument
+from monty.io import zopen
+
 
 def dt_to_isoformat_ceil_ms(dt):
     """Helper to account for Mongo storing datetimes with only ms precision."""
@@ -15,6 +25,130 @@ LU_KEY_ISOFORMAT = (lambda s: datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%f"),
                     dt_to_isoformat_ceil_ms)
 
 
+class DotPath:
+    """
+    A mongo dot-notation path like "a.b.0.c", parsed once so that it can be
+    applied to many documents. Path components that parse as integers are used
+    as list indices when getting values. Use dot_path to get a cached instance.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, key):
+        """
+        Args:
+            key (str): the key in dot notation
+        """
+        self.key = key
+        self.keys = tuple(key.split("."))
+        self.parts = tuple(self._parse(k) for k in self.keys)
+        # d["a"]["b"][0]["c"] for "a.b.0.c"
+        self._get = functools.partial(functools.reduce, operator.getitem, self.parts)
+
+    @staticmethod
+    def _parse(k):
+        try:
+            return int(k)  # for searching array data
+        except ValueError:
+            return k
+
+    def get(self, d, default=_MISSING):
+        """
+        Grab the value at the path.
+
+        Args:
+            d (dict): the dictionary to search
+            default: value returned if the path does not exist. If not given,
+                a KeyError, IndexError or TypeError is raised instead.
+
+        Returns:
+            value stored at the path
+        """
+        if default is self._MISSING:
+            return self._get(d)
+        try:
+            return self._get(d)
+        except (KeyError, IndexError, TypeError):
+            return default
+
+    def set(self, d, value):
+        """
+        Set the value at the path in place, creating the missing intermediate
+        dictionaries. Lists along the path are indexed, not created.
+
+        Args:
+            d (dict): the dictionary to update
+            value: object
+
+        Raises:
+            TypeError: if a value along the path is neither a dict nor a list
+            IndexError: if a list along the path is too short
+        """
+        for k, part in zip(self.keys[:-1], self.parts[:-1]):
+            if isinstance(d, list):
+                d = d[part]
+            else:
+                if k not in d:
+                    d[k] = {}
+                d = d[k]
+        if isinstance(d, list):
+            d[self.parts[-1]] = value
+        else:
+            d[self.keys[-1]] = value
+
+    def put(self, value):
+        """
+        Build a new dictionary holding the value at the path, see put_mongolike.
+
+        Args:
+            value: object
+        """
+        for k in reversed(self.keys):
+            value = {k: value}
+        return value
+
+    def __repr__(self):
+        return "DotPath({!r})".format(self.key)
+
+
+@functools.lru_cache(maxsize=1024)
+def dot_path(key):
+    """
+    The DotPath of a key, cached.
+
+    Args:
+        key (str): the key in dot notation, e.g., "a.b.c"
+
+    Returns:
+        DotPath
+    """
+    return DotPath(key)
+
+
+def extract_paths(docs, keys, default=None):
+    """
+    Grab the values of several dot-notation keys from a batch of documents.
+
+    Args:
+        docs (list): the dictionaries to search
+        keys (list): the keys in dot notation
+        default: value used where a key does not exist in a document
+
+    Returns:
+        dict: key: list of the values of the key, in the order of docs
+    """
+    docs = docs if isinstance(docs, list) else list(docs)
+    columns = {}
+    for key in keys:
+        get = dot_path(key)._get
+        try:
+            columns[key] = [get(d) for d in docs]
+        except (KeyError, IndexError, TypeError):
+            # slow path, some documents lack the key
+            columns[key] = [dot_path(key).get(d, default) for d in docs]
+    return columns
+
+
 def get_mongolike(d, key):
     """
     Grab a dict value using dot-notation like "a.b.c" from dict {"a":{"b":{"c": 3}}}
@@ -26,16 +160,7 @@ def get_mongolike(d, key):
         value from desired dict (whatever is stored at the desired key)
 
     """
-    lead_key = key.split(".", 1)[0]
-    try:
-        lead_key = int(lead_key)  # for searching array data
-    except:
-        pass
-
-    if "." in key:
-        remainder = key.split(".", 1)[1]
-        return get_mongolike(d[lead_key], remainder)
-    return d[lead_key]
+    return dot_path(key)._get(d)
 
 
 def put_mongolike(key, value):
@@ -46,12 +171,7 @@ def put_mongolike(key, value):
         key (str): the key to put into using mongo notation, doesn't support arrays
         value: object
     """
-    lead_key = key.split(".", 1)[0]
-
-    if "." in key:
-        remainder = key.split(".", 1)[1]
-        return {lead_key: put_mongolike(remainder, value)}
-    return {lead_key: value}
+    return dot_path(key).put(value)
 
 
 def make_mongolike(d, get_key, put_key):
@@ -66,29 +186,322 @@ def make_mongolike(d, get_key, put_key):
     return put_mongolike(put_key,get_mongolike(d,get_key))
 
 
-def recursive_update(d, u):
+def replace_lists(old, new):
+    """
+    List merge strategy: the new list replaces the old one.
+    """
+    return new
+
+
+def append_lists(old, new):
     """
-    Recursive updates d with values from u
+    List merge strategy: the new items are appended to the old ones.
+    """
+    return old + new
+
+
+def union_lists(old, new, key=None):
+    """
+    List merge strategy: union of the old and new items. Items are the same if
+    they have the same value of key (a dot-notation key of dict items), or if
+    they are equal when no key is given or an item lacks the key. A new item
+    replaces the old item it matches, other new items are appended.
 
     Args:
-        d (dict): dict to update
-        u (dict): updates to propogate
+        old (list): the old items
+        new (list): the new items
+        key (str): key identifying the items, whose values must be hashable
     """
+    merged = list(old)
+    if key is None:
+        merged.extend(item for item in new if item not in old)
+        return merged
+    path = dot_path(key)
+    positions = {}
+    for i, item in enumerate(old):
+        k = path.get(item, None)
+        if k is not None:
+            positions[k] = i
+    for item in new:
+        k = path.get(item, None)
+        if k is None:
+            if item not in old:
+                merged.append(item)
+        elif k in positions:
+            merged[positions[k]] = item
+        else:
+            positions[k] = len(merged)
+            merged.append(item)
+    return merged
 
-    for k, v in u.items():
-        if k in d:
-            if isinstance(v, dict) and isinstance(d[k], dict):
-                recursive_update(d[k], v)
-            else:
-                d[k] = v
+
+LIST_STRATEGIES = {"replace": replace_lists, "append": append_lists, "union": union_lists}
+
+
+def merge_dicts(d, u, list_strategy="replace", list_key=None, track_changes=False):
+    """
+    Merge u into d in place, in a single iterative pass over both trees (deep
+    documents do not hit the recursion limit). Nested dicts are merged, lists
+    are merged with list_strategy and other values of u replace those of d.
+    Values of u are not copied.
+
+    Args:
+        d (dict): dict to update
+        u (dict): updates to propagate
+        list_strategy (str or callable): "replace", "append", "union" (see
+            union_lists) or a function (old_list, new_list) -> merged list
+        list_key (str): key identifying list items for the "union" strategy
+        track_changes (bool): whether to return the changed fields
+
+    Returns:
+        dict: if track_changes, dot-notation key: new value of each field that
+            changed, i.e. a Mongo $set document. Otherwise None.
+    """
+    if not callable(list_strategy):
+        if list_strategy not in LIST_STRATEGIES:
+            raise ValueError("Unknown list merge strategy: {}".format(list_strategy))
+        if list_strategy == "union":
+            list_strategy = functools.partial(union_lists, key=list_key)
         else:
+            list_strategy = LIST_STRATEGIES[list_strategy]
+
+    changes = {} if track_changes else None
+    stack = [(d, u, "")]
+    while stack:
+        d, u, prefix = stack.pop()
+        for k, v in u.items():
+            if k in d:
+                old = d[k]
+                if isinstance(v, dict) and isinstance(old, dict):
+                    stack.append((old, v, "{}{}.".format(prefix, k)))
+                    continue
+                if isinstance(v, list) and isinstance(old, list):
+                    v = list_strategy(old, v)
+                if track_changes and old == v:
+                    continue
             d[k] = v
+            if track_changes:
+                changes["{}{}".format(prefix, k)] = v
+    return changes
+
+
+def recursive_update(d, u):
+    """
+    Recursive updates d with values from u, see merge_dicts
+
+    Args:
+        d (dict): dict to update
+        u (dict): updates to propogate
+    """
+    merge_dicts(d, u)
 
 
 def grouper(iterable, n, fillvalue=None):
     """
-    Collect data into fixed-length chunks or blocks.
+    Collect data into fixed-length chunks or blocks. The last chunk is padded
+    with fillvalue, use chunks to get exact chunks.
     """
     # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx
     args = [iter(iterable)] * n
     return itertools.zip_longest(*args, fillvalue=fillvalue)
+
+
+def sizeof(item):
+    """
+    Encoded size of an item in bytes: BSON size of documents, pickle size of
+    other objects and of the mappings BSON can't encode (non-str keys, numpy
+    values, ...).
+    """
+    if isinstance(item, Mapping):
+        try:
+            return len(BSON.encode(item))
+        except (InvalidDocument, TypeError):
+            pass
+    return len(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+
+
+class Chunker:
+    """
+    Groups a stream of items into chunks (lists), without padding. A chunk is
+    complete when it holds size items, when adding an item would make it
+    exceed max_bytes, or when its first item was added more than max_age
+    seconds ago. The age is only checked when items are added; use expired to
+    flush a chunk while waiting for items.
+    """
+
+    def __init__(self, size=1000, max_bytes=None, max_age=None, sizeof=sizeof):
+        """
+        Args:
+            size (int): maximum number of items per chunk
+            max_bytes (int): maximum total size of the items of a chunk. A
+                single item larger than that makes a chunk on its own.
+            max_age (float): maximum time in seconds between the first item of
+                a chunk and the completion of the chunk
+            sizeof (callable): size of an item in bytes, used with max_bytes
+        """
+        self.size = max(1, size)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sizeof = sizeof
+        self._chunk = []
+        self._bytes = 0
+        self._started = None
+
+    def __len__(self):
+        return len(self._chunk)
+
+    @property
+    def expired(self):
+        """
+        Whether the pending chunk is older than max_age.
+        """
+        return (self.max_age is not None and bool(self._chunk)
+                and time.monotonic() - self._started >= self.max_age)
+
+    def add(self, item):
+        """
+        Add an item.
+
+        Returns:
+            list: the chunks completed by the item, usually none or one
+        """
+        completed = []
+        if self.max_bytes is not None:
+            n_bytes = self.sizeof(item)
+            if self._chunk and self._bytes + n_bytes > self.max_bytes:
+                completed.append(self.flush())
+            self._bytes += n_bytes
+        if not self._chunk and self.max_age is not None:
+            self._started = time.monotonic()
+        self._chunk.append(item)
+        if len(self._chunk) >= self.size or self.expired:
+            completed.append(self.flush())
+        return completed
+
+    def extend(self, items):
+        """
+        Add several items.
+
+        Returns:
+            list: the completed chunks
+        """
+        if self.max_bytes is not None or self.max_age is not None:
+            completed = []
+            for item in items:
+                completed.extend(self.add(item))
+            return completed
+        # only the number of items matters, slice
+        self._chunk.extend(items)
+        n_full = len(self._chunk) // self.size * self.size
+        completed = [self._chunk[i:i + self.size] for i in range(0, n_full, self.size)]
+        del self._chunk[:n_full]
+        return completed
+
+    def flush(self):
+        """
+        Complete the pending chunk.
+
+        Returns:
+            list: the pending items, possibly none
+        """
+        chunk, self._chunk = self._chunk, []
+        self._bytes = 0
+        self._started = None
+        return chunk
+
+
+def chunks(iterable, size=1000, max_bytes=None, max_age=None, sizeof=sizeof):
+    """
+    Iterate over exact chunks of an iterable, see Chunker.
+
+    Args:
+        iterable: the items
+        size (int): maximum number of items per chunk
+        max_bytes (int): maximum total size of the items of a chunk
+        max_age (float): maximum time in seconds spent collecting a chunk
+        sizeof (callable): size of an item in bytes, used with max_bytes
+
+    Yields:
+        list: chunks of items
+    """
+    if max_bytes is None and max_age is None:
+        iterator = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(iterator, size))
+            if not chunk:
+                return
+            yield chunk
+    chunker = Chunker(size, max_bytes, max_age, sizeof)
+    for item in iterable:
+        yield from chunker.add(item)
+    chunk = chunker.flush()
+    if chunk:
+        yield chunk
+
+
+def _json_truncated(err):
+    """
+    Whether a JSON decoding error may come from a document truncated by the end
+    of the buffer, rather than from invalid JSON: the error is at the end of
+    the buffer (within the longest literal, -Infinity), or in a string that is
+    not terminated yet.
+    """
+    return err.pos >= len(err.doc) - len("-Infinity") or err.msg.startswith("Unterminated string")
+
+
+def iter_json_objects(path, read_size=1 << 20):
+    """
+    Incrementally parse the documents of a JSON file, without loading the whole
+    file in memory. The file holds either a JSON array of documents, a single
+    document or a sequence of documents (e.g. JSON-lines). gzip, bz2 and xz
+    compressed files are decompressed transparently based on their extension.
+    A document that is not valid JSON raises ValueError as soon as it is read,
+    instead of buffering the rest of the file.
+
+    Args:
+        path (str): path to the file
+        read_size (int): number of characters read from the file at a time
+
+    Yields:
+        the documents in the file
+    """
+    decoder = json.JSONDecoder()
+    with zopen(path, "rt") as f:
+        buf, pos, eof = "", 0, False
+        in_array = None
+        while True:
+            # skip the whitespace (and, within an array, the separators)
+            while pos < len(buf) and (buf[pos].isspace() or (in_array and buf[pos] == ",")):
+                pos += 1
+            if pos == len(buf) or not eof and len(buf) - pos < 2:
+                if eof:
+                    if in_array:
+                        raise ValueError("Unterminated JSON array in {}".format(path))
+                    return
+                chunk = f.read(read_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            if in_array is None:
+                in_array = buf[pos] == "["
+                if in_array:
+                    pos += 1
+                continue
+            if in_array and buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as err:
+                if eof or not _json_truncated(err):
+                    raise
+                end = None
+            # a value ending with the buffer (e.g. a number) may be truncated
+            if end is None or (end == len(buf) and not eof):
+                # read at least as much as buffered, so that big documents are
+                # not re-parsed once per read_size
+                chunk = f.read(max(read_size, len(buf) - pos))
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            yield obj
+            pos = end